@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+"""Benchmark kit password hashing against the number of processes
+
+Creating handout kits is dominated by bcrypt hashing one password per kit.
+This times knimin.lib.util.hash_passwords on generated kit passwords with an
+increasing number of worker processes, up to one per CPU, and reports kits
+hashed per second. No database is needed::
+
+    python benchmarks/bench_kit_hashing.py --kits 500
+"""
+from __future__ import division
+from multiprocessing import cpu_count
+from time import time
+
+import click
+
+from knimin.lib.util import hash_passwords, make_passwd
+
+
+@click.command()
+@click.option('--kits', default=200, show_default=True,
+              help='Number of kit passwords hashed per run')
+@click.option('--max-processes', default=cpu_count(), show_default=True,
+              help='Largest number of worker processes to try')
+def bench(kits, max_processes):
+    passwords = [make_passwd() for _ in range(kits)]
+    # 1, 2, 4, ... and max_processes itself
+    counts = {2 ** i for i in range(max_processes.bit_length())}
+    counts.add(max_processes)
+
+    click.echo('%-10s %12s %10s' % ('processes', 'kits/second', 'speedup'))
+    base = None
+    for processes in sorted(counts):
+        start = time()
+        hash_passwords(passwords, processes)
+        rate = kits / (time() - start)
+        if base is None:
+            base = rate
+        click.echo('%-10d %12.1f %9.2fx' % (processes, rate, rate / base))
+
+
+if __name__ == '__main__':
+    bench()
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+"""Benchmark barcode label rendering
+
+Times rendering synthetic barcodes as label images with
+knimin.lib.code128.code128_image, the size used for label sheets, and as a
+PDF of label sheets with knimin.lib.squash_barcodes.build_barcodes_pdf,
+with 1, 2, 4, ... worker processes up to one per CPU. Reports labels
+rendered per second. No database is needed::
+
+    python benchmarks/bench_labels.py --labels 100000
+"""
+from __future__ import division
+from multiprocessing import cpu_count
+from time import time
+
+import click
+
+from knimin.lib.squash_barcodes import build_barcodes_pdf, get_image
+
+
+@click.command()
+@click.option('--labels', default=10000, show_default=True,
+              help='Number of labels rendered per run')
+@click.option('--max-processes', default=cpu_count(), show_default=True,
+              help='Largest number of processes rendering PDF pages')
+def bench(labels, max_processes):
+    barcodes = ['%09d' % i for i in range(1, labels + 1)]
+
+    click.echo('%-10s %12s %10s' % ('output', 'labels/sec', 'seconds'))
+    start = time()
+    for _ in get_image(barcodes):
+        pass
+    taken = time() - start
+    click.echo('%-10s %12.1f %10.2f' % ('image', labels / taken, taken))
+
+    # 1, 2, 4, ... and max_processes itself
+    counts = {2 ** i for i in range(max_processes.bit_length())}
+    counts.add(max_processes)
+    for processes in sorted(counts):
+        start = time()
+        pdf = build_barcodes_pdf(barcodes, processes)
+        taken = time() - start
+        click.echo('%-10s %12.1f %10.2f' % ('pdf x%d' % processes,
+                                            labels / taken, taken))
+    click.echo('PDF size: %d bytes' % len(pdf))
+
+
+if __name__ == '__main__':
+    bench()
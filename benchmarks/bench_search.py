@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+"""Benchmark the AG search queries on a synthetic dataset
+
+Builds a minimal copy of the tables searched by the AG search page in an
+EMPTY scratch database, fills them with generated rows and times
+KniminAccess.search_participant_info, search_kits, search_barcodes and
+search_handout_kits before and after applying patch 0001 (trigram indexes).
+
+The scratch database must already exist and is reached with the postgres
+settings from the labadmin config, e.g.::
+
+    createdb ag_bench
+    python benchmarks/bench_search.py --database ag_bench --logins 2000000
+"""
+from __future__ import division
+from copy import copy
+from os.path import join
+from time import time
+
+import click
+
+from knimin.lib.configuration import config
+from knimin.lib.data_access import KniminAccess
+from knimin.lib.patch import PATCHES_DIR
+
+
+SCHEMA_SQL = """
+CREATE SCHEMA ag;
+CREATE SCHEMA barcodes;
+CREATE TABLE ag.ag_login (
+    ag_login_id uuid PRIMARY KEY, email varchar, name varchar,
+    address varchar, city varchar, state varchar, zip varchar,
+    country varchar);
+CREATE TABLE ag.ag_kit (
+    ag_kit_id uuid PRIMARY KEY, ag_login_id uuid, supplied_kit_id varchar,
+    kit_password varchar, swabs_per_kit integer,
+    kit_verification_code varchar, kit_verified char(1));
+CREATE TABLE ag.ag_kit_barcodes (
+    ag_kit_barcode_id uuid PRIMARY KEY, ag_kit_id uuid, barcode varchar,
+    notes varchar);
+CREATE TABLE ag.ag_login_surveys (
+    ag_login_id uuid, survey_id varchar PRIMARY KEY,
+    participant_name varchar);
+CREATE TABLE ag.ag_handout_kits (
+    kit_id varchar PRIMARY KEY, password varchar, verification_code varchar,
+    swabs_per_kit integer);
+CREATE TABLE ag.ag_handout_barcodes (
+    kit_id varchar, barcode varchar, sample_barcode_file varchar);
+"""
+
+# %(n)s logins, one kit and one participant per login, two barcodes per kit
+# and n / 4 handout kits with two barcodes each. Roughly 40% of the emails
+# are gmail addresses so "gmail" is a realistic broad search.
+DATA_SQL = """
+INSERT INTO ag.ag_login
+    SELECT md5(random()::text)::uuid,
+           'user' || i || '@' || (ARRAY['gmail.com', 'gmail.com',
+                                        'ucsd.edu', 'yahoo.com',
+                                        'hotmail.com'])[i %% 5 + 1],
+           md5(i::text), i || ' ' || md5((i * 7)::text) || ' st',
+           'city', 'CA', '92093', 'USA'
+    FROM generate_series(1, %(n)s) i;
+INSERT INTO ag.ag_kit
+    SELECT md5(random()::text)::uuid, ag_login_id,
+           substr(md5(ag_login_id::text), 1, 5), md5(email), 2,
+           lpad((abs(hashtext(email)) %% 100000)::text, 5, '0'), 'y'
+    FROM ag.ag_login;
+INSERT INTO ag.ag_kit_barcodes
+    SELECT md5(random()::text)::uuid, ag_kit_id,
+           lpad((row_number() OVER ())::text, 9, '0'),
+           CASE WHEN random() < 0.1 THEN md5(random()::text) END
+    FROM ag.ag_kit, generate_series(1, 2);
+INSERT INTO ag.ag_login_surveys
+    SELECT ag_login_id, md5(ag_login_id::text), 'participant ' || name
+    FROM ag.ag_login;
+INSERT INTO ag.ag_handout_kits
+    SELECT 'h' || i, md5(i::text), '12345', 2
+    FROM generate_series(1, %(n)s / 4) i;
+INSERT INTO ag.ag_handout_barcodes
+    SELECT 'h' || i, lpad((%(n)s * 2 + i * 2 - j)::text, 9, '0'), ''
+    FROM generate_series(1, %(n)s / 4) i, generate_series(0, 1) j;
+ANALYZE;
+"""
+
+
+def time_search(func, term, repeat):
+    """Best wall clock time of func(term) in seconds, and number of hits"""
+    best = None
+    for _ in range(repeat):
+        start = time()
+        hits = len(func(term))
+        elapsed = time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, hits
+
+
+@click.command()
+@click.option('--database', required=True,
+              help='Empty scratch database to generate the data in')
+@click.option('--logins', default=2000000, type=int,
+              help='Number of synthetic logins (kits, barcodes and '
+                   'participants scale with it)')
+@click.option('--repeat', default=3, type=int,
+              help='Runs per query, best time reported')
+def bench(database, logins, repeat):
+    bench_config = copy(config)
+    bench_config.db_database = database
+    db = KniminAccess(bench_config)
+
+    exists = db._con.execute_fetchone(
+        "SELECT EXISTS(SELECT 1 FROM pg_namespace WHERE nspname = 'ag')")[0]
+    if exists:
+        raise click.ClickException(
+            'Schema ag already exists in %s; use an empty database' %
+            database)
+
+    click.echo('Generating %d logins...' % logins)
+    start = time()
+    db._con.execute(SCHEMA_SQL)
+    db._con.execute(DATA_SQL % {'n': logins})
+    click.echo('Generated in %.1fs' % (time() - start))
+
+    some_email = db._con.execute_fetchone(
+        "SELECT email FROM ag.ag_login LIMIT 1 OFFSET %s", [logins // 2])[0]
+    searches = [
+        ('search_participant_info', db.search_participant_info,
+         [some_email, 'gmail']),
+        ('search_kits', db.search_kits, ['a1b2c']),
+        ('search_barcodes', db.search_barcodes,
+         ['%09d' % (logins // 3), 'participant 1a2b']),
+        ('search_handout_kits', db.search_handout_kits,
+         ['h%d' % (logins // 8), '%09d' % (logins * 2 + 10)]),
+    ]
+
+    def run():
+        results = {}
+        for name, func, terms in searches:
+            for term in terms:
+                results[(name, term)] = time_search(func, term, repeat)
+        return results
+
+    click.echo('Timing without trigram indexes...')
+    before = run()
+    patch_fp = join(PATCHES_DIR, '0001.sql')
+    click.echo('Applying %s...' % patch_fp)
+    start = time()
+    with open(patch_fp, 'U') as f:
+        db._con.execute(f.read())
+    db._con.execute('ANALYZE')
+    click.echo('Indexes built in %.1fs' % (time() - start))
+    click.echo('Timing with trigram indexes...')
+    after = run()
+
+    click.echo('\n%-25s %-32s %8s %10s %10s %8s' % (
+        'method', 'term', 'hits', 'seq (ms)', 'trgm (ms)', 'speedup'))
+    for name, _, terms in searches:
+        for term in terms:
+            seq, hits = before[(name, term)]
+            trgm, _ = after[(name, term)]
+            click.echo('%-25s %-32s %8d %10.1f %10.1f %7.1fx' % (
+                name, term, hits, seq * 1000, trgm * 1000, seq / trgm))
+
+
+if __name__ == '__main__':
+    bench()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+"""Benchmark syncing vioscreen data against a local stand-in for the API
+
+Serves the recorded session in knimin/tests/data/vioscreen for --users users
+from a local stand-in of the vioscreen API, with the given latency and error
+rate, and times VioscreenHandler.sync_vioscreen into the vioscreen tables of
+an EMPTY scratch database at each concurrency. The tables are emptied
+between runs, so every run pulls and stores every user.
+
+The scratch database must already exist and is reached with the postgres
+settings from the labadmin config, e.g.::
+
+    createdb ag_bench
+    python benchmarks/bench_vioscreen_sync.py --database ag_bench \\
+        --users 500 --latency 0.1 --concurrency 1 --concurrency 8
+"""
+from __future__ import division
+from copy import copy
+from time import time
+
+import click
+
+from knimin.lib.configuration import config
+from knimin.lib.data_access import SQLHandler
+from knimin.lib.vioscreen import VioscreenClient, VioscreenHandler
+from knimin.tests.vioscreen_api import VioscreenStandIn
+
+
+SCHEMA_SQL = """
+CREATE SCHEMA ag;
+CREATE TABLE ag.vioscreen_surveys (
+    status varchar, survey_id varchar PRIMARY KEY, pulldown_date timestamp,
+    pulled_at timestamp, session_id varchar);
+CREATE TABLE ag.vioscreen_foodcomponents (
+    survey_id varchar, code varchar, description varchar, valuetype varchar,
+    amount double precision, units varchar);
+CREATE TABLE ag.vioscreen_percentenergy (
+    survey_id varchar, code varchar, description varchar,
+    foodcomponenttype integer, fooddatadefinition varchar, precision integer,
+    shortdescription varchar, units varchar, amount double precision);
+CREATE TABLE ag.vioscreen_mpeds (
+    survey_id varchar, code varchar, description varchar, valuetype varchar,
+    amount double precision, units varchar);
+CREATE TABLE ag.vioscreen_eatingpatterns (
+    survey_id varchar, code varchar, description varchar, valuetype varchar,
+    amount double precision, units varchar);
+CREATE TABLE ag.vioscreen_foodconsumption (
+    survey_id varchar, description varchar, foodcode varchar,
+    foodgroup varchar, amount double precision, frequency integer,
+    consumptionadjustment double precision, servingsizetext varchar,
+    servingfrequencytext varchar, created varchar, data jsonb);
+CREATE TABLE ag.vioscreen_dietaryscore (
+    survey_id varchar, type varchar, name varchar, score double precision,
+    lowerlimit double precision, upperlimit double precision);
+"""
+
+
+@click.command()
+@click.option('--database', required=True,
+              help='Empty scratch database to store the vioscreen data in')
+@click.option('--users', default=200, type=int,
+              help='Number of users served by the stand-in')
+@click.option('--latency', default=0.05, type=float,
+              help='Seconds each API request takes')
+@click.option('--error-rate', default=0.0, type=float,
+              help='Fraction of API requests answered with 503')
+@click.option('--scale', default=1, type=int,
+              help='Times the recorded rows are repeated in each session')
+@click.option('--concurrency', multiple=True, type=int,
+              help='Concurrent requests to time, can be repeated. '
+                   'Default 1, 2, 4 and 8')
+@click.option('--parsed', is_flag=True,
+              help='Decode the session data in python instead of splitting '
+                   'the JSON into rows in postgres')
+def bench(database, users, latency, error_rate, scale, concurrency, parsed):
+    bench_config = copy(config)
+    bench_config.db_database = database
+    bench_config.vioscreen_rate_limit = 0
+    bench_config.vioscreen_raw_payloads = not parsed
+    sql = SQLHandler(bench_config)
+
+    exists = sql.execute_fetchone(
+        "SELECT EXISTS(SELECT 1 FROM pg_namespace WHERE nspname = 'ag')")[0]
+    if exists:
+        raise click.ClickException(
+            'Schema ag already exists in %s; use an empty database' %
+            database)
+    sql.execute(SCHEMA_SQL)
+
+    api = VioscreenStandIn({'user%06d' % i: 'Finished'
+                            for i in range(users)},
+                           latency=latency, error_rate=error_rate,
+                           scale=scale, seed=0)
+    bench_config.vioscreen_url = api.start()
+    click.echo('Serving %d users at %s, %.0fms latency, %.0f%% errors' % (
+        users, bench_config.vioscreen_url, latency * 1000, error_rate * 100))
+
+    click.echo('\n%11s %8s %12s %9s %8s %13s %9s' % (
+        'concurrency', 'seconds', 'users/minute', 'requests', 'retries',
+        'mean req (ms)', 'failures'))
+    try:
+        for n in concurrency or (1, 2, 4, 8):
+            bench_config.vioscreen_concurrency = n
+            VioscreenClient._tokens.clear()
+            vio = VioscreenHandler(bench_config)
+            start = time()
+            failures = vio.sync_vioscreen()
+            elapsed = time() - start
+            stats = vio._client.stats()
+            click.echo('%11d %8.1f %12.0f %9d %8d %13.1f %9d' % (
+                n, elapsed, users * 60 / elapsed, stats['requests'],
+                stats['retries'], stats['mean_seconds'] * 1000,
+                len(failures)))
+            vio.flush_vioscreen_db()
+    finally:
+        api.stop()
+
+
+if __name__ == '__main__':
+    bench()
@@ -1,7 +1,12 @@
 #!/usr/bin/env python
+from functools import partial
+
 from knimin.lib.configuration import config
 from knimin.lib.data_access import KniminAccess
+from knimin.lib.typeahead import TypeaheadIndex
 
 db = KniminAccess(config)
+# refreshed on its own thread, with its own connection
+typeahead = TypeaheadIndex(partial(KniminAccess, config))
 
-__all__ = ['db']
+__all__ = ['db', 'typeahead']
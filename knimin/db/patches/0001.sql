@@ -0,0 +1,37 @@
+-- Trigram indexes for the AG search page
+--
+-- KniminAccess.search_participant_info, search_kits, search_barcodes and
+-- search_handout_kits match substrings with LIKE '%term%', which a btree
+-- index cannot serve. GIN trigram indexes on the exact expressions used in
+-- those queries let the planner replace the sequential scans with bitmap
+-- index scans.
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE INDEX ag_login_email_trgm_idx
+    ON ag.ag_login USING gin (lower(email) gin_trgm_ops);
+CREATE INDEX ag_login_name_trgm_idx
+    ON ag.ag_login USING gin (lower(name) gin_trgm_ops);
+CREATE INDEX ag_login_address_trgm_idx
+    ON ag.ag_login USING gin (lower(address) gin_trgm_ops);
+
+CREATE INDEX ag_kit_supplied_kit_id_trgm_idx
+    ON ag.ag_kit USING gin (lower(supplied_kit_id) gin_trgm_ops);
+CREATE INDEX ag_kit_kit_password_trgm_idx
+    ON ag.ag_kit USING gin (lower(kit_password) gin_trgm_ops);
+CREATE INDEX ag_kit_kit_verification_code_trgm_idx
+    ON ag.ag_kit USING gin (lower(kit_verification_code) gin_trgm_ops);
+CREATE INDEX ag_kit_ag_kit_id_trgm_idx
+    ON ag.ag_kit USING gin ((cast(ag_kit_id AS varchar(100))) gin_trgm_ops);
+
+CREATE INDEX ag_kit_barcodes_barcode_trgm_idx
+    ON ag.ag_kit_barcodes USING gin (barcode gin_trgm_ops);
+CREATE INDEX ag_kit_barcodes_notes_trgm_idx
+    ON ag.ag_kit_barcodes USING gin (lower(notes) gin_trgm_ops);
+
+CREATE INDEX ag_login_surveys_participant_name_trgm_idx
+    ON ag.ag_login_surveys USING gin (lower(participant_name) gin_trgm_ops);
+
+CREATE INDEX ag_handout_barcodes_kit_id_trgm_idx
+    ON ag.ag_handout_barcodes USING gin (kit_id gin_trgm_ops);
+CREATE INDEX ag_handout_barcodes_barcode_trgm_idx
+    ON ag.ag_handout_barcodes USING gin (barcode gin_trgm_ops);
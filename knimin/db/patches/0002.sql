@@ -0,0 +1,50 @@
+-- Inventory of barcodes not yet assigned to any project
+--
+-- Finding unassigned barcodes used to anti-join every barcode against
+-- barcodes.project_barcode. barcodes.unassigned_barcode holds just the
+-- barcodes with no project, so counting and picking them only reads that
+-- (small) table. Triggers keep it in step with barcodes.barcode and
+-- barcodes.project_barcode, whichever application writes to them.
+CREATE TABLE barcodes.unassigned_barcode (
+    barcode varchar PRIMARY KEY
+        REFERENCES barcodes.barcode (barcode) ON DELETE CASCADE);
+
+INSERT INTO barcodes.unassigned_barcode (barcode)
+    SELECT barcode FROM barcodes.barcode b
+    WHERE NOT EXISTS (SELECT 1 FROM barcodes.project_barcode pb
+                      WHERE pb.barcode = b.barcode);
+
+CREATE FUNCTION barcodes.unassigned_barcode_new() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO barcodes.unassigned_barcode (barcode)
+        VALUES (NEW.barcode) ON CONFLICT DO NOTHING;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER unassigned_barcode_new
+    AFTER INSERT ON barcodes.barcode
+    FOR EACH ROW EXECUTE PROCEDURE barcodes.unassigned_barcode_new();
+
+CREATE FUNCTION barcodes.unassigned_barcode_project() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        -- the barcode is free again once its last project is removed
+        INSERT INTO barcodes.unassigned_barcode (barcode)
+            SELECT OLD.barcode
+            WHERE EXISTS (SELECT 1 FROM barcodes.barcode
+                          WHERE barcode = OLD.barcode)
+                AND NOT EXISTS (SELECT 1 FROM barcodes.project_barcode
+                                WHERE barcode = OLD.barcode)
+            ON CONFLICT DO NOTHING;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        DELETE FROM barcodes.unassigned_barcode WHERE barcode = NEW.barcode;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER unassigned_barcode_project
+    AFTER INSERT OR UPDATE OF barcode OR DELETE ON barcodes.project_barcode
+    FOR EACH ROW EXECUTE PROCEDURE barcodes.unassigned_barcode_project();
@@ -0,0 +1,38 @@
+-- Sequence for minting new barcodes
+--
+-- New barcode numbers used to come from max(barcode::integer), which casts
+-- every barcode and lets two concurrent callers pick the same numbers.
+-- barcodes.barcode_seq hands out the numbers instead, starting after the
+-- highest barcode already minted.
+CREATE SEQUENCE barcodes.barcode_seq;
+
+SELECT setval('barcodes.barcode_seq',
+              COALESCE((SELECT max(barcode::integer)
+                        FROM barcodes.barcode), 0) + 1,
+              false);
+
+-- Add new barcodes to the unassigned inventory once per statement rather
+-- than once per row, so minting a large batch runs a single insert.
+-- Transition tables need PostgreSQL 10; older servers keep the row trigger
+DO $do$
+BEGIN
+    IF current_setting('server_version_num')::integer >= 100000 THEN
+        DROP TRIGGER unassigned_barcode_new ON barcodes.barcode;
+
+        CREATE OR REPLACE FUNCTION barcodes.unassigned_barcode_new()
+        RETURNS trigger AS $fn$
+        BEGIN
+            INSERT INTO barcodes.unassigned_barcode (barcode)
+                SELECT barcode FROM new_barcodes ON CONFLICT DO NOTHING;
+            RETURN NULL;
+        END;
+        $fn$ LANGUAGE plpgsql;
+
+        EXECUTE 'CREATE TRIGGER unassigned_barcode_new
+                     AFTER INSERT ON barcodes.barcode
+                     REFERENCING NEW TABLE AS new_barcodes
+                     FOR EACH STATEMENT
+                     EXECUTE PROCEDURE barcodes.unassigned_barcode_new()';
+    END IF;
+END
+$do$;
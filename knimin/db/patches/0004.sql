@@ -0,0 +1,10 @@
+-- Vioscreen sync state
+--
+-- Record the session each survey's status was read from, so a sync can
+-- tell from the user's session list whether anything changed and skip the
+-- users whose latest session is the one already stored.
+ALTER TABLE ag.vioscreen_surveys ADD COLUMN session_id varchar;
+
+-- The time each survey was last pulled, whatever its status.
+-- pulldown_date is only set when a finished survey is pulled.
+ALTER TABLE ag.vioscreen_surveys ADD COLUMN pulled_at timestamp;
@@ -0,0 +1,45 @@
+-- Statement-level unassigned inventory trigger for servers upgraded to
+-- PostgreSQL 10 or later
+--
+-- Patch 0003 only installs the statement-level trigger when it is applied
+-- on PostgreSQL 10 or later, so databases patched on an older server keep
+-- the row-level trigger from patch 0002 after the server is upgraded.
+-- barcodes.install_unassigned_barcode_trigger() switches to the
+-- statement-level trigger when the server supports it and the row-level
+-- one is still installed, and does nothing otherwise. It is run here, and
+-- should be run again after upgrading the server:
+--
+--     SELECT barcodes.install_unassigned_barcode_trigger();
+CREATE FUNCTION barcodes.install_unassigned_barcode_trigger()
+RETURNS boolean AS $do$
+BEGIN
+    IF current_setting('server_version_num')::integer < 100000 OR
+            NOT EXISTS (SELECT 1 FROM pg_trigger
+                        WHERE tgrelid = 'barcodes.barcode'::regclass
+                            AND tgname = 'unassigned_barcode_new'
+                            -- bit 0 of tgtype is set for row triggers
+                            AND tgtype & 1 = 1) THEN
+        RETURN false;
+    END IF;
+
+    DROP TRIGGER unassigned_barcode_new ON barcodes.barcode;
+
+    CREATE OR REPLACE FUNCTION barcodes.unassigned_barcode_new()
+    RETURNS trigger AS $fn$
+    BEGIN
+        INSERT INTO barcodes.unassigned_barcode (barcode)
+            SELECT barcode FROM new_barcodes ON CONFLICT DO NOTHING;
+        RETURN NULL;
+    END;
+    $fn$ LANGUAGE plpgsql;
+
+    EXECUTE 'CREATE TRIGGER unassigned_barcode_new
+                 AFTER INSERT ON barcodes.barcode
+                 REFERENCING NEW TABLE AS new_barcodes
+                 FOR EACH STATEMENT
+                 EXECUTE PROCEDURE barcodes.unassigned_barcode_new()';
+    RETURN true;
+END;
+$do$ LANGUAGE plpgsql;
+
+SELECT barcodes.install_unassigned_barcode_trigger();
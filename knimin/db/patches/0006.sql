@@ -0,0 +1,103 @@
+-- Typeahead change log
+--
+-- Barcodes, kit IDs, handout kit IDs and login emails are created and
+-- changed both by labadmin and american-gut-web. Every insert, change and
+-- removal of one of them is logged with the ID of the transaction making
+-- it, so the typeahead indexes can pick up what was committed since they
+-- last read the log (see KniminAccess.get_typeahead_changes) instead of
+-- reloading everything. A change replaces old_values with new_values.
+CREATE TABLE ag.typeahead_change (
+    change_id bigserial PRIMARY KEY,
+    txid bigint NOT NULL DEFAULT txid_current(),
+    changed timestamp NOT NULL DEFAULT now(),
+    kind varchar NOT NULL,
+    old_values varchar[] NOT NULL DEFAULT '{}',
+    new_values varchar[] NOT NULL DEFAULT '{}');
+
+CREATE INDEX typeahead_change_txid_idx ON ag.typeahead_change (txid);
+
+-- TG_ARGV[0] is the kind of identifier and TG_ARGV[1] the column holding it
+CREATE FUNCTION ag.log_typeahead_change() RETURNS trigger AS $$
+DECLARE
+    old_value varchar;
+    new_value varchar;
+BEGIN
+    IF TG_OP <> 'INSERT' THEN
+        old_value := to_jsonb(OLD) ->> TG_ARGV[1];
+    END IF;
+    IF TG_OP <> 'DELETE' THEN
+        new_value := to_jsonb(NEW) ->> TG_ARGV[1];
+    END IF;
+    IF old_value IS DISTINCT FROM new_value THEN
+        INSERT INTO ag.typeahead_change (kind, old_values, new_values)
+            VALUES (TG_ARGV[0], array_remove(ARRAY[old_value], NULL),
+                    array_remove(ARRAY[new_value], NULL));
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER typeahead_barcode
+    AFTER UPDATE OF barcode OR DELETE ON barcodes.barcode
+    FOR EACH ROW
+    EXECUTE PROCEDURE ag.log_typeahead_change('barcode', 'barcode');
+
+-- New barcodes are minted in bulk, so on PostgreSQL 10 or later each
+-- statement logs them in a single change, from a transition table. Older
+-- servers log them row by row, and should run this again once upgraded:
+--
+--     SELECT ag.install_typeahead_barcode_trigger();
+CREATE FUNCTION ag.install_typeahead_barcode_trigger()
+RETURNS boolean AS $do$
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_trigger
+               WHERE tgrelid = 'barcodes.barcode'::regclass
+                   AND tgname = 'typeahead_new_barcodes'
+                   -- bit 0 of tgtype is set for row triggers
+                   AND tgtype & 1 = 0) THEN
+        RETURN false;
+    END IF;
+    DROP TRIGGER IF EXISTS typeahead_new_barcodes ON barcodes.barcode;
+
+    IF current_setting('server_version_num')::integer < 100000 THEN
+        CREATE TRIGGER typeahead_new_barcodes
+            AFTER INSERT ON barcodes.barcode
+            FOR EACH ROW
+            EXECUTE PROCEDURE ag.log_typeahead_change('barcode', 'barcode');
+        RETURN false;
+    END IF;
+
+    CREATE OR REPLACE FUNCTION ag.log_new_barcodes() RETURNS trigger AS $fn$
+    BEGIN
+        INSERT INTO ag.typeahead_change (kind, new_values)
+            SELECT 'barcode', array_agg(barcode) FROM new_barcodes
+            HAVING count(*) > 0;
+        RETURN NULL;
+    END;
+    $fn$ LANGUAGE plpgsql;
+
+    EXECUTE 'CREATE TRIGGER typeahead_new_barcodes
+                 AFTER INSERT ON barcodes.barcode
+                 REFERENCING NEW TABLE AS new_barcodes
+                 FOR EACH STATEMENT
+                 EXECUTE PROCEDURE ag.log_new_barcodes()';
+    RETURN true;
+END;
+$do$ LANGUAGE plpgsql;
+
+SELECT ag.install_typeahead_barcode_trigger();
+
+CREATE TRIGGER typeahead_kit_id
+    AFTER INSERT OR UPDATE OF supplied_kit_id OR DELETE ON ag.ag_kit
+    FOR EACH ROW
+    EXECUTE PROCEDURE ag.log_typeahead_change('kit_id', 'supplied_kit_id');
+
+CREATE TRIGGER typeahead_handout_kit_id
+    AFTER INSERT OR UPDATE OF kit_id OR DELETE ON ag.ag_handout_kits
+    FOR EACH ROW
+    EXECUTE PROCEDURE ag.log_typeahead_change('handout_kit_id', 'kit_id');
+
+CREATE TRIGGER typeahead_email
+    AFTER INSERT OR UPDATE OF email OR DELETE ON ag.ag_login
+    FOR EACH ROW
+    EXECUTE PROCEDURE ag.log_typeahead_change('email', 'email');
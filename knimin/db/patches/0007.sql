@@ -0,0 +1,7 @@
+-- Keep minted barcodes to 9 digits
+--
+-- Barcodes are compared, ordered and paged through as text, which only
+-- matches their numeric order while they all have 9 digits. Minting fails
+-- once barcodes.barcode_seq runs out of 9 digit numbers rather than
+-- handing out longer barcodes.
+ALTER SEQUENCE barcodes.barcode_seq MAXVALUE 999999999;
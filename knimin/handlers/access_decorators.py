@@ -25,10 +25,9 @@ def set_access(access_levels=['Admin']):  # noqa: C901
                 if self.current_user is None:
                     return
 
-                # verify the user exists
-                # WARNING: this is a list lookup. As the number of users is
-                # anticipated to be small for labadmin, this is probably okay.
-                if self.current_user not in db.get_users():
+                # verify the user exists. Access levels are cached per user,
+                # so this and the check below usually skip the database
+                if db.get_user_access(self.current_user) is None:
                     raise HTTPError(403, 'User %s does not have access level '
                                     '%s' % (self.current_user,
                                             ', '.join(self._access_levels)))
@@ -45,22 +44,23 @@ def set_access(access_levels=['Admin']):  # noqa: C901
                                             ', '.join(self._access_levels)))
 
             # Decorate the get post, put, and delete methods to restrict
-            # access automatically using decorator
+            # access automatically using decorator. The result is returned
+            # so coroutine methods are waited on by tornado
             def get(self):
                 self._has_access()
-                super(DecoratedClass, self).get()
+                return super(DecoratedClass, self).get()
 
             def post(self):
                 self._has_access()
-                super(DecoratedClass, self).post()
+                return super(DecoratedClass, self).post()
 
             def put(self):
                 self._has_access()
-                super(DecoratedClass, self).put()
+                return super(DecoratedClass, self).put()
 
             def delete(self):
                 self._has_access()
-                super(DecoratedClass, self).delete()
+                return super(DecoratedClass, self).delete()
 
         return DecoratedClass
     return class_modifier
@@ -10,7 +10,7 @@ class AGAddBarcodeKitHandler(BaseHandler):
     @authenticated
     def get(self):
         self.render("ag_add_barcode_kit.html", currentuser=self.current_user,
-                    kit_ids=db.get_used_kit_ids(), skid='', barcodes='')
+                    skid='', barcodes='')
 
     @authenticated
     def post(self):
@@ -21,5 +21,4 @@ class AGAddBarcodeKitHandler(BaseHandler):
         barcodes = db.add_barcodes_to_kit(ag_kit_id, num_barcodes)
 
         self.render("ag_add_barcode_kit.html", currentuser=self.current_user,
-                    kit_ids=db.get_used_kit_ids(), skid=supplied_kit_id,
-                    barcodes=', '.join(barcodes))
+                    skid=supplied_kit_id, barcodes=', '.join(barcodes))
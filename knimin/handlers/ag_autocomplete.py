@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+from tornado.web import authenticated, HTTPError
+from tornado.escape import json_encode
+from knimin.handlers.base import BaseHandler
+from knimin.handlers.access_decorators import set_access
+
+from knimin import db, typeahead
+
+# kinds users with only the 'AG kits' access level can complete. Barcodes
+# and participant emails, or every kind at once, need 'Search'
+KIT_KINDS = {'kit_id', 'handout_kit_id'}
+MAX_LIMIT = 100
+
+
+@set_access(['Search', 'AG kits'])
+class AGAutocompleteHandler(BaseHandler):
+    @authenticated
+    def get(self):
+        term = self.get_argument('term')
+        kinds = self.get_arguments('kind') or None
+        if (kinds is None or not KIT_KINDS.issuperset(kinds)) and \
+                not db.has_access(self.current_user, ['Search']):
+            raise HTTPError(403, 'Search access needed for %s' %
+                            (', '.join(kinds) if kinds else 'all kinds'))
+        try:
+            limit = int(self.get_argument('limit', 20))
+            if limit < 1:
+                raise ValueError('limit must be positive')
+            matches = typeahead.search(term, kinds, min(limit, MAX_LIMIT))
+        except ValueError as e:
+            raise HTTPError(400, str(e))
+        # jQuery UI autocomplete expects a bare list
+        self.set_header('Content-Type', 'application/json')
+        self.write(json_encode(matches))
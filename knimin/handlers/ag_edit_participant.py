@@ -3,7 +3,7 @@ from tornado.web import authenticated
 from knimin.handlers.base import BaseHandler
 from knimin.handlers.access_decorators import set_access
 
-from knimin import db
+from knimin import db, typeahead
 
 
 @set_access(['Search'])
@@ -30,8 +30,12 @@ class AGEditParticipantHandler(BaseHandler):
         country = self.get_argument('country')
         ag_login_id = self.get_argument('ag_login_id')
         try:
+            old_emails = [login['email']
+                          for login in db.get_login_info(ag_login_id)]
             db.updateAGLogin(ag_login_id, email, name, address,
                              city, state, zipcode, country)
+            # stored stripped and lowercased
+            typeahead.replace('email', old_emails, [email.strip().lower()])
             self.render("ag_edit_participant.html", response='Good',
                         login=None,
                         currentuser=self.current_user)
@@ -1,27 +1,55 @@
 #!/usr/bin/env python
 from tornado.web import authenticated, HTTPError
+from tornado import gen, concurrent
 from tornado.escape import url_unescape
 from knimin.handlers.base import BaseHandler
 from knimin.handlers.access_decorators import set_access
 
-from knimin.lib.squash_barcodes import build_barcodes_pdf
+from knimin.lib.squash_barcodes import write_barcodes_pdf, barcodes_pdf_key
 from knimin import db
 
 
 @set_access(['Barcodes'])
 class AGBarcodePrintoutHandler(BaseHandler):
+    # sheets are rendered on these threads (and the application's worker
+    # processes) so the IOLoop keeps serving other requests meanwhile
+    executor = concurrent.futures.ThreadPoolExecutor(2)
+    # bytes sent to the client at a time
+    chunk_size = 65536
+
+    @concurrent.run_on_executor
+    def _render_pdf(self, barcodes, key):
+        pool = self.application.process_pool
+        with self.application.barcode_pdfs.writer(key) as f:
+            # without the application's pool the pages are rendered on
+            # this thread, as forking from a thread can deadlock
+            write_barcodes_pdf(barcodes, f.write,
+                               processes=None if pool else 1, pool=pool)
+            f.flush()
+            # opened before it is moved into the cache, so it can be sent
+            # even if it is evicted straight away
+            pdf = open(f.name, 'rb')
+        return pdf
+
     @authenticated
+    @gen.coroutine
     def post(self):
         barcodes = self.get_argument('barcodes').split(",")
-        pdf = build_barcodes_pdf(barcodes)
         self.add_header('Content-type', 'application/pdf')
         self.add_header('Content-Transfer-Encoding', 'binary')
         self.add_header('Accept-Ranges', 'bytes')
         self.add_header('Content-Encoding', 'none')
         self.add_header('Content-Disposition',
                         'attachment; filename=barcodes.pdf')
-        self.write(pdf)
-        self.flush()
+        key = barcodes_pdf_key(barcodes)
+        # a reprint sends the PDF from the last time
+        pdf = self.application.barcode_pdfs.open(key)
+        if pdf is None:
+            pdf = yield self._render_pdf(barcodes, key)
+        with pdf:
+            for chunk in iter(lambda: pdf.read(self.chunk_size), ''):
+                self.write(chunk)
+                yield self.flush()
         self.finish()
 
 
@@ -48,7 +76,7 @@ class AGNewBarcodeHandler(BaseHandler):
     @authenticated
     def get(self):
         project_names = db.getProjectNames()
-        remaining = len(db.get_unassigned_barcodes())
+        remaining = db.count_unassigned_barcodes()
         self.render("ag_new_barcode.html", currentuser=self.current_user,
                     projects=project_names, barcodes=[], remaining=remaining,
                     msg="", newbc=[], assignedbc=[], assign_projects="")
@@ -88,7 +116,7 @@ class AGNewBarcodeHandler(BaseHandler):
             raise HTTPError(400, 'Unknown action: %s' % action)
 
         project_names = db.getProjectNames()
-        remaining = len(db.get_unassigned_barcodes())
+        remaining = db.count_unassigned_barcodes()
         self.render("ag_new_barcode.html", currentuser=self.current_user,
                     projects=project_names, remaining=remaining,
                     msg=msg, newbc=newbc, assignedbc=assignedbc,
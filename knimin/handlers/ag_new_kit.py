@@ -1,48 +1,160 @@
-from json import loads
+from time import time
+from uuid import uuid4
+
 from tornado.web import authenticated, HTTPError
+from tornado import gen, concurrent
 from tornado.escape import url_unescape
 from knimin.handlers.base import BaseHandler
 from knimin.handlers.access_decorators import set_access
-from knimin import db
-from knimin.lib.mem_zip import InMemoryZip
-from knimin.lib.util import get_printout_data
+from knimin import db, typeahead
+from knimin.lib.mem_zip import StreamingZip
+from knimin.lib.util import iter_printout_data, hash_passwords
+
+
+class KitBatchStore(object):
+    """Newly created kits, kept on the server until they are downloaded
+
+    Parameters
+    ----------
+    max_age : int, optional
+        Seconds a batch is kept after it is created. Default 3600
+
+    Notes
+    -----
+    Batches hold the plain text kit passwords, so they are only kept in
+    memory, only given back to the user who created them and dropped after
+    max_age.
+    """
+    def __init__(self, max_age=3600):
+        self.max_age = max_age
+        self._batches = {}
+
+    def _expire(self):
+        oldest = time() - self.max_age
+        for batch_id, batch in self._batches.items():
+            if batch[0] < oldest:
+                del self._batches[batch_id]
+
+    def add(self, user, kits):
+        """Stores a batch of kits
+
+        Parameters
+        ----------
+        user : str
+            The user who created the kits
+        kits : list of namedtuple
+            The kits, as returned by KniminAccess.create_ag_kits
+
+        Returns
+        -------
+        str
+            ID to fetch the batch with
+        """
+        self._expire()
+        batch_id = uuid4().hex
+        self._batches[batch_id] = (time(), user, kits)
+        return batch_id
+
+    def get(self, user, batch_id):
+        """Returns a batch of kits
+
+        Parameters
+        ----------
+        user : str
+            The user asking for the batch
+        batch_id : str
+            ID of the batch, as returned by add
+
+        Returns
+        -------
+        list of namedtuple or None
+            The kits, or None if the batch does not exist, has expired or
+            was created by another user
+        """
+        self._expire()
+        batch = self._batches.get(batch_id)
+        if batch is None or batch[1] != user:
+            return None
+        return batch[2]
+
+
+def _table_rows(kits):
+    yield '\t'.join(kits[0]._fields)
+    for kit in kits:
+        yield '\n' + '\t'.join(map(str, kit))
 
 
 @set_access(['AG kits'])
 class AGNewKitDLHandler(BaseHandler):
+    # bytes held before they are flushed to the client
+    flush_size = 65536
+
+    def _buffer(self, chunk):
+        self._pending.append(chunk)
+        self._buffered += len(chunk)
+
+    @gen.coroutine
+    def _send(self):
+        self.write(''.join(self._pending))
+        self._pending = []
+        self._buffered = 0
+        yield self.flush()
+
     @authenticated
+    @gen.coroutine
     def post(self):
-        kitinfo = loads(self.get_argument('kitinfo'))
-        fields = self.get_argument('fields').split(',')
-        table = ['\t'.join(fields)]
-        table.extend(['\t'.join(map(str, kit)) for kit in kitinfo])
-        kit_zip = InMemoryZip()
-        kit_zip.append('kit_printouts.txt', get_printout_data(kitinfo)).append(
-            'kit_table.txt', '\n'.join(table))
-        # write out zip file
+        batch_id = self.get_argument('batch')
+        kits = self.application.kit_batches.get(self.current_user, batch_id)
+        if kits is None:
+            raise HTTPError(404, 'Unknown kit batch: %s' % batch_id)
+
         self.add_header('Content-type', 'application/octet-stream')
         self.add_header('Content-Transfer-Encoding', 'binary')
         self.add_header('Accept-Ranges', 'bytes')
         self.add_header('Content-Encoding', 'none')
         self.add_header('Content-Disposition',
                         'attachment; filename=kitinfo.zip')
-        self.write(kit_zip.write_to_buffer())
-        self.flush()
+        # the zip is sent while the printout and table are produced, waiting
+        # for each flush so no more than flush_size is held at a time
+        self._pending = []
+        self._buffered = 0
+        kit_zip = StreamingZip(self._buffer)
+        for name, chunks in (('kit_printouts.txt', iter_printout_data(kits)),
+                             ('kit_table.txt', _table_rows(kits))):
+            for _ in kit_zip.write_file(name, chunks):
+                if self._buffered >= self.flush_size:
+                    yield self._send()
+        kit_zip.close()
+        yield self._send()
         self.finish()
 
 
 @set_access(['AG kits'])
 class AGNewKitHandler(BaseHandler):
+    # bcrypt is slow on purpose, so kit passwords are hashed on these
+    # threads (and the application's worker processes) instead of the
+    # IOLoop. The database work stays on the IOLoop, which owns the
+    # connection
+    executor = concurrent.futures.ThreadPoolExecutor(2)
+
+    @concurrent.run_on_executor
+    def _hash_passwords(self, passwords):
+        pool = self.application.process_pool
+        # without the application's pool the passwords are hashed on this
+        # thread, as forking from a thread can deadlock. bcrypt releases
+        # the GIL while hashing
+        return hash_passwords(passwords, None if pool else 1, pool)
+
     @authenticated
     def get(self):
         project_names = db.getProjectNames()
-        remaining = len(db.get_unassigned_barcodes())
+        remaining = db.count_unassigned_barcodes()
 
         self.render("ag_new_kit.html", projects=project_names,
-                    currentuser=self.current_user, msg="", kitinfo=[],
-                    fields="", remaining=remaining)
+                    currentuser=self.current_user, msg="", remaining=remaining)
 
     @authenticated
+    @gen.coroutine
     def post(self):
         tag = self.get_argument("tag")
         if not tag:
@@ -51,12 +163,14 @@ class AGNewKitHandler(BaseHandler):
                     for p in self.get_arguments("projects")]
         num_swabs = map(int, self.get_arguments("swabs"))
         num_kits = map(int, self.get_arguments("kits"))
-        kits = []
-        fields = ""
         try:
-            kits = db.create_ag_kits(zip(num_swabs, num_kits), tag, projects)
-            fields = ','.join(kits[0]._fields)
+            kit_info = db.make_ag_kits(zip(num_swabs, num_kits))
+            hashed = yield self._hash_passwords([k[0] for k in kit_info])
+            kits = db.insert_ag_kits(kit_info, hashed, tag, projects)
+            typeahead.add('handout_kit_id', [k.kit_id for k in kits])
         except Exception as e:
             raise HTTPError(500, "ERROR: %s" % e.message.encode('utf-8'))
 
-        self.write({'kitinfo': kits, 'fields': fields})
+        batch_id = self.application.kit_batches.add(self.current_user, kits)
+        self.write({'batch': batch_id, 'kits': len(kits),
+                    'barcodes': sum(len(k.barcodes) for k in kits)})
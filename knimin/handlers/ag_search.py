@@ -1,9 +1,13 @@
 #!/usr/bin/env python
-from tornado.web import authenticated
+from tornado.web import authenticated, HTTPError
 from knimin.handlers.base import BaseHandler
 from knimin.handlers.access_decorators import set_access
 
 from knimin import db
+from knimin.lib.configuration import config
+
+# Cursor value for a result section with no further pages
+END = 'end'
 
 
 @set_access(['Search'])
@@ -16,49 +20,50 @@ class AGSearchHandler(BaseHandler):
     @authenticated
     def post(self):
         term = self.get_argument('search_term')
-        results = {}
-        # search participant info
-        logins = db.search_participant_info(term)
-        results = set(logins)
-        # search kit info and add to resluts
-        logins = db.search_kits(term)
-        results = results | set(logins)
-        #  search barcode and add to results
-        logins = db.search_barcodes(term)
-        results = results | set(logins)
-        # search handout kits
-        handouts = db.search_handout_kits(term)
+        # keyset cursors for the page requested, absent on the first page
+        after = self.get_argument('after', None)
+        handout_after = self.get_argument('handout_after', None)
+        page_size = config.search_page_size
+
+        results = []
+        next_after = END
+        if after != END:
+            # Each search returns its first page_size + 1 matches past the
+            # cursor, so the first page_size of their union is the page and
+            # any extra login means there is a next one
+            logins = set()
+            for search in (db.search_participant_info, db.search_kits,
+                           db.search_barcodes):
+                logins.update(search(term, after, page_size + 1))
+            logins = sorted(logins)
+            if len(logins) > page_size:
+                logins = logins[:page_size]
+                next_after = logins[-1]
+            # now take the ag_login_ids and collect the information to display
+            results = db.search_bundle(logins)
 
-        # now take the ag_login_ids and collect the information to display
-        display_results = []  # list of dictionatries
-        for login in results:
-            login_display = {}
-            login_display['login_info'] = db.get_login_info(login)
-            login_display['humans'] = db.getHumanParticipants(
-                login)
-            login_display['animals'] = db.getAnimalParticipants(
-                login)
-            login_display['kit'] = db.get_kit_info_by_login(login)
-            for kit in login_display['kit']:
-                barcode_info = {}
-                ag_barcodes = db.get_barcode_info_by_kit_id(
-                    kit['ag_kit_id'])
-                barcode_info = {}
-                for ag_barcode in ag_barcodes:
-                    barcode_info[ag_barcode['barcode']] = {}
-                    barcode_info[ag_barcode['barcode']]['ag_info'] = ag_barcode
-                    lab_barcode_info = db.get_barcode_details(
-                        ag_barcode['barcode'])
-                    plate = db.get_plate_for_barcode(
-                        ag_barcode['barcode'])
-                    barcode_info[ag_barcode['barcode']]['barcode_info'] = \
-                        lab_barcode_info
-                    barcode_info[ag_barcode['barcode']]['plate'] = plate
-                kit['barcode_info'] = barcode_info
-            display_results.append(login_display)
+        handouts = []
+        next_handout_after = END
+        if handout_after != END:
+            if handout_after is not None:
+                # kit_id:barcode of the last handout on the previous page
+                handout_after = handout_after.rsplit(':', 1)
+                if len(handout_after) != 2:
+                    raise HTTPError(400, 'Invalid handout_after cursor')
+            handouts = db.search_handout_kits(term, handout_after,
+                                              page_size + 1)
+            if len(handouts) > page_size:
+                handouts = handouts[:page_size]
+                next_handout_after = '%s:%s' % (handouts[-1]['kit_id'],
+                                                handouts[-1]['barcode'])
 
         # now render the page
         self.render("ag_search.html",
-                    results=display_results,
+                    results=results,
                     handouts=handouts,
-                    currentuser=self.current_user)
+                    currentuser=self.current_user,
+                    search_term=term,
+                    estimates=db.estimate_search_counts(term),
+                    next_after=next_after,
+                    next_handout_after=next_handout_after,
+                    end=END)
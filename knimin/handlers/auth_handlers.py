@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 from tornado.escape import json_encode
+from tornado import gen, concurrent
 
 from knimin import db
 from knimin.lib.data_access import IncorrectEmailError, IncorrectPasswordError
@@ -16,9 +17,18 @@ from knimin.handlers.access_decorators import set_access
 @set_access(['Base'])
 class AuthLoginHandler(BaseHandler):
     """user login, no page necessary"""
+    # bcrypt is slow on purpose, so passwords are checked on these threads
+    # instead of the IOLoop. bcrypt releases the GIL while hashing
+    executor = concurrent.futures.ThreadPoolExecutor(4)
+
+    @concurrent.run_on_executor
+    def _check_password(self, password, hashed):
+        return db.check_password(password, hashed)
+
     def get(self):
         self.redirect("/")
 
+    @gen.coroutine
     def post(self):
         email = self.get_argument("email", "").strip().lower()
         password = self.get_argument("password", "")
@@ -27,7 +37,8 @@ class AuthLoginHandler(BaseHandler):
 
         success = False
         try:
-            success = db.authenticate_user(email, password)
+            hashed = db.get_password_hash(email)
+            success = yield self._check_password(password, hashed)
         except IncorrectEmailError:
             msg = "Unknown user"
         except IncorrectPasswordError:
@@ -1,16 +1,76 @@
 #!/usr/bin/env python
+from time import time
+
 from tornado.web import authenticated
+from tornado import gen, concurrent
+from tornado.ioloop import IOLoop
 from knimin.handlers.base import BaseHandler
 from knimin.handlers.access_decorators import set_access
-from knimin import db
+from knimin.lib.configuration import config
+from knimin.lib.data_access import KniminAccess
+
+# The summary is counted on this thread with its own connection, so the
+# IOLoop's connection is never used from two threads at once
+_summary_executor = concurrent.futures.ThreadPoolExecutor(1)
+_summary_db = []
+
+
+def _count_projects():
+    if not _summary_db:
+        _summary_db.append(KniminAccess(config))
+    return _summary_db[0].get_project_summary(breakdown=True)
+
+
+class ProjectSummaryCache(object):
+    """Project barcode counts, recounted in the background when stale
+
+    Parameters
+    ----------
+    max_age : int, optional
+        Seconds after which a request triggers a background recount.
+        Default 300
+
+    Notes
+    -----
+    Only the first request waits for the counts. Later requests get the
+    cached summary straight away, and if it is older than max_age a single
+    recount is started for the requests that follow.
+    """
+    def __init__(self, max_age=300):
+        self.max_age = max_age
+        self.summary = None
+        self.updated = None
+        self._counting = None
+
+    @gen.coroutine
+    def refresh(self):
+        """Recounts the summary, sharing a recount already under way"""
+        if self._counting is None:
+            self._counting = _summary_executor.submit(_count_projects)
+        counting = self._counting
+        try:
+            summary = yield counting
+        finally:
+            if self._counting is counting:
+                self._counting = None
+        self.summary = summary
+        self.updated = time()
+
+    @gen.coroutine
+    def get(self):
+        """Returns the summary, as from KniminAccess.get_project_summary"""
+        if self.summary is None:
+            yield self.refresh()
+        elif self._counting is None and \
+                time() - self.updated >= self.max_age:
+            IOLoop.current().spawn_callback(self.refresh)
+        raise gen.Return(self.summary)
 
 
 @set_access(['Base'])
 class ProjectsSummaryHandler(BaseHandler):
     @authenticated
+    @gen.coroutine
     def get(self):
-        projects = db.getProjectNames()
-        # escape unicode project names for xhtml rendering
-        info = [(p, len(db.get_barcodes_for_projects([p])))
-                for p in projects]
-        self.render('projects_summary.html', proj_counts=info)
+        summary = yield self.application.projects_summary.get()
+        self.render('projects_summary.html', summary=summary)
@@ -185,44 +185,92 @@ def code128_format(data):
     return codes
 
 
+def code128_widths(text, thickness=3):
+    """
+    Widths of the alternating bars and spaces of a barcode, starting with
+    a bar
+    """
+    return [int(weight) * thickness
+            for code in code128_format(text) for weight in WEIGHTS[code]]
+
+
+# Caches of the bit pattern of each code value and of the loaded fonts
+_STRIPS = {}
+_FONTS = {}
+
+
+def _code_strip(code, thickness):
+    """
+    Bits of a code value's bars (0, black) and spaces (1, white), and
+    their width in pixels
+    """
+    key = (code, thickness)
+    strip = _STRIPS.get(key)
+    if strip is None:
+        bits = width = 0
+        draw_bar = True
+        for weight in WEIGHTS[code]:
+            w = int(weight) * thickness
+            bits <<= w
+            if not draw_bar:
+                bits |= (1 << w) - 1
+            width += w
+            draw_bar = not draw_bar
+        strip = _STRIPS[key] = (bits, width)
+    return strip
+
+
+def _load_font(font):
+    loaded = _FONTS.get(font)
+    if loaded is None:
+        if font is None:
+            loaded = ImageFont.load_default()
+        else:
+            loaded = ImageFont.truetype(font, 20)
+        _FONTS[font] = loaded
+    return loaded
+
+
 def code128_image(text, height=100, width=None, thickness=3, quiet_zone=True,
                   font=None, show_text=False):
-    data = code128_format(text)
     barcode_height = height - 25 if show_text else height
-    barcode_widths = []
-    for code in data:
-        for weight in WEIGHTS[code]:
-            barcode_widths.append(int(weight) * thickness)
-    barcode_width = sum(barcode_widths)
+    # one row of the barcode as bits, left to right
+    bits = bars_width = 0
+    for code in code128_format(text):
+        strip, strip_width = _code_strip(code, thickness)
+        bits = (bits << strip_width) | strip
+        bars_width += strip_width
+    barcode_width = bars_width
     x = 0
 
     if quiet_zone:
         barcode_width += 20 * thickness
         x = 10 * thickness
 
-    if width is not None:
-        if barcode_width > width:
-            tmp = "Calculated width %d smaller than provided width %d"
-            raise ValueError(tmp % (barcode_width, width))
-        else:
-            x = (width - barcode_width) / 2
-
-    # Monochrome Image
-    img = Image.new('1', (width, height), 1)
-    draw = ImageDraw.Draw(img)
-    draw_bar = True
-    for w in barcode_widths:
-        if draw_bar:
-            draw.rectangle(((x, 0), (x + w - 1, barcode_height)), fill=0)
-        draw_bar = not draw_bar
-        x += w
+    if width is None:
+        width = barcode_width
+    elif barcode_width > width:
+        tmp = "Calculated width %d smaller than provided width %d"
+        raise ValueError(tmp % (barcode_width, width))
+    else:
+        x = (width - barcode_width) / 2
+
+    # Monochrome Image, built from packed rows of white (1) and black (0)
+    # bits padded to whole bytes. The bar row is copied down the barcode
+    row_width = (width + 7) // 8 * 8
+    right = row_width - x - bars_width
+    row = ((((1 << x) - 1) << bars_width | bits) << right) | (1 << right) - 1
+    row = ('%0*x' % (row_width // 4, row)).decode('hex')
+    bar_rows = min(max(barcode_height, 0) + 1, height)
+    white = '\xff' * (row_width // 8)
+    img = Image.frombytes('1', (width, height),
+                          row * bar_rows + white * (height - bar_rows))
+    x += bars_width
 
     if show_text:
         # Add barcode text beneith the barcode
-        if font is None:
-            font = ImageFont.load_default()
-        else:
-            font = ImageFont.truetype(font, 20)
+        draw = ImageDraw.Draw(img)
+        font = _load_font(font)
         text_width = font.getsize(text)[0]
         draw.text((x / 2 - (text_width / 2), height - 25), text, font=font)
 
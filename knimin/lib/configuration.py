@@ -34,6 +34,19 @@ class KniminConfig(object):
         The host where the database lives
     port : int
         The port used to connect to the postgres database in the previous host
+    search_page_size : int
+        Number of logins (and handout kit barcodes) shown per AG search page
+    barcode_pdf_cache_mb : int
+        Megabytes of barcode sheet PDFs kept in base_data_dir for reprints
+    vioscreen_url : str
+        Address of the Vioscreen API
+    vioscreen_concurrency : int
+        Most requests made to a Vioscreen host at once
+    vioscreen_rate_limit : float
+        Most requests a second made to a Vioscreen host, 0 for no limit
+    vioscreen_raw_payloads : bool
+        Whether Vioscreen session data is stored as received and split into
+        rows by postgres, instead of being decoded in python
 
     Notes
     -----
@@ -72,6 +85,13 @@ class KniminConfig(object):
         self.base_data_dir = config.get('main', 'base_data_dir')
         self.base_log_dir = config.get('main', 'BASE_LOG_DIR')
         self.attempt_geocode = config.getboolean('main', 'ATTEMPT_GEOCODE')
+        self.search_page_size = 50
+        if config.has_option('main', 'SEARCH_PAGE_SIZE'):
+            self.search_page_size = config.getint('main', 'SEARCH_PAGE_SIZE')
+        self.barcode_pdf_cache_mb = 500
+        if config.has_option('main', 'BARCODE_PDF_CACHE_MB'):
+            self.barcode_pdf_cache_mb = config.getint('main',
+                                                      'BARCODE_PDF_CACHE_MB')
 
     def _get_postgres(self, config):
         """Get the configuration of the postgres section"""
@@ -101,6 +121,21 @@ class KniminConfig(object):
         self.vioscreen_regcode = os.environ.get('VIOSCREEN_REGISTRATION',
                                                 config.get('vioscreen',
                                                            'registration'))
+        self.vioscreen_url = 'https://api.viocare.com'
+        if config.has_option('vioscreen', 'URL'):
+            self.vioscreen_url = config.get('vioscreen', 'URL')
+        self.vioscreen_concurrency = 4
+        if config.has_option('vioscreen', 'CONCURRENCY'):
+            self.vioscreen_concurrency = config.getint('vioscreen',
+                                                       'CONCURRENCY')
+        self.vioscreen_rate_limit = 10.0
+        if config.has_option('vioscreen', 'RATE_LIMIT'):
+            self.vioscreen_rate_limit = config.getfloat('vioscreen',
+                                                        'RATE_LIMIT')
+        self.vioscreen_raw_payloads = True
+        if config.has_option('vioscreen', 'RAW_PAYLOADS'):
+            self.vioscreen_raw_payloads = config.getboolean('vioscreen',
+                                                            'RAW_PAYLOADS')
 
     def _get_qiita(self, config):
         self.qiita_host = config.get('qiita', 'QIITA_HOST')
@@ -11,16 +11,15 @@ from requests.exceptions import SSLError
 import json
 import re
 
-from bcrypt import hashpw, gensalt
 from future.utils import viewitems
 
 from psycopg2 import connect, Error as PostgresError
 from psycopg2.extras import DictCursor
 
 from mail import send_email
-from util import (make_valid_kit_ids, make_verification_code, make_passwd,
+from util import (make_kit_ids, make_verification_code, make_passwd,
                   categorize_age, categorize_etoh, categorize_bmi, correct_age,
-                  fetch_url, correct_bmi)
+                  fetch_url, correct_bmi, hash_password, hash_passwords)
 from tornado.escape import xhtml_escape
 from constants import (md_lookup, month_int_lookup, month_str_lookup,
                        regions_by_state, blanks_values, season_lookup,
@@ -63,6 +62,33 @@ class SQLHandler(object):
         with self._connection.cursor(cursor_factory=DictCursor) as cur:
             yield cur
 
+    @contextmanager
+    def transaction(self):
+        """ Runs several statements in a single transaction
+
+        Returns
+        -------
+        pgcursor : psycopg2.cursor
+            Cursor to run the statements with. The transaction is committed
+            when the block ends and rolled back if it raises
+
+        Raises
+        ------
+        ValueError
+            If there is some error executing one of the statements
+        """
+        with self.cursor() as cur:
+            try:
+                yield cur
+                self._connection.commit()
+            except PostgresError as e:
+                self._connection.rollback()
+                raise ValueError("\nError running SQL transaction: %s"
+                                 % str(e).decode('utf-8'))
+            except:  # noqa
+                self._connection.rollback()
+                raise
+
     def _check_sql_args(self, sql_args):
         """ Checks that sql_args have the correct type
 
@@ -295,10 +321,17 @@ class KniminAccess(object):
                      'Sole of shoe',
                      'Water']
 
+    # seconds a user's cached access levels are trusted before re-reading
+    # them, so changes made by another labadmin process are picked up
+    access_cache_ttl = 60
+
     def __init__(self, config):
         self._con = SQLHandler(config)
         self._con.execute('set search_path to ag, barcodes, public')
         self.config = config
+        # {email: (time cached, frozenset of access names or None)}
+        self._access_cache = {}
+        self._access_names = None
 
     def _get_col_names_from_cursor(self, cur):
         if cur.description:
@@ -306,6 +339,42 @@ class KniminAccess(object):
         else:
             return []
 
+    def get_user_access(self, email):
+        """Returns the access levels of a user, cached for a short time
+
+        Parameters
+        ----------
+        email : str
+            Email of user to check
+
+        Returns
+        -------
+        frozenset of str or None
+            Names of the user's access levels, or None if the user does not
+            exist
+
+        Notes
+        -----
+        Levels are cached per user for access_cache_ttl seconds.
+        alter_access_levels clears the cached entry of the user it changes.
+        """
+        now = datetime.now()
+        cached = self._access_cache.get(email)
+        if cached is not None and \
+                now - cached[0] < timedelta(seconds=self.access_cache_ttl):
+            return cached[1]
+
+        sql = """SELECT access_name
+                 FROM ag.labadmin_users
+                 LEFT JOIN ag.labadmin_users_access USING (email)
+                 LEFT JOIN ag.labadmin_access USING (access_id)
+                 WHERE email = %s"""
+        rows = self._con.execute_fetchall(sql, [email])
+        levels = frozenset(r[0] for r in rows if r[0] is not None) \
+            if rows else None
+        self._access_cache[email] = (now, levels)
+        return levels
+
     def has_access(self, email, access_levels):
         """Whether user has access level given or not.
 
@@ -324,25 +393,26 @@ class KniminAccess(object):
         Notes
         -----
         For uses with Admin acces, this will always return true.
+        Uses the cached levels from get_user_access, so this usually does not
+        touch the database.
 
         Raises
         ------
         ValueError
             Unknown access level passed
         """
-        # Make sure all access levels passed exist
-        sql = "Select 1 from ag.labadmin_access WHERE access_name = %s"
+        # Make sure all access levels passed exist. The levels themselves
+        # only change with a schema patch, so they are read once
+        if self._access_names is None:
+            self._access_names = {x[1] for x in self.get_access_levels()}
         for level in access_levels:
-            if self._con.execute_fetchone(sql, [level]) is None:
+            if level not in self._access_names:
                 raise ValueError('Unknown access level %s' % level)
 
-        sql = """SELECT EXISTS(
-                    SELECT 1
-                    FROM ag.labadmin_users_access
-                    JOIN ag.labadmin_access USING (access_id)
-                    WHERE email = %s AND access_name IN %s)"""
-        access = tuple(access_levels + ['Admin'])
-        return self._con.execute_fetchone(sql, [email, access])[0]
+        levels = self.get_user_access(email)
+        if not levels:
+            return False
+        return 'Admin' in levels or not levels.isdisjoint(access_levels)
 
     def get_users(self):
         """Get a list of users in the system
@@ -429,6 +499,7 @@ class KniminAccess(object):
             sql = """INSERT INTO ag.labadmin_users_access (email, access_id)
                      VALUES (%s, %s)"""
             self._con.executemany(sql, [(email, l) for l in add])
+        self._access_cache.pop(email, None)
 
     def get_ag_barcode_details(self, barcodes):
         """Retrieve sample, kit, and login details by barcode
@@ -1335,40 +1406,63 @@ class KniminAccess(object):
         part of the hashed password. Don't need to actually store the salt
         because of this.
         """
-        # all the encode/decode as a python 3 workaround for bcrypt
-        if hashedpw is None:
-            hashedpw = gensalt()
-        else:
-            hashedpw = hashedpw.encode('utf-8')
-        password = password.encode('utf-8')
-        output = hashpw(password, hashedpw)
-        if isinstance(output, bytes):
-            output = output.decode("utf-8")
-        return output
+        return hash_password(password, hashedpw)
 
-    def authenticate_user(self, email, password):
-        # see if user exists
-        sql = """SELECT EXISTS (SELECT email FROM ag.labadmin_users
-                 WHERE email = %s)"""
-        exists = self._con.execute_fetchone(sql, [email])[0]
+    def get_password_hash(self, email):
+        """Returns the stored bcrypt hash of a labadmin user's password
 
-        if not exists:
-            raise IncorrectEmailError("Email not valid: %s" % email)
+        Parameters
+        ----------
+        email : str
+            Email of the user
 
-        # pull password out of database
-        sql = "SELECT password FROM ag.labadmin_users WHERE email = %s"
+        Returns
+        -------
+        str
+            The hashed password
 
-        # verify password
+        Raises
+        ------
+        IncorrectEmailError
+            The user does not exist
+        """
+        sql = "SELECT password FROM ag.labadmin_users WHERE email = %s"
         dbpass = self._con.execute_fetchone(sql, [email])
-        dbpass = dbpass[0] if dbpass else ''
-        hashed = self._hash_password(password, dbpass)
+        if dbpass is None:
+            raise IncorrectEmailError("Email not valid: %s" % email)
+        return dbpass[0] or ''
+
+    def check_password(self, password, hashed):
+        """Verifies a password against its stored hash
+
+        Parameters
+        ----------
+        password : str
+            Plaintext password
+        hashed : str
+            Hash from get_password_hash
+
+        Returns
+        -------
+        bool
+            True if the password matches
+
+        Raises
+        ------
+        IncorrectPasswordError
+            The password does not match
 
-        if hashed == dbpass:
+        Notes
+        -----
+        bcrypt is deliberately slow. This does not touch the database, so it
+        can be run off the IOLoop thread.
+        """
+        if self._hash_password(password, hashed) == hashed:
             return True
-        else:
-            raise IncorrectPasswordError("Password not valid!")
+        raise IncorrectPasswordError("Password not valid!")
 
-        return False
+    def authenticate_user(self, email, password):
+        return self.check_password(password, self.get_password_hash(email))
 
     def get_unconsented(self):
         """Returns unconsented barcode and person's email
@@ -1470,30 +1564,24 @@ class KniminAccess(object):
         barcodes : list of str
             Barcodes attached to the kit
         """
-        barcodes = self.get_unassigned_barcodes(num_barcodes)
         # assign barcodes to projects for the kit
         sql = """SELECT DISTINCT project_id FROM barcodes.project_barcode
                  JOIN ag.ag_kit_barcodes USING (barcode)
                  WHERE ag_kit_id = %s"""
         proj_ids = [x[0] for x in self._con.execute_fetchall(sql, [ag_kit_id])]
-        barcode_project_insert = """INSERT INTO project_barcode
-                                    (barcode, project_id)
-                                    VALUES (%s, %s)"""
-        project_inserts = []
-        for barcode in barcodes:
-            for project in proj_ids:
-                project_inserts.append((barcode, project))
-        self._con.executemany(barcode_project_insert, project_inserts)
-
-        # Add barcodes to the kit
-        sql = """INSERT  INTO ag_kit_barcodes
-                (ag_kit_id, barcode, sample_barcode_file)
-                VALUES (%s, %s, %s || '.jpg')"""
-        barcode_info = [[ag_kit_id, b, b] for b in barcodes]
-        self._con.executemany(sql, barcode_info)
+
+        with self._con.transaction() as cur:
+            barcodes = self._claim_barcodes(cur, num_barcodes, proj_ids)
+            # Add barcodes to the kit
+            sql = """INSERT  INTO ag_kit_barcodes
+                    (ag_kit_id, barcode, sample_barcode_file)
+                    VALUES (%s, %s, %s || '.jpg')"""
+            barcode_info = [[ag_kit_id, b, b] for b in barcodes]
+            cur.executemany(sql, barcode_info)
         return barcodes
 
-    def create_ag_kits(self, swabs_kits, tag=None, projects=None):
+    def create_ag_kits(self, swabs_kits, tag=None, projects=None,
+                       processes=None, pool=None):
         """ Creates american gut handout kits on the database
 
         Parameters
@@ -1505,16 +1593,89 @@ class KniminAccess(object):
             Tag to add to kit IDs. Default None
         projects : list of str, optional
             Subprojects to attach to, if given. Default None.
+        processes : int, optional
+            Number of worker processes hashing the kit passwords. Default
+            one per CPU
+        pool : multiprocessing.Pool, optional
+            Worker processes to hash the kit passwords on, instead of
+            starting processes for this call
 
         Returns
         -------
         list of namedtuples
             The new kit information, in the form
             [(kit_id, password, verification_code, (barcode, barcode,...)),...]
+
+        See Also
+        --------
+        make_ag_kits
+        insert_ag_kits
+        """
+        kit_info = self.make_ag_kits(swabs_kits)
+        # bcrypt dominates the time taken for large batches, so hash all the
+        # passwords at once across the available cores
+        hashed = hash_passwords((kit[0] for kit in kit_info), processes, pool)
+        return self.insert_ag_kits(kit_info, hashed, tag, projects)
+
+    def make_ag_kits(self, swabs_kits):
+        """Makes the passwords and verification codes of new handout kits
+
+        Parameters
+        ----------
+        swabs_kits : list of tuples
+            kits and swab counts, with tuples in the form
+            (# of swabs, # of kits with this swab count)
+
+        Returns
+        -------
+        list of tuple of (str, str, int)
+            The password, verification code and number of swabs of each kit
+
+        Raises
+        ------
+        ValueError
+            There are not enough unassigned barcodes for the kits' swabs
+
+        Notes
+        -----
+        Nothing is written to the database. The passwords are then hashed,
+        which is slow, and the kits stored with insert_ag_kits.
         """
-        # make sure we have enough barcodes
         total_swabs = sum(s * k for s, k in swabs_kits)
-        barcodes = self.get_unassigned_barcodes(total_swabs)
+        remaining = self.count_unassigned_barcodes()
+        if remaining < total_swabs:
+            raise ValueError(
+                "Not enough barcodes! %d asked for, %d remaining"
+                % (total_swabs, remaining))
+
+        kit_info = []
+        for num_swabs, num_kits in swabs_kits:
+            for i in range(num_kits):
+                kit_info.append((make_passwd(), make_verification_code(),
+                                 num_swabs))
+        return kit_info
+
+    def insert_ag_kits(self, kit_info, hashed, tag=None, projects=None):
+        """Stores new handout kits and assigns barcodes to them
+
+        Parameters
+        ----------
+        kit_info : list of tuple of (str, str, int)
+            The kits, as returned by make_ag_kits
+        hashed : list of str
+            The hashed password of each kit
+        tag : str, optional
+            Tag to add to kit IDs. Default None
+        projects : list of str, optional
+            Subprojects to attach to, if given. Default None.
+
+        Returns
+        -------
+        list of namedtuples
+            The new kit information, in the form
+            [(kit_id, password, verification_code, (barcode, barcode,...)),...]
+        """
+        total_swabs = sum(kit[2] for kit in kit_info)
 
         # Assign barcodes to AG and any other subprojects
         if projects is None:
@@ -1522,42 +1683,102 @@ class KniminAccess(object):
         else:
             if "American Gut Project" not in projects:
                 projects.append("American Gut Project")
-        self.assign_barcodes(total_swabs, projects)
+        proj_ids = self._get_project_ids(projects)
 
+        kit_inserts = [[password, ver_code, num_swabs]
+                       for password, (_, ver_code, num_swabs)
+                       in zip(hashed, kit_info)]
+
+        # Insert kits, followed by barcodes attached to the kits
+        kit_barcode_sql = """INSERT INTO ag_handout_barcodes
+                             (kit_id, barcode, sample_barcode_file)
+                             VALUES(%s, %s, %s || '.jpg')"""
+
+        # claiming the barcodes and creating the kits happen in a single
+        # transaction, so concurrent kit creation gets disjoint barcodes and
+        # a failure gives the barcodes back
         kits = []
         kit_barcode_inserts = []
-        kit_inserts = []
         start = 0
         KitTuple = namedtuple('AGKit', ['kit_id', 'password',
                               'verification_code', 'barcodes'])
-        # build the kits information and the sql insert information
-        for num_swabs, num_kits in swabs_kits:
-            kit_ids = make_valid_kit_ids(num_kits, self.get_used_kit_ids(),
-                                         tag=tag)
-            for i in range(num_kits):
-                ver_code = make_verification_code()
-                password = make_passwd()
+        with self._con.transaction() as cur:
+            barcodes = self._claim_barcodes(cur, total_swabs, proj_ids)
+            kit_ids = self._insert_handout_kits(cur, kit_inserts, tag)
+            for kit_id, info in zip(kit_ids, kit_info):
+                password, ver_code, num_swabs = info
                 kit_bcs = tuple(barcodes[start:start + num_swabs])
                 start += num_swabs
-                kits.append(KitTuple(kit_ids[i], password, ver_code, kit_bcs))
-                kit_inserts.append((kit_ids[i],
-                                    self._hash_password(password),
-                                    ver_code, num_swabs))
+                kits.append(KitTuple(kit_id, password, ver_code, kit_bcs))
                 for barcode in kit_bcs:
-                    kit_barcode_inserts.append((kit_ids[i], barcode, barcode))
+                    kit_barcode_inserts.append((kit_id, barcode, barcode))
+            cur.executemany(kit_barcode_sql, kit_barcode_inserts)
 
-        # Insert kits, followed by barcodes attached to the kits
-        kit_sql = """INSERT INTO ag_handout_kits
-                     (kit_id, password, verification_code, swabs_per_kit)
-                     VALUES (%s, %s, %s, %s)"""
-        kit_barcode_sql = """INSERT INTO ag_handout_barcodes
-                             (kit_id, barcode, sample_barcode_file)
-                             VALUES(%s, %s, %s || '.jpg')"""
+        return kits
 
-        self._con.executemany(kit_sql, kit_inserts)
-        self._con.executemany(kit_barcode_sql, kit_barcode_inserts)
+    def _insert_handout_kits(self, cur, kits, tag=None, max_tries=10):
+        """Inserts handout kits, giving each one a free random kit ID
 
-        return kits
+        Parameters
+        ----------
+        cur : psycopg2 cursor
+            Cursor of the open transaction to insert the kits in
+        kits : list of list
+            The kits, in the form [password, verification_code, swabs]
+        tag : str, optional
+            Tag to add to kit IDs. Default None
+        max_tries : int, optional
+            Times to draw new IDs for kits whose ID is taken. Default 10
+
+        Returns
+        -------
+        list of str
+            The kit ID of each kit, in the order given
+
+        Raises
+        ------
+        ValueError
+            No free kit ID found for some kits after max_tries
+
+        Notes
+        -----
+        Candidate IDs are inserted in one statement per try. The handout kit
+        primary key and the unique registered kit ID reject the ones already
+        used, including by concurrent transactions, and only those kits get
+        new candidates. The cost depends on the number of kits created, not
+        on how many kits exist.
+        """
+        if not kits:
+            return []
+        sql = """INSERT INTO ag.ag_handout_kits
+                    (kit_id, password, verification_code, swabs_per_kit)
+                 SELECT k.kit_id, k.password, k.verification_code,
+                        k.swabs_per_kit
+                 FROM unnest(%s::varchar[], %s::varchar[], %s::varchar[],
+                             %s::integer[])
+                    AS k(kit_id, password, verification_code, swabs_per_kit)
+                 WHERE NOT EXISTS (SELECT 1 FROM ag.ag_kit
+                                   WHERE supplied_kit_id = k.kit_id)
+                 ON CONFLICT (kit_id) DO NOTHING
+                 RETURNING kit_id"""
+        kit_ids = [None] * len(kits)
+        pending = range(len(kits))
+        tried = set()
+        for _ in range(max_tries):
+            candidates = make_kit_ids(len(pending), tag=tag, exclude=tried)
+            tried.update(candidates)
+            rows = [kits[i] for i in pending]
+            cur.execute(sql, [candidates, [r[0] for r in rows],
+                              [r[1] for r in rows], [r[2] for r in rows]])
+            inserted = {x[0] for x in cur.fetchall()}
+            for i, kit_id in zip(pending, candidates):
+                if kit_id in inserted:
+                    kit_ids[i] = kit_id
+            pending = [i for i in pending if kit_ids[i] is None]
+            if not pending:
+                return kit_ids
+        raise ValueError("No free kit IDs found for %d kits after %d tries"
+                         % (len(pending), max_tries))
 
     def get_used_kit_ids(self):
         """Grab in use kit IDs, return set of them
@@ -1568,6 +1789,77 @@ class KniminAccess(object):
 
         return set(i[0] for i in self._con.execute_fetchall(sql))
 
+    def get_typeahead_values(self, kind):
+        """Returns the identifiers offered by typeahead lookups
+
+        Parameters
+        ----------
+        kind : {'barcode', 'kit_id', 'handout_kit_id', 'email'}
+            The identifiers to return
+
+        Returns
+        -------
+        list of str
+            The identifiers, in ascending order
+
+        Raises
+        ------
+        ValueError
+            Unknown kind passed
+        """
+        columns = {'barcode': ('barcode', 'barcodes.barcode'),
+                   'kit_id': ('supplied_kit_id', 'ag.ag_kit'),
+                   'handout_kit_id': ('kit_id', 'ag.ag_handout_kits'),
+                   'email': ('email', 'ag.ag_login')}
+        if kind not in columns:
+            raise ValueError('Unknown typeahead kind: %s' % kind)
+        column, table = columns[kind]
+        sql = """SELECT {0} FROM {1} WHERE {0} IS NOT NULL
+                 ORDER BY {0}""".format(column, table)
+        return [x[0] for x in self._con.execute_fetchall(sql)]
+
+    def get_typeahead_changes(self, since=None):
+        """Returns the typeahead identifiers changed since a snapshot
+
+        Parameters
+        ----------
+        since : str, optional
+            Snapshot returned by an earlier call. Default None, only return
+            the current snapshot
+
+        Returns
+        -------
+        str
+            The current snapshot, to pass to the next call
+        list of tuple of (str, list of str, list of str)
+            The kind, old values and new values of each change committed
+            after `since` was taken, in the order they were made
+
+        Notes
+        -----
+        Changes are found by the transaction that made them rather than by
+        their position in the log, so changes committed after ones made
+        later are not missed.
+        """
+        if since is None:
+            sql = "SELECT txid_current_snapshot()::text"
+            return self._con.execute_fetchone(sql)[0], []
+        sql = """SELECT s.snapshot::text, c.kind, c.old_values, c.new_values
+                 FROM (SELECT txid_current_snapshot() AS snapshot) s
+                 LEFT JOIN ag.typeahead_change c
+                    ON c.txid >= txid_snapshot_xmin(%s::txid_snapshot)
+                        AND NOT txid_visible_in_snapshot(c.txid,
+                                                         %s::txid_snapshot)
+                 ORDER BY c.change_id"""
+        rows = self._con.execute_fetchall(sql, [since, since])
+        return rows[0][0], [tuple(r[1:]) for r in rows if r[1] is not None]
+
+    def prune_typeahead_changes(self, days=1):
+        """Removes typeahead changes older than the given number of days"""
+        sql = """DELETE FROM ag.typeahead_change
+                 WHERE changed < now() - %s * interval '1 day'"""
+        self._con.execute(sql, [days])
+
     def create_project(self, name):
         if name.strip() == '':
             raise ValueError("Project name can not be blank!")
@@ -1603,19 +1895,27 @@ class KniminAccess(object):
         -----
         Barcodes are returned in ascending order
         """
-        sql = """SELECT DISTINCT barcode FROM barcodes.barcode
-                 LEFT JOIN barcodes.project_barcode pb USING (barcode)
-                 WHERE pb.barcode IS NULL
-                 ORDER BY barcode ASC"""
-        barcodes = self._con.execute_fetchall(sql)
-        if n is not None:
-            if len(barcodes) < n:
-                raise ValueError(
-                    "Not enough barcodes! %d asked for, %d remaining"
-                    % (n, len(barcodes)))
-            barcodes = barcodes[:n]
+        # LIMIT NULL returns all rows
+        sql = """SELECT barcode FROM barcodes.unassigned_barcode
+                 ORDER BY barcode ASC LIMIT %s"""
+        barcodes = self._con.execute_fetchall(sql, [n])
+        if n is not None and len(barcodes) < n:
+            raise ValueError(
+                "Not enough barcodes! %d asked for, %d remaining"
+                % (n, len(barcodes)))
         return [x[0] for x in barcodes]
 
+    def count_unassigned_barcodes(self):
+        """Returns the number of barcodes not assigned to any project
+
+        Returns
+        -------
+        int
+            Number of unassigned barcodes
+        """
+        sql = "SELECT count(*) FROM barcodes.unassigned_barcode"
+        return self._con.execute_fetchone(sql)[0]
+
     def assign_barcodes(self, num_barcodes, projects):
         """Assign a given number of barcodes to projects
 
@@ -1631,39 +1931,86 @@ class KniminAccess(object):
         list of str
             Barcodes assigned to the projects
 
+        Raises
+        ------
+        ValueError
+            One or more projects given don't exist in the database
+            Not enough unassigned barcodes left
+        """
+        proj_ids = self._get_project_ids(projects)
+        with self._con.transaction() as cur:
+            return self._claim_barcodes(cur, num_barcodes, proj_ids)
+
+    def _get_project_ids(self, projects):
+        """Returns the project_ids of the given projects
+
         Raises
         ------
         ValueError
             One or more projects given don't exist in the database
         """
-        # Verify projects given exist
-        sql = "SELECT project FROM project"
-        existing = {x[0] for x in self._con.execute_fetchall(sql)}
-        not_exist = {p for p in projects if p not in existing}
+        sql = "SELECT project, project_id FROM project WHERE project IN %s"
+        ids = dict(self._con.execute_fetchall(sql, [tuple(projects)]))
+        not_exist = {p for p in projects if p not in ids}
         if not_exist:
             raise ValueError("Project(s) given don't exist in database: %s"
                              % ', '.join(map(xhtml_escape, not_exist)))
+        return [ids[p] for p in set(projects)]
+
+    def _claim_barcodes(self, cur, num_barcodes, project_ids):
+        """Takes unassigned barcodes and assigns them to projects
+
+        Parameters
+        ----------
+        cur : psycopg2.cursor
+            Cursor of the transaction from SQLHandler.transaction to claim
+            the barcodes in
+        num_barcodes : int
+            Number of barcodes to claim
+        project_ids : list of int
+            Projects to assign the barcodes to
 
-        # Get unassigned barcode list and make sure we have enough barcodes
-        barcodes = self.get_unassigned_barcodes(num_barcodes)
-
-        # Assign barcodes to the project(s)
-        sql = "SELECT project_id from project WHERE project in %s"
-        proj_ids = [x[0] for x in
-                    self._con.execute_fetchall(sql, [tuple(projects)])]
-
-        barcode_project_insert = """INSERT INTO project_barcode
-                                    (barcode, project_id)
-                                    VALUES (%s, %s)"""
-        project_inserts = []
-        for barcode in barcodes:
-            for project in proj_ids:
-                project_inserts.append((barcode, project))
-        self._con.executemany(barcode_project_insert, project_inserts)
+        Returns
+        -------
+        list of str
+            The claimed barcodes, in ascending order
+
+        Raises
+        ------
+        ValueError
+            num_barcodes is not positive
+            Not enough unassigned barcodes left
+
+        Notes
+        -----
+        The barcodes are removed from barcodes.unassigned_barcode with FOR
+        UPDATE SKIP LOCKED, so transactions claiming barcodes at the same time
+        get disjoint sets instead of waiting on or colliding with each other.
+        The claim is undone if the transaction rolls back.
+        """
+        if num_barcodes < 1:
+            raise ValueError("Number of barcodes must be positive, got %d"
+                             % num_barcodes)
+        sql = """DELETE FROM barcodes.unassigned_barcode
+                 WHERE barcode IN (
+                    SELECT barcode FROM barcodes.unassigned_barcode
+                    ORDER BY barcode LIMIT %s
+                    FOR UPDATE SKIP LOCKED)
+                 RETURNING barcode"""
+        cur.execute(sql, [num_barcodes])
+        barcodes = sorted(x[0] for x in cur.fetchall())
+        if len(barcodes) < num_barcodes:
+            raise ValueError(
+                "Not enough barcodes! %d asked for, %d remaining"
+                % (num_barcodes, len(barcodes)))
+
+        sql = """INSERT INTO barcodes.project_barcode (barcode, project_id)
+                 VALUES (%s, %s)"""
+        cur.executemany(sql, [(b, p) for b in barcodes for p in project_ids])
         # Set assign date for the barcodes
         sql = """UPDATE barcodes.barcode
                  SET assigned_on = NOW() WHERE barcode IN %s"""
-        self._con.execute(sql, [tuple(barcodes)])
+        cur.execute(sql, [tuple(barcodes)])
         return barcodes
 
     def create_barcodes(self, num_barcodes):
@@ -1678,20 +2025,25 @@ class KniminAccess(object):
         -------
         list
             New barcodes created
-        """
-
-        # Get newest barcode as an integer
-        sql = "SELECT max(barcode::integer) from barcode"
-        newest = self._con.execute_fetchone(sql)[0]
 
-        # create new barcodes by padding integers with zeros
-        barcodes = ['%09d' % b for b in range(newest + 1,
-                                              newest + 1 + num_barcodes)]
+        Raises
+        ------
+        ValueError
+            If barcodes.barcode_seq has run out of 9 digit numbers
 
-        barcode_insert = """INSERT INTO barcode (barcode, obsolete)
-                            VALUES (%s, 'N')"""
-        self._con.executemany(barcode_insert, [[b] for b in barcodes])
-        return barcodes
+        Notes
+        -----
+        The barcode numbers are drawn from barcodes.barcode_seq and inserted
+        in a single statement, so concurrent calls never mint the same
+        barcode.
+        """
+        sql = """INSERT INTO barcodes.barcode (barcode, obsolete)
+                 SELECT lpad(nextval('barcodes.barcode_seq')::text, 9, '0'),
+                        'N'
+                 FROM generate_series(1, %s)
+                 RETURNING barcode"""
+        return sorted(x[0] for x in
+                      self._con.execute_fetchall(sql, [num_barcodes]))
 
     def get_barcodes_for_projects(self, projects, limit=None):
         """Gets barcode information for barcodes belonging to projects
@@ -1724,6 +2076,59 @@ class KniminAccess(object):
             sql_args.append(limit)
         return self._con.execute_fetchall(select_sql, sql_args)
 
+    def get_project_summary(self, breakdown=False):
+        """Counts the barcodes in every project
+
+        Parameters
+        ----------
+        breakdown : bool, optional
+            Also count the barcodes of each project by status and
+            sequencing status. Default False
+
+        Returns
+        -------
+        list of dict
+            One dict per project, ordered by project name, in the form
+            {'project': name, 'barcodes': number of barcodes}. With
+            breakdown, each also has 'status' and 'sequencing_status' keys
+            holding {value: number of barcodes}, with None for barcodes
+            where the value is not set.
+        """
+        if breakdown:
+            sql = """SELECT project, status, sequencing_status,
+                        count(barcode)
+                     FROM project
+                     LEFT JOIN project_barcode USING (project_id)
+                     LEFT JOIN barcode USING (barcode)
+                     GROUP BY project, status, sequencing_status
+                     ORDER BY project"""
+        else:
+            sql = """SELECT project, count(barcode)
+                     FROM project
+                     LEFT JOIN project_barcode USING (project_id)
+                     GROUP BY project
+                     ORDER BY project"""
+
+        summary = []
+        for row in self._con.execute_fetchall(sql):
+            project = self._unicode_convert(row[0])
+            if not summary or summary[-1]['project'] != project:
+                summary.append({'project': project, 'barcodes': 0})
+                if breakdown:
+                    summary[-1]['status'] = defaultdict(int)
+                    summary[-1]['sequencing_status'] = defaultdict(int)
+            info = summary[-1]
+            count = row[-1]
+            info['barcodes'] += count
+            if breakdown and count:
+                info['status'][row[1]] += count
+                info['sequencing_status'][row[2]] += count
+        if breakdown:
+            for info in summary:
+                info['status'] = dict(info['status'])
+                info['sequencing_status'] = dict(info['sequencing_status'])
+        return summary
+
     def add_external_survey(self, survey, description, url):
         """Adds a new external survey to the database
 
@@ -2225,41 +2630,171 @@ class KniminAccess(object):
         res = self._con.execute_fetchone(sql, [barcode])
         return res[0] if res else None
 
-    def search_participant_info(self, term):
-        sql = """SELECT cast(ag_login_id as varchar(100)) as ag_login_id
+    def _like_term(self, term):
+        """Builds a LIKE pattern matching term anywhere in a value
+
+        Parameters
+        ----------
+        term : str
+            The search term
+
+        Returns
+        -------
+        str
+            term wrapped in %, with any LIKE wildcards in it escaped so they
+            match literally
+        """
+        term = term.replace('\\', '\\\\').replace('%', '\\%').replace(
+            '_', '\\_')
+        return '%' + term + '%'
+
+    def _participant_info_search(self, term):
+        """SQL and arguments matching logins on email, name or address"""
+        sql = """SELECT ag_login_id
                  FROM ag_login al
                  WHERE lower(email) like %s or lower(name) like
                  %s or lower(address) like %s"""
-        liketerm = '%%' + term.lower() + '%%'
-        results = self._con.execute_fetchall(sql,
-                                             [liketerm, liketerm, liketerm])
-        return [x[0] for x in results]
+        liketerm = self._like_term(term.lower())
+        return sql, [liketerm, liketerm, liketerm]
 
-    def search_kits(self, term):
-        sql = """SELECT cast(ag_login_id as varchar(100)) as ag_login_id
+    def _kits_search(self, term):
+        """SQL and arguments matching logins on their kit information"""
+        sql = """SELECT ag_login_id
                  FROM ag_kit
                  WHERE lower(supplied_kit_id) like %s or
                  lower(kit_password) like %s or
-                 lower(kit_verification_code) = %s or
+                 lower(kit_verification_code) like %s or
                  cast(ag_kit_id as varchar(100)) like %s"""
-        liketerm = '%%' + term.lower() + '%%'
-        results = self._con.execute_fetchall(sql,
-                                             [liketerm, liketerm, liketerm,
-                                              liketerm])
-        return [x[0] for x in results]
+        liketerm = self._like_term(term.lower())
+        return sql, [liketerm, liketerm, liketerm, liketerm]
+
+    def _barcodes_search(self, term):
+        """SQL and arguments matching logins on barcodes, participant names
+        or barcode notes"""
+        # Each branch filters a single table so the trigram indexes on
+        # barcode, notes and participant_name can be used. Only logins with
+        # at least one kit barcode are returned.
+        sql = """SELECT ag_login_id
+                 FROM ag.ag_kit
+                 WHERE ag_kit_id IN (
+                    SELECT ag_kit_id FROM ag.ag_kit_barcodes
+                    WHERE barcode like %s or lower(notes) like %s)
+                 UNION
+                 SELECT ag_login_id
+                 FROM ag.ag_login_surveys
+                 WHERE lower(participant_name) like %s
+                    AND ag_login_id IN (
+                        SELECT ag_login_id FROM ag.ag_kit
+                        JOIN ag.ag_kit_barcodes USING (ag_kit_id))"""
+        liketerm = self._like_term(term.decode('utf-8').lower())
+        return sql, [liketerm, liketerm, liketerm]
 
-    def search_barcodes(self, term):
-        sql = """SELECT DISTINCT
-                    cast(ag_login_id as varchar(100)) as ag_login_id
-                 FROM ag.ag_kit_barcodes
-                 JOIN ag.ag_kit USING (ag_kit_id)
-                 LEFT JOIN ag.ag_login_surveys USING (ag_login_id)
-                 WHERE barcode like %s or lower(participant_name) like
-                 %s or lower(notes) like %s"""
-        liketerm = '%%' + term.decode('utf-8').lower() + '%%'
-        results = self._con.execute_fetchall(sql,
-                                             [liketerm, liketerm, liketerm])
-        return [x[0] for x in results]
+    def _page_logins(self, sql, sql_args, after=None, limit=None):
+        """Runs a login search with keyset pagination
+
+        Parameters
+        ----------
+        sql : str
+            Query returning matching ag_login_ids in a column ag_login_id
+        sql_args : list
+            The arguments for the query
+        after : str, optional
+            Only return ag_login_ids sorting after this one. Default None
+            (start from the first match)
+        limit : int, optional
+            Maximum number of ag_login_ids to return. Default None (all)
+
+        Returns
+        -------
+        list of str
+            Distinct matching ag_login_ids in ascending order
+        """
+        sql = """SELECT cast(ag_login_id as varchar(100)) as ag_login_id
+                 FROM (%s) AS matches""" % sql
+        sql_args = list(sql_args)
+        if after is not None:
+            sql += " WHERE matches.ag_login_id > %s"
+            sql_args.append(after)
+        # Order on the uuid itself, not its text cast. LIMIT NULL returns
+        # all rows
+        sql += """ GROUP BY matches.ag_login_id
+                  ORDER BY matches.ag_login_id LIMIT %s"""
+        sql_args.append(limit)
+        return [x[0] for x in self._con.execute_fetchall(sql, sql_args)]
+
+    def _estimate_rows(self, sql, sql_args):
+        """Returns the planner's estimate of the rows a query returns
+
+        This only plans the query, so it is cheap enough to run on every
+        search regardless of how many rows actually match
+        """
+        plan = self._con.execute_fetchone(
+            'EXPLAIN (FORMAT JSON) ' + sql, sql_args)[0]
+        if not isinstance(plan, list):
+            plan = json.loads(plan)
+        return int(plan[0]['Plan']['Plan Rows'])
+
+    def search_participant_info(self, term, after=None, limit=None):
+        """Finds logins whose email, name or address contain term
+
+        Parameters
+        ----------
+        term : str
+            Text to search for
+        after : str, optional
+            Keyset pagination cursor, only return ag_login_ids sorting after
+            this one. Default None
+        limit : int, optional
+            Maximum number of ag_login_ids to return. Default None (all)
+
+        Returns
+        -------
+        list of str
+            Matching ag_login_ids in ascending order
+        """
+        sql, sql_args = self._participant_info_search(term)
+        return self._page_logins(sql, sql_args, after, limit)
+
+    def search_kits(self, term, after=None, limit=None):
+        """Finds logins whose kit ID, password or verification code contain
+        term
+
+        Parameters and return value are the same as search_participant_info
+        """
+        sql, sql_args = self._kits_search(term)
+        return self._page_logins(sql, sql_args, after, limit)
+
+    def search_barcodes(self, term, after=None, limit=None):
+        """Finds logins with a kit barcode, barcode note or participant name
+        containing term
+
+        Parameters and return value are the same as search_participant_info
+        """
+        sql, sql_args = self._barcodes_search(term)
+        return self._page_logins(sql, sql_args, after, limit)
+
+    def estimate_search_counts(self, term):
+        """Estimates how many results an AG search for term has
+
+        Parameters
+        ----------
+        term : str
+            Text to search for
+
+        Returns
+        -------
+        dict of int
+            Planner estimates in the form {'logins': number of matching
+            logins, 'handouts': number of matching handout kit barcodes}
+        """
+        searches = [self._participant_info_search(term),
+                    self._kits_search(term),
+                    self._barcodes_search(term)]
+        sql = ' UNION '.join('(%s)' % s for s, _ in searches)
+        sql_args = [a for _, args in searches for a in args]
+        handout_sql, handout_args = self._handout_kits_search(term)
+        return {'logins': self._estimate_rows(sql, sql_args),
+                'handouts': self._estimate_rows(handout_sql, handout_args)}
 
     def get_kit_info_by_login(self, ag_login_id):
         sql = """SELECT cast(ag_kit_id as varchar(100)) as ag_kit_id,
@@ -2271,15 +2806,43 @@ class KniminAccess(object):
         info = self._con.execute_fetchdict(sql, [ag_login_id])
         return info if info else []
 
-    def search_handout_kits(self, term):
-        sql = """SELECT kit_id, password, barcode, verification_code
-                 FROM ag.ag_handout_kits
-                 JOIN (SELECT kit_id, barcode, sample_barcode_file
-                    FROM ag.ag_handout_barcodes
-                    GROUP BY kit_id, barcode) AS hb USING (kit_id)
-                 WHERE kit_id LIKE %s or barcode LIKE %s"""
-        liketerm = '%%' + term + '%%'
-        return self._con.execute_fetchdict(sql, [liketerm, liketerm])
+    def _handout_kits_search(self, term):
+        """SQL and arguments matching handout kits on kit ID or barcode"""
+        sql = """SELECT DISTINCT hb.kit_id, password, hb.barcode,
+                                 verification_code
+                 FROM ag.ag_handout_barcodes hb
+                 JOIN ag.ag_handout_kits USING (kit_id)
+                 WHERE (hb.kit_id LIKE %s or hb.barcode LIKE %s)"""
+        liketerm = self._like_term(term)
+        return sql, [liketerm, liketerm]
+
+    def search_handout_kits(self, term, after=None, limit=None):
+        """Finds handout kit barcodes whose kit ID or barcode contain term
+
+        Parameters
+        ----------
+        term : str
+            Text to search for
+        after : tuple of (str, str), optional
+            Keyset pagination cursor, only return rows sorting after this
+            (kit_id, barcode). Default None
+        limit : int, optional
+            Maximum number of rows to return. Default None (all)
+
+        Returns
+        -------
+        list of dict
+            Matching rows, ordered by kit_id and barcode, with keys kit_id,
+            password, barcode and verification_code
+        """
+        sql, sql_args = self._handout_kits_search(term)
+        if after is not None:
+            sql += " AND (hb.kit_id, hb.barcode) > (%s, %s)"
+            sql_args.extend(after)
+        # LIMIT NULL returns all rows
+        sql += " ORDER BY hb.kit_id, hb.barcode LIMIT %s"
+        sql_args.append(limit)
+        return self._con.execute_fetchdict(sql, sql_args)
 
     def get_login_by_email(self, email):
         sql = """SELECT name, address, city, state, zip, country, ag_login_id
@@ -2300,6 +2863,114 @@ class KniminAccess(object):
                  WHERE   ag_login_id = %s"""
         return self._con.execute_fetchdict(sql, [ag_login_id])
 
+    def search_bundle(self, ag_login_ids):  # noqa
+        """Collects everything the AG search page displays for logins
+
+        Parameters
+        ----------
+        ag_login_ids : iterable of str
+            The ag_login_ids to gather information for
+
+        Returns
+        -------
+        list of dict
+            One dict per login, in the order given, of the form
+            {'login_info': [login dict],
+             'humans': [participant_name, ...],
+             'animals': [participant_name, ...],
+             'kit': [kit dict with extra key 'barcode_info'
+                     {barcode: {'ag_info': dict, 'barcode_info': dict,
+                                'plate': [dict, ...]}}, ...]}
+
+        Notes
+        -----
+        This is equivalent to calling get_login_info, getHumanParticipants,
+        getAnimalParticipants, get_kit_info_by_login,
+        get_barcode_info_by_kit_id, get_barcode_details and
+        get_plate_for_barcode for every login, but issues a fixed number of
+        queries regardless of how many logins, kits or barcodes match.
+        """
+        ag_login_ids = [str(login) for login in ag_login_ids]
+        if not ag_login_ids:
+            return []
+        logins = tuple(ag_login_ids)
+
+        bundle = {login: {'login_info': [], 'humans': [], 'animals': [],
+                          'kit': []} for login in ag_login_ids}
+
+        sql = """SELECT cast(ag_login_id as varchar(100)) as ag_login_id,
+                        email, name, address, city, state, zip, country
+                 FROM ag_login
+                 WHERE ag_login_id IN %s"""
+        for row in self._con.execute_fetchdict(sql, [logins]):
+            bundle[row['ag_login_id']]['login_info'].append(row)
+
+        # human surveys are survey 1, animal surveys are survey 2
+        sql = """SELECT DISTINCT
+                    cast(ag_login_id as varchar(100)) as ag_login_id,
+                    ags.survey_id, participant_name
+                 FROM ag.ag_login_surveys
+                 JOIN ag.survey_answers USING (survey_id)
+                 JOIN ag.group_questions gq USING (survey_question_id)
+                 JOIN ag.surveys ags USING (survey_group)
+                 WHERE ag_login_id IN %s AND ags.survey_id IN (1, 2)"""
+        participant_key = {1: 'humans', 2: 'animals'}
+        for login, survey, name in self._con.execute_fetchall(sql, [logins]):
+            bundle[login][participant_key[survey]].append(name)
+
+        sql = """SELECT cast(ag_kit_id as varchar(100)) as ag_kit_id,
+                        cast(ag_login_id as varchar(100)) as ag_login_id,
+                        supplied_kit_id, kit_password, swabs_per_kit,
+                        kit_verification_code, kit_verified
+                 FROM ag_kit
+                 WHERE ag_login_id IN %s"""
+        kits = {}
+        for kit in self._con.execute_fetchdict(sql, [logins]):
+            kit['barcode_info'] = {}
+            kits[kit['ag_kit_id']] = kit
+            bundle[kit['ag_login_id']]['kit'].append(kit)
+
+        if kits:
+            sql = """SELECT DISTINCT
+                        cast(ag_kit_barcode_id as varchar(100)) as
+                        ag_kit_barcode_id, cast(ag_kit_id as varchar(100)) as
+                        ag_kit_id, barcode, sample_date, sample_time,
+                        site_sampled, environment_sampled, participant_name,
+                        notes, results_ready, withdrawn, refunded
+                     FROM ag.ag_kit_barcodes
+                     LEFT JOIN ag.source_barcodes_surveys USING (barcode)
+                     LEFT JOIN ag.ag_login_surveys USING (survey_id)
+                     WHERE ag_kit_id IN %s"""
+            barcodes = {}
+            for row in self._con.execute_fetchdict(sql, [tuple(kits)]):
+                info = {'ag_info': row, 'barcode_info': {}, 'plate': []}
+                kits[row['ag_kit_id']]['barcode_info'][row['barcode']] = info
+                barcodes.setdefault(row['barcode'], []).append(info)
+
+            if barcodes:
+                bcs = tuple(barcodes)
+                sql = """SELECT barcode, create_date_time, status,
+                            scan_date, sample_postmark_date,
+                            biomass_remaining, sequencing_status, obsolete
+                         FROM barcode
+                         WHERE barcode IN %s"""
+                for row in self._con.execute_fetchdict(sql, [bcs]):
+                    barcode = row.pop('barcode')
+                    for info in barcodes[barcode]:
+                        info['barcode_info'] = row
+
+                sql = """SELECT pb.barcode, p.plate, p.sequence_date
+                         FROM plate p
+                         INNER JOIN plate_barcode pb
+                         ON pb.plate_id = p.plate_id
+                         WHERE pb.barcode IN %s"""
+                for row in self._con.execute_fetchdict(sql, [bcs]):
+                    barcode = row.pop('barcode')
+                    for info in barcodes[barcode]:
+                        info['plate'].append(row)
+
+        return [bundle[login] for login in ag_login_ids]
+
     def getAGBarcodeDetails(self, barcode):
         sql = """SELECT DISTINCT email,
                     cast(ag_kit_barcode_id as varchar(100)),
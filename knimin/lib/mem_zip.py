@@ -1,5 +1,8 @@
 # http://stackoverflow.com/a/19722365
+import struct
+import time
 import zipfile
+import zlib
 
 try:
     from cStringIO import StringIO
@@ -61,6 +64,114 @@ class InMemoryZip(object):
         return self.in_memory_data.getvalue()
 
 
+class _CountingWriter(object):
+    """Write-only file object passing data on and tracking the position"""
+    def __init__(self, write):
+        self._write = write
+        self._pos = 0
+
+    def write(self, data):
+        self._pos += len(data)
+        self._write(data)
+
+    def tell(self):
+        return self._pos
+
+    def flush(self):
+        pass
+
+
+class StreamingZip(object):
+    """Zip archive handed to a callback piece by piece as it is built
+
+    Parameters
+    ----------
+    write : callable
+        Called with each chunk of the archive, in order
+
+    Notes
+    -----
+    Nothing is held in memory beyond the chunk being compressed, so
+    arbitrarily large files can be sent while they are produced. Files are
+    written with a data descriptor after their contents, since the sizes
+    and checksum are not known when the file header goes out.
+    """
+    def __init__(self, write):
+        self._out = _CountingWriter(write)
+        self.zip = zipfile.ZipFile(self._out, "w", zipfile.ZIP_DEFLATED,
+                                   False)
+
+    def append(self, filename_in_zip, chunks):
+        """Appends a file whose contents are produced in chunks
+
+        Parameters
+        ----------
+        filename_in_zip : str
+            Filename of zip file.
+        chunks : iterable of str
+            Contents to be written into file, in order.
+
+        See Also
+        --------
+        write_file
+        """
+        for _ in self.write_file(filename_in_zip, chunks):
+            pass
+        return self   # so you can daisy-chain
+
+    def write_file(self, filename_in_zip, chunks):
+        """Appends a file, yielding after each chunk is written
+
+        Parameters
+        ----------
+        filename_in_zip : str
+            Filename of zip file.
+        chunks : iterable of str
+            Contents to be written into file, in order.
+
+        Notes
+        -----
+        The file is written as the generator is iterated, so the caller can
+        wait for what was written so far to be sent before going on.
+        """
+        zinfo = zipfile.ZipInfo(filename_in_zip, time.localtime()[:6])
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+        zinfo.external_attr = 0o600 << 16
+        # sizes and checksum follow the data
+        zinfo.flag_bits = 0x08
+        # created on Windows, so Unix permissions are not inferred as 0000
+        zinfo.create_system = 0
+        zinfo.header_offset = self._out.tell()
+        self._out.write(zinfo.FileHeader(zip64=False))
+
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                                      zlib.DEFLATED, -15)
+        crc = size = compress_size = 0
+        for chunk in chunks:
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            data = compressor.compress(chunk)
+            if data:
+                compress_size += len(data)
+                self._out.write(data)
+            yield
+        data = compressor.flush()
+        compress_size += len(data)
+        self._out.write(data)
+
+        zinfo.CRC = crc & 0xffffffff
+        zinfo.file_size = size
+        zinfo.compress_size = compress_size
+        self._out.write(struct.pack("<4sLLL", "PK\x07\x08", zinfo.CRC,
+                                    compress_size, size))
+        self.zip.filelist.append(zinfo)
+        self.zip.NameToInfo[zinfo.filename] = zinfo
+
+    def close(self):
+        """Writes the end of the archive"""
+        self.zip.close()
+
+
 def extract_zip(input_zip):
     """ Reads all files of a zip file from disk.
 
@@ -0,0 +1,92 @@
+"""Apply the labadmin SQL patches to the database
+
+The core AG schema is created and patched by american-gut-web. Schema
+changes that only labadmin needs (indexes, helper tables, sequences) live
+in knimin/db/patches as numbered SQL files. Each file is applied once, in
+filename order, inside its own transaction, and recorded in
+ag.labadmin_patches.
+"""
+from glob import glob
+from os.path import join, dirname, abspath, basename
+
+
+PATCHES_DIR = join(dirname(abspath(__file__)), '..', 'db', 'patches')
+
+
+def _ensure_patch_table(sql_handler):
+    sql = """CREATE TABLE IF NOT EXISTS ag.labadmin_patches (
+                patch varchar PRIMARY KEY,
+                applied_on timestamp NOT NULL DEFAULT NOW())"""
+    sql_handler.execute(sql)
+
+
+def get_applied_patches(sql_handler):
+    """Returns the names of the patches already applied
+
+    Parameters
+    ----------
+    sql_handler : SQLHandler
+        Connection to the database
+
+    Returns
+    -------
+    set of str
+        Filenames of the applied patches, e.g. {'0001.sql'}
+    """
+    _ensure_patch_table(sql_handler)
+    sql = "SELECT patch FROM ag.labadmin_patches"
+    return {x[0] for x in sql_handler.execute_fetchall(sql)}
+
+
+def get_pending_patches(sql_handler, patches_dir=PATCHES_DIR):
+    """Returns the patch files not yet applied, in the order to apply them
+
+    Parameters
+    ----------
+    sql_handler : SQLHandler
+        Connection to the database
+    patches_dir : str, optional
+        Folder holding the numbered SQL patches. Default knimin/db/patches
+
+    Returns
+    -------
+    list of str
+        Full paths of the pending patch files
+    """
+    applied = get_applied_patches(sql_handler)
+    return [fp for fp in sorted(glob(join(patches_dir, '*.sql')))
+            if basename(fp) not in applied]
+
+
+def patch_db(sql_handler, patches_dir=PATCHES_DIR):
+    """Applies all pending patches to the database
+
+    Parameters
+    ----------
+    sql_handler : SQLHandler
+        Connection to the database
+    patches_dir : str, optional
+        Folder holding the numbered SQL patches. Default knimin/db/patches
+
+    Returns
+    -------
+    list of str
+        Filenames of the patches applied, in order
+
+    Raises
+    ------
+    ValueError
+        A patch failed. It is rolled back and later patches are not applied
+    """
+    applied = []
+    for fp in get_pending_patches(sql_handler, patches_dir):
+        name = basename(fp)
+        with open(fp, 'U') as f:
+            patch_sql = f.read()
+        # the patch and its bookkeeping row go in the same transaction.
+        # Literal % in the patch must not be taken as a placeholder
+        sql = patch_sql.replace('%', '%%')
+        sql += "\n;INSERT INTO ag.labadmin_patches (patch) VALUES (%s)"
+        sql_handler.execute(sql, [name])
+        applied.append(name)
+    return applied
@@ -0,0 +1,150 @@
+"""Disk cache of generated barcode PDFs
+
+Operators often reprint the same batch of barcodes. Finished PDFs are kept
+in a folder under base_data_dir, named after a hash of everything that went
+into them, so a reprint is read back from disk instead of being rendered
+again. The least recently used files are removed once the folder grows over
+its size limit.
+"""
+from contextlib import contextmanager
+from errno import EEXIST, ENOENT
+from os import listdir, makedirs, remove, rename, stat, utime
+from os.path import join
+from tempfile import NamedTemporaryFile
+
+
+class PDFCache(object):
+    """Folder of PDFs keyed on a hash of their contents
+
+    Parameters
+    ----------
+    cache_dir : str
+        Folder holding the cached PDFs. Created if missing
+    max_size : int
+        Bytes the cached PDFs may take before the least recently used ones
+        are removed
+    """
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+
+    def _path(self, key):
+        return join(self.cache_dir, '%s.pdf' % key)
+
+    def get(self, key):
+        """Returns the path of a cached PDF
+
+        Parameters
+        ----------
+        key : str
+            Hash the PDF was stored under
+
+        Returns
+        -------
+        str or None
+            Path to the PDF, or None if it is not cached
+        """
+        path = self._path(key)
+        try:
+            # the modification time records when the PDF was last used
+            utime(path, None)
+        except OSError as e:
+            if e.errno != ENOENT:
+                raise
+            return None
+        return path
+
+    def open(self, key):
+        """Opens a cached PDF for reading
+
+        Parameters
+        ----------
+        key : str
+            Hash the PDF was stored under
+
+        Returns
+        -------
+        file or None
+            The PDF, or None if it is not cached
+
+        Notes
+        -----
+        Unlike opening the path from get, this does not fail if the PDF is
+        evicted in between. Once opened, the PDF can be read to the end
+        even if it is evicted.
+        """
+        try:
+            pdf = open(self._path(key), 'rb')
+        except IOError as e:
+            if e.errno != ENOENT:
+                raise
+            return None
+        self.get(key)
+        return pdf
+
+    @contextmanager
+    def writer(self, key):
+        """Opens a file to write a PDF into the cache
+
+        Parameters
+        ----------
+        key : str
+            Hash to store the PDF under
+
+        Yields
+        ------
+        file
+            File to write the PDF to
+
+        Notes
+        -----
+        The PDF is written to a temporary file and only moved into place
+        once the block finishes without errors, so a failed or concurrent
+        render never leaves a partial PDF under the key.
+        """
+        try:
+            makedirs(self.cache_dir)
+        except OSError as e:
+            if e.errno != EEXIST:
+                raise
+        f = NamedTemporaryFile(dir=self.cache_dir, suffix='.tmp',
+                               delete=False)
+        try:
+            with f:
+                yield f
+            rename(f.name, self._path(key))
+        except BaseException:
+            remove(f.name)
+            raise
+        self.evict()
+
+    def _files(self):
+        """Returns (mtime, size, path) of each cached PDF"""
+        files = []
+        for name in listdir(self.cache_dir):
+            if not name.endswith('.pdf'):
+                continue
+            path = join(self.cache_dir, name)
+            try:
+                info = stat(path)
+            except OSError as e:
+                # removed by a concurrent eviction
+                if e.errno != ENOENT:
+                    raise
+                continue
+            files.append((info.st_mtime, info.st_size, path))
+        return files
+
+    def evict(self):
+        """Removes the least recently used PDFs until under max_size"""
+        files = self._files()
+        total = sum(f[1] for f in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_size:
+                break
+            try:
+                remove(path)
+            except OSError as e:
+                if e.errno != ENOENT:
+                    raise
+            total -= size
@@ -2,19 +2,55 @@
 
 """take barcodes and dump to a single multipage pdf
 
-requires GPL Ghostscript 9.05
+The labels are written straight to PDF, with the bars drawn as filled
+rectangles and the barcode text set in Helvetica, so no images or external
+programs are involved.
 """
 
-from PIL import Image
-from os import path, mkdir
+from collections import deque
+from hashlib import sha256
+from multiprocessing import Pool, cpu_count
 from os.path import join, dirname, realpath
-from math import ceil
-from random import choice
-from shutil import rmtree
-from subprocess import Popen, PIPE
-from shlex import split as cmd_split
+from zlib import compress
 
-from knimin.lib.code128 import code128_image
+from knimin.lib.code128 import code128_image, code128_widths
+
+# Layout in pixels at 150 dpi, assuming N * 8.5in x 11in
+PAGE_WIDTH = 1275
+PAGE_HEIGHT = 1650
+DPI = 150
+
+# padding set empirically for
+# Electronic Imaging Materials
+# Part #80402
+START_LEFT = 18
+START_UPPER = 59
+HORIZ_GAP = 23
+VERT_GAP = 17
+BOX_WIDTH = 300
+BOX_HEIGHT = 150
+COLUMNS = 4
+LABELS_PER_PAGE = 36
+
+# barcodes are 202x100px, centered in their box
+LABEL_WIDTH = 202
+LABEL_HEIGHT = 100
+SHIFT_RIGHT = 49
+SHIFT_DOWN = 25
+BAR_THICKNESS = 2
+BAR_HEIGHT = 76
+FONT_SIZE = 20
+TEXT_BASELINE = 93
+# Helvetica digit width, in thousandths of the font size. Barcodes are
+# zero padded numbers, so this is all that is needed to center the text
+DIGIT_WIDTH = 556
+# bump when the PDF drawn for the same barcodes changes, so cached PDFs
+# are not reused
+PDF_VERSION = 1
+LAYOUT = (PDF_VERSION, PAGE_WIDTH, PAGE_HEIGHT, DPI, START_LEFT, START_UPPER,
+          HORIZ_GAP, VERT_GAP, BOX_WIDTH, BOX_HEIGHT, COLUMNS,
+          LABELS_PER_PAGE, LABEL_WIDTH, LABEL_HEIGHT, SHIFT_RIGHT, SHIFT_DOWN,
+          BAR_THICKNESS, BAR_HEIGHT, FONT_SIZE, TEXT_BASELINE, DIGIT_WIDTH)
 
 
 def get_image(barcodes):
@@ -24,92 +60,266 @@ def get_image(barcodes):
                             show_text=True, quiet_zone=False)
 
 
-def build_barcodes_pdf(barcodes):
-    # 36 barcodes per page
-    pages = int(ceil(len(barcodes) / 36.0))
-
-    # assuming N * 8.5in x 11in
-    PAGE_WIDTH = 1275
-    PAGE_HEIGHT = 1650
-
-    # create blank pdfs
-    blanks = [Image.new('RGB', (PAGE_WIDTH, PAGE_HEIGHT), (255, 255, 255))
-              for i in range(pages)]
-
-    # padding set empirically for
-    # Electronic Imaging Materials
-    # Part #80402
-    START_LEFT = 18
-    START_UPPER = 59
-    HORIZ_GAP = 23
-    VERT_GAP = 17
-    BOX_WIDTH = 300
-    BOX_HEIGHT = 150
-
-    # center barcode, assuming barcode images are 300x150px
-    # will adjust per image if 202x100px
-    SHIFT_RIGHT = 0
-    SHIFT_DOWN = 0
-
-    # set starting points
-    cur_left = START_LEFT
-    cur_upper = START_UPPER
-    page = -1
-    idx = 0
-    for i in get_image(barcodes):
-        # if we have 36 barcodes we have filled a page
-        if idx % 36 == 0:
-            page += 1
-            cur_upper = START_UPPER
-            cur_left = START_LEFT
-
-        # verify the barcode is the expected size, shift accordingly
-        width, height = i.size
-        if i.size == (202, 100):
-            SHIFT_RIGHT = 49
-            SHIFT_DOWN = 25
-        elif i.size == (300, 150):
-            SHIFT_RIGHT = 0
-            SHIFT_DOWN = 0
-        else:
-            tmp = "image %s is an unsupported size"
-            raise AttributeError(tmp % i.shape)
-
-        # shift to new row
-        if cur_left + width > PAGE_WIDTH:
-            cur_left = START_LEFT
-            cur_upper = cur_upper + HORIZ_GAP + BOX_HEIGHT
-
-        # paste into the image
-        blanks[page].paste(i, (cur_left + SHIFT_RIGHT, cur_upper + SHIFT_DOWN))
-
-        # shift right
-        cur_left += BOX_WIDTH + VERT_GAP
-
-        idx += 1
-
-    # write out each page
-    tmpdir = "tmp_%s" % ''.join([choice("ABCDEFGHIJKLMNOPQRSTUVWXYZ")
-                                 for i in range(5)])
-    # TODO: leverage python's tempfile module to replace this home brew
-    # mechanism here. See issue: #147.
-    while path.exists(tmpdir):
-        tmpdir = "tmp_%s" % ''.join([choice("ABCDEFGHIJKLMNOPQRSTUVWXYZ")
-                                     for i in range(5)])
-    mkdir(tmpdir)
-
-    temp_pages = "squash_barcode_page_%d.pdf"
-    for page, blank in enumerate(blanks):
-        blank.save(path.join(tmpdir, temp_pages % page), quality=100)
-
-    match_pages = ' '.join([path.join(tmpdir, "squash_barcode_page_%d.pdf" % i)
-                            for i in range(len(blanks))])
-
-    # magically squash all the pages
-    cmd = cmd_split('gs -r150 -q -sPAPERSIZE=a4 -dNOPAUSE -dBATCH' +  # noqa
-                    ' -sDEVICE=pdfwrite -sOutputFile=- %s' % match_pages)
-    p = Popen(cmd, stdout=PIPE)
-    output, _ = p.communicate()
-    rmtree(tmpdir)
-    # return PDF text
-    return output
+def barcodes_pdf_key(barcodes):
+    """Returns a hash identifying the label sheets for the barcodes
+
+    Parameters
+    ----------
+    barcodes : list of str
+        Barcodes to print, in order
+
+    Returns
+    -------
+    str
+        Hex digest covering the barcodes and the label layout
+    """
+    key = sha256(repr(LAYOUT))
+    for barcode in barcodes:
+        key.update('\0%s' % barcode)
+    return key.hexdigest()
+
+
+def _pdf_string(text):
+    return '(%s)' % text.replace('\\', '\\\\').replace(
+        '(', '\\(').replace(')', '\\)')
+
+
+def draw_label(barcode, left, upper):
+    """Returns the PDF drawing operators for a single label
+
+    Parameters
+    ----------
+    barcode : str
+        The barcode to draw
+    left, upper : int
+        Top left corner of the label, in pixels from the top left of the page
+
+    Returns
+    -------
+    list of str
+        PDF operators filling the bars and showing the text. Coordinates
+        are in pixels, with y growing down the page
+
+    Raises
+    ------
+    ValueError
+        The barcode does not fit in the label
+    """
+    widths = code128_widths(barcode, BAR_THICKNESS)
+    barcode_width = sum(widths)
+    if barcode_width > LABEL_WIDTH:
+        tmp = "Calculated width %d smaller than provided width %d"
+        raise ValueError(tmp % (barcode_width, LABEL_WIDTH))
+
+    ops = []
+    x = left + (LABEL_WIDTH - barcode_width) // 2
+    center = x + barcode_width / 2.0
+    draw_bar = True
+    for w in widths:
+        if draw_bar:
+            ops.append('%d %d %d %d re' % (x, upper, w, BAR_HEIGHT))
+        draw_bar = not draw_bar
+        x += w
+    ops.append('f')
+
+    text_width = len(barcode) * DIGIT_WIDTH * FONT_SIZE / 1000.0
+    ops.append('BT /F1 %d Tf 1 0 0 -1 %.1f %d Tm %s Tj ET'
+               % (FONT_SIZE, center - text_width / 2, upper + TEXT_BASELINE,
+                  _pdf_string(barcode)))
+    return ops
+
+
+def build_page(barcodes):
+    """Returns the PDF content stream for a page of labels
+
+    Parameters
+    ----------
+    barcodes : list of str
+        Barcodes on the page, at most LABELS_PER_PAGE
+
+    Returns
+    -------
+    str
+        The page's drawing operators
+    """
+    # draw in pixels from the top left corner of the page
+    scale = 72.0 / DPI
+    ops = ['%g 0 0 %g 0 %g cm' % (scale, -scale, PAGE_HEIGHT * scale)]
+    for idx, barcode in enumerate(barcodes):
+        row, column = divmod(idx, COLUMNS)
+        left = START_LEFT + column * (BOX_WIDTH + VERT_GAP) + SHIFT_RIGHT
+        upper = START_UPPER + row * (BOX_HEIGHT + HORIZ_GAP) + SHIFT_DOWN
+        ops.extend(draw_label(barcode, left, upper))
+    return '\n'.join(ops)
+
+
+def render_page(barcodes):
+    """Returns the compressed content stream for a page of labels
+
+    Parameters
+    ----------
+    barcodes : list of str
+        Barcodes on the page, at most LABELS_PER_PAGE
+
+    Returns
+    -------
+    str
+        The page's drawing operators, deflated
+    """
+    return compress(build_page(barcodes))
+
+
+def _render_pages(pages):
+    return [render_page(p) for p in pages]
+
+
+def _render_ahead(pool, pages, ahead, chunksize):
+    """Yields the rendered pages in order, keeping the pool busy
+
+    At most ahead chunks of chunksize pages are rendered but not yet
+    yielded
+    """
+    pending = deque()
+    chunk = []
+    for page in pages:
+        chunk.append(page)
+        if len(chunk) == chunksize:
+            pending.append(pool.apply_async(_render_pages, (chunk,)))
+            chunk = []
+        if len(pending) > ahead:
+            for data in pending.popleft().get():
+                yield data
+    if chunk:
+        pending.append(pool.apply_async(_render_pages, (chunk,)))
+    while pending:
+        for data in pending.popleft().get():
+            yield data
+
+
+def write_pdf(pages, width, height, write):
+    """Writes a PDF document from page content streams as they come
+
+    Parameters
+    ----------
+    pages : iterable of str
+        Deflated content stream of each page, in order
+    width, height : float
+        Page size in points
+    write : callable
+        Called with each piece of the document, in order
+
+    Notes
+    -----
+    Pages can use the Helvetica font as /F1. Each page is written as soon
+    as it is produced, so only the object offsets are kept for the whole
+    document.
+    """
+    # objects 1 to 3 are the catalog, page tree and font. Pages are objects
+    # 4, 5 for the first page, 6, 7 for the second and so on. The page tree
+    # needs the page count, so it is written last
+    header = '%PDF-1.4\n%\xe2\xe3\xcf\xd3\n'
+    write(header)
+    size = [len(header)]
+    offsets = {}
+
+    def add_object(num, body):
+        offsets[num] = size[0]
+        obj = '%d 0 obj\n%s\nendobj\n' % (num, body)
+        write(obj)
+        size[0] += len(obj)
+
+    add_object(3, '<</Type/Font/Subtype/Type1/BaseFont/Helvetica'
+                  '/Encoding/WinAnsiEncoding>>')
+    num = 4
+    for data in pages:
+        add_object(num, '<</Length %d/Filter/FlateDecode>>\nstream\n%s\n'
+                        'endstream' % (len(data), data))
+        add_object(num + 1, '<</Type/Page/Parent 2 0 R/Contents %d 0 R>>'
+                            % num)
+        num += 2
+    kids = ' '.join('%d 0 R' % i for i in range(5, num, 2))
+    add_object(2, '<</Type/Pages/Kids[%s]/Count %d/MediaBox[0 0 %g %g]'
+                  '/Resources<</Font<</F1 3 0 R>>>>>>'
+                  % (kids, (num - 4) // 2, width, height))
+    add_object(1, '<</Type/Catalog/Pages 2 0 R>>')
+
+    write('xref\n0 %d\n0000000000 65535 f \n' % num)
+    for i in range(1, num):
+        write('%010d 00000 n \n' % offsets[i])
+    write('trailer\n<</Size %d/Root 1 0 R>>\nstartxref\n%d\n%%%%EOF\n'
+          % (num, size[0]))
+
+
+def write_barcodes_pdf(barcodes, write, processes=None, chunksize=8,
+                       pool=None):
+    """Lays barcodes out on label sheets, writing the PDF a page at a time
+
+    Parameters
+    ----------
+    barcodes : list of str
+        Barcodes to print, LABELS_PER_PAGE to a page
+    write : callable
+        Called with each piece of the PDF document, in order. For example
+        the write method of a file or of a request handler
+    processes : int, optional
+        Number of worker processes rendering pages. Default one per CPU
+    chunksize : int, optional
+        Number of pages rendered by a worker at a time. Default 8
+    pool : multiprocessing.Pool, optional
+        Worker processes to render the pages on, instead of starting
+        processes for this call. processes is then how many of them are
+        kept busy
+
+    Notes
+    -----
+    Each page's labels are known up front, so pages are rendered
+    independently by the workers and written out in order. Only a couple
+    of chunks per worker are rendered ahead of the writing, so memory use
+    does not grow with the number of barcodes.
+    """
+    pages = (barcodes[i:i + LABELS_PER_PAGE]
+             for i in range(0, len(barcodes), LABELS_PER_PAGE))
+    width = PAGE_WIDTH * 72.0 / DPI
+    height = PAGE_HEIGHT * 72.0 / DPI
+    if processes is None:
+        processes = cpu_count()
+    own_pool = pool is None
+    if own_pool:
+        num_pages = -(-len(barcodes) // LABELS_PER_PAGE)
+        processes = min(processes, num_pages)
+        if processes <= 1:
+            write_pdf((render_page(p) for p in pages), width, height, write)
+            return
+        pool = Pool(processes)
+
+    try:
+        write_pdf(_render_ahead(pool, pages, processes * 2, chunksize),
+                  width, height, write)
+    finally:
+        if own_pool:
+            pool.close()
+            pool.join()
+
+
+def build_barcodes_pdf(barcodes, processes=None):
+    """Lays barcodes out on label sheets
+
+    Parameters
+    ----------
+    barcodes : list of str
+        Barcodes to print, LABELS_PER_PAGE to a page
+    processes : int, optional
+        Number of worker processes rendering pages. Default one per CPU
+
+    Returns
+    -------
+    str
+        The PDF document
+
+    See Also
+    --------
+    write_barcodes_pdf
+    """
+    pdf = []
+    write_barcodes_pdf(barcodes, pdf.append, processes)
+    return ''.join(pdf)
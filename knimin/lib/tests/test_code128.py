@@ -2,7 +2,7 @@ from unittest import TestCase, main
 from os.path import join, dirname, realpath
 
 import knimin.lib
-from knimin.lib.code128 import code128_format, code128_image
+from knimin.lib.code128 import code128_format, code128_image, code128_widths
 
 
 class Code128Tests(TestCase):
@@ -16,6 +16,14 @@ class Code128Tests(TestCase):
         obs = code128_format(wikipedia_example)
         self.assertEqual(obs, exp)
 
+    def test_code128_widths(self):
+        obs = code128_widths('PJJ123C', 2)
+        # start B is 211214, bars and spaces alternate from a bar
+        self.assertEqual(obs[:6], [4, 2, 2, 4, 2, 8])
+        # stop is 2331112
+        self.assertEqual(obs[-7:], [4, 6, 6, 2, 2, 2, 4])
+        self.assertEqual(len(obs), 6 * 9 + 7)
+
     def test_code128_image(self):
         # use the same font etc as is in use with squash_barcodes
         font = join(dirname(realpath(knimin.lib.__file__)), 'FreeSans.ttf')
@@ -25,6 +33,33 @@ class Code128Tests(TestCase):
         self.assertEqual(im.height, 100)
         self.assertEqual(im.width, 202)
 
+        # the bar row follows the bar widths and is copied down the bars
+        widths = code128_widths('000001234', 2)
+        exp = []
+        for i, w in enumerate(widths):
+            exp.extend([0 if i % 2 == 0 else 255] * w)
+        x = (202 - len(exp)) // 2
+        exp = [255] * x + exp + [255] * (202 - x - len(exp))
+        for y in (0, 75):
+            self.assertEqual([im.getpixel((i, y)) for i in range(202)], exp)
+        self.assertEqual([im.getpixel((i, 76)) for i in range(202)],
+                         [255] * 202)
+
+        # cached strips and font give the same image again
+        again = code128_image('000001234', height=100, width=202,
+                              thickness=2, show_text=True, quiet_zone=False,
+                              font=font)
+        self.assertEqual(again.tobytes(), im.tobytes())
+
+    def test_code128_image_width(self):
+        im = code128_image('1234', height=10, thickness=1)
+        # quiet zones of 10 modules each side of the bars
+        self.assertEqual(im.width, sum(code128_widths('1234', 1)) + 20)
+        self.assertEqual(im.getpixel((9, 0)), 255)
+        self.assertEqual(im.getpixel((10, 0)), 0)
+        self.assertRaisesRegexp(ValueError, "Calculated width",
+                                code128_image, '1234', width=10)
+
 
 if __name__ == '__main__':
     main()
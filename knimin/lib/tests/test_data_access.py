@@ -2,11 +2,16 @@ from unittest import TestCase, main
 from os.path import join, dirname, realpath
 from six import StringIO
 import datetime
+from random import seed
 
 import pandas as pd
 
 from knimin import db
+from knimin.lib.configuration import config
+from knimin.lib.data_access import (KniminAccess, IncorrectEmailError,
+                                    IncorrectPasswordError)
 from knimin.lib.constants import ebi_remove
+from knimin.lib.util import make_kit_ids
 
 
 class TestDataAccess(TestCase):
@@ -169,6 +174,106 @@ class TestDataAccess(TestCase):
         obs = db.search_kits('990001124')
         self.assertEqual([], obs)
 
+    def test_like_term(self):
+        self.assertEqual(db._like_term('tst_ab'), '%tst\\_ab%')
+        self.assertEqual(db._like_term('100%'), '%100\\%%')
+        self.assertEqual(db._like_term('a\\b'), '%a\\\\b%')
+        # wildcards typed by the user must not act as wildcards
+        self.assertEqual(db.search_participant_info('%'), [])
+
+    def test_search_pagination(self):
+        # walking the pages must give the unpaginated results, in order
+        for search in (db.search_participant_info, db.search_kits,
+                       db.search_barcodes):
+            exp = search('a')
+            self.assertEqual(exp, sorted(exp))
+            obs = []
+            page = search('a', limit=2)
+            while page:
+                self.assertLessEqual(len(page), 2)
+                obs.extend(page)
+                page = search('a', after=page[-1], limit=2)
+            self.assertEqual(obs, exp)
+
+        exp = db.search_handout_kits('1')
+        obs = []
+        page = db.search_handout_kits('1', limit=3)
+        while page:
+            obs.extend(page)
+            page = db.search_handout_kits(
+                '1', after=(page[-1]['kit_id'], page[-1]['barcode']),
+                limit=3)
+        self.assertItemsEqual(obs, exp)
+
+    def test_estimate_search_counts(self):
+        obs = db.estimate_search_counts('a')
+        self.assertItemsEqual(obs, ['logins', 'handouts'])
+        self.assertGreater(obs['logins'], 0)
+        self.assertGreaterEqual(obs['handouts'], 0)
+
+    def test_get_typeahead_values(self):
+        barcodes = db.get_typeahead_values('barcode')
+        self.assertEqual(barcodes, sorted(barcodes))
+        self.assertIn('000001124', barcodes)
+        kit_ids = set(db.get_typeahead_values('kit_id'))
+        kit_ids.update(db.get_typeahead_values('handout_kit_id'))
+        self.assertEqual(kit_ids, db.get_used_kit_ids())
+        with self.assertRaises(ValueError):
+            db.get_typeahead_values('foo')
+
+    def test_get_typeahead_changes(self):
+        ag_login_id = 'd8592c74-7cf9-2135-e040-8a80115d6401'
+        login = db.get_login_info(ag_login_id)[0]
+        snapshot, changes = db.get_typeahead_changes()
+        self.assertEqual(changes, [])
+        barcodes = db.create_barcodes(2)
+        try:
+            db.updateAGLogin(ag_login_id, 'Typeahead@example.com',
+                             login['name'], login['address'], login['city'],
+                             login['state'], login['zip'], login['country'])
+            snapshot, changes = db.get_typeahead_changes(snapshot)
+            self.assertEqual(changes,
+                             [('barcode', [], barcodes),
+                              ('email', [login['email']],
+                               ['typeahead@example.com'])])
+            # changes already returned are not returned again
+            self.assertEqual(db.get_typeahead_changes(snapshot)[1], [])
+        finally:
+            db.updateAGLogin(ag_login_id, login['email'], login['name'],
+                             login['address'], login['city'], login['state'],
+                             login['zip'], login['country'])
+            db._con.execute("DELETE FROM barcodes.barcode "
+                            "WHERE barcode IN %s", [tuple(barcodes)])
+
+    def test_search_bundle(self):
+        ag_login_ids = ['d8592c74-7cf9-2135-e040-8a80115d6401',
+                        'd8592c74-9694-2135-e040-8a80115d6401']
+        obs = db.search_bundle(ag_login_ids)
+        self.assertEqual(len(obs), 2)
+
+        # must match what the single-login lookups return
+        for ag_login_id, bundle in zip(ag_login_ids, obs):
+            self.assertEqual(bundle['login_info'],
+                             db.get_login_info(ag_login_id))
+            self.assertItemsEqual(bundle['humans'],
+                                  db.getHumanParticipants(ag_login_id))
+            self.assertItemsEqual(bundle['animals'],
+                                  db.getAnimalParticipants(ag_login_id))
+            kits = db.get_kit_info_by_login(ag_login_id)
+            self.assertItemsEqual([k['ag_kit_id'] for k in bundle['kit']],
+                                  [k['ag_kit_id'] for k in kits])
+            for kit in bundle['kit']:
+                ag_info = db.get_barcode_info_by_kit_id(kit['ag_kit_id'])
+                self.assertItemsEqual(kit['barcode_info'],
+                                      [b['barcode'] for b in ag_info])
+                for barcode, info in kit['barcode_info'].items():
+                    self.assertEqual(info['barcode_info'],
+                                     db.get_barcode_details(barcode))
+                    self.assertEqual(info['plate'],
+                                     db.get_plate_for_barcode(barcode))
+
+        self.assertEqual(db.search_bundle([]), [])
+
     def test_get_barcodes_with_results(self):
         obs = db.get_barcodes_with_results()
         exp = ['000023299']
@@ -219,6 +324,222 @@ class TestDataAccess(TestCase):
         sql = """DELETE FROM ag.labadmin_users WHERE email=%s"""
         db._con.execute(sql, [email])
 
+    def test_get_user_access(self):
+        self.assertIsNone(db.get_user_access('does not exist'))
+
+        db.alter_access_levels('test', [1, 6])
+        self.assertEqual(db.get_user_access('test'),
+                         frozenset(['Barcodes', 'Search']))
+
+        # changes made outside alter_access_levels wait for the ttl
+        sql = "DELETE FROM ag.labadmin_users_access WHERE email = %s"
+        db._con.execute(sql, ['test'])
+        self.assertEqual(db.get_user_access('test'),
+                         frozenset(['Barcodes', 'Search']))
+        ttl = db.access_cache_ttl
+        try:
+            db.access_cache_ttl = 0
+            self.assertEqual(db.get_user_access('test'), frozenset())
+        finally:
+            db.access_cache_ttl = ttl
+
+        # alter_access_levels clears the cached levels
+        db.alter_access_levels('test', [2])
+        self.assertEqual(db.get_user_access('test'), frozenset(['AG kits']))
+        db.alter_access_levels('test', [])
+        self.assertEqual(db.get_user_access('test'), frozenset())
+
+    def test_has_access(self):
+        db.alter_access_levels('test', [6])
+        self.assertTrue(db.has_access('test', ['Search']))
+        self.assertTrue(db.has_access('test', ['AG kits', 'Search']))
+        self.assertFalse(db.has_access('test', ['AG kits']))
+        self.assertFalse(db.has_access('does not exist', ['Search']))
+
+        db.alter_access_levels('test', [7])
+        self.assertTrue(db.has_access('test', ['AG kits']))
+        db.alter_access_levels('test', [])
+        self.assertFalse(db.has_access('test', ['AG kits']))
+
+        with self.assertRaises(ValueError):
+            db.has_access('test', ['Not a level'])
+
+    def test_get_password_hash(self):
+        hashed = db.get_password_hash('test')
+        self.assertTrue(hashed.startswith('$2'))
+        with self.assertRaises(IncorrectEmailError):
+            db.get_password_hash('does not exist')
+
+    def test_check_password(self):
+        hashed = db.get_password_hash('test')
+        self.assertTrue(db.check_password('test', hashed))
+        with self.assertRaises(IncorrectPasswordError):
+            db.check_password('wrong', hashed)
+
+    def test_get_project_summary(self):
+        obs = db.get_project_summary()
+        self.assertEqual([p['project'] for p in obs],
+                         sorted(db.getProjectNames()))
+        for info in obs:
+            self.assertEqual(
+                info['barcodes'],
+                len(db.get_barcodes_for_projects([info['project']])))
+
+        obs = db.get_project_summary(breakdown=True)
+        for info in obs:
+            barcodes = db.get_barcodes_for_projects([info['project']])
+            self.assertEqual(info['barcodes'], len(barcodes))
+            self.assertEqual(sum(info['status'].values()), len(barcodes))
+            self.assertEqual(sum(info['sequencing_status'].values()),
+                             len(barcodes))
+            received = [b for b in barcodes if b['status'] == 'Received']
+            self.assertEqual(info['status'].get('Received', 0),
+                             len(received))
+
+    def test_get_unassigned_barcodes(self):
+        sql = """SELECT barcode FROM barcodes.barcode b
+                 WHERE NOT EXISTS (SELECT 1 FROM barcodes.project_barcode pb
+                                   WHERE pb.barcode = b.barcode)
+                 ORDER BY barcode"""
+        exp = [x[0] for x in db._con.execute_fetchall(sql)]
+        self.assertEqual(db.get_unassigned_barcodes(), exp)
+        self.assertEqual(db.get_unassigned_barcodes(2), exp[:2])
+        self.assertEqual(db.count_unassigned_barcodes(), len(exp))
+        with self.assertRaises(ValueError):
+            db.get_unassigned_barcodes(len(exp) + 1)
+
+    def test_create_barcodes(self):
+        sql = "SELECT max(barcode) FROM barcodes.barcode"
+        newest = db._con.execute_fetchone(sql)[0]
+        barcodes = db.create_barcodes(3)
+        try:
+            self.assertEqual(len(barcodes), 3)
+            self.assertEqual(barcodes, sorted(barcodes))
+            self.assertTrue(all(len(b) == 9 for b in barcodes))
+            self.assertTrue(all(b > newest for b in barcodes))
+            # new barcodes are also in the unassigned inventory
+            sql = """SELECT barcode FROM barcodes.unassigned_barcode
+                     WHERE barcode IN %s ORDER BY barcode"""
+            obs = [x[0] for x in
+                   db._con.execute_fetchall(sql, [tuple(barcodes)])]
+            self.assertEqual(obs, barcodes)
+            # numbers are never handed out twice
+            more = db.create_barcodes(2)
+            barcodes.extend(more)
+            self.assertTrue(all(b > barcodes[2] for b in more))
+        finally:
+            db._con.execute("DELETE FROM barcodes.barcode "
+                            "WHERE barcode IN %s", [tuple(barcodes)])
+
+    def test_create_barcodes_past_nine_digits(self):
+        sql = "SELECT last_value, is_called FROM barcodes.barcode_seq"
+        last_value, is_called = db._con.execute_fetchone(sql)
+        db._con.execute("SELECT setval('barcodes.barcode_seq', 999999998, "
+                        "false)")
+        barcodes = []
+        try:
+            barcodes = db.create_barcodes(2)
+            self.assertEqual(barcodes, ['999999998', '999999999'])
+            with self.assertRaises(ValueError):
+                db.create_barcodes(1)
+        finally:
+            if barcodes:
+                db._con.execute("DELETE FROM barcodes.barcode "
+                                "WHERE barcode IN %s", [tuple(barcodes)])
+            db._con.execute("SELECT setval('barcodes.barcode_seq', %s, %s)",
+                            [last_value, is_called])
+
+    def test_unassigned_barcode_inventory(self):
+        barcode = db.create_barcodes(1)[0]
+        try:
+            self.assertIn(barcode, db.get_unassigned_barcodes())
+            sql = "SELECT project_id FROM barcodes.project LIMIT 1"
+            project_id = db._con.execute_fetchone(sql)[0]
+            sql = """INSERT INTO barcodes.project_barcode (barcode, project_id)
+                     VALUES (%s, %s)"""
+            db._con.execute(sql, [barcode, project_id])
+            self.assertNotIn(barcode, db.get_unassigned_barcodes())
+
+            sql = "DELETE FROM barcodes.project_barcode WHERE barcode = %s"
+            db._con.execute(sql, [barcode])
+            self.assertIn(barcode, db.get_unassigned_barcodes())
+        finally:
+            db._con.execute("DELETE FROM barcodes.project_barcode "
+                            "WHERE barcode = %s", [barcode])
+            db._con.execute("DELETE FROM barcodes.barcode WHERE barcode = %s",
+                            [barcode])
+        self.assertNotIn(barcode, db.get_unassigned_barcodes())
+
+    def test_claim_barcodes_concurrent(self):
+        class Rollback(Exception):
+            pass
+
+        other = KniminAccess(config)
+        exp = db.get_unassigned_barcodes(4)
+        proj_ids = db._get_project_ids(['American Gut Project'])
+        # two open transactions claiming at the same time get different
+        # barcodes instead of blocking or colliding
+        try:
+            with db._con.transaction() as cur:
+                first = db._claim_barcodes(cur, 2, proj_ids)
+                try:
+                    with other._con.transaction() as other_cur:
+                        second = other._claim_barcodes(other_cur, 2,
+                                                       proj_ids)
+                        raise Rollback()
+                except Rollback:
+                    pass
+                raise Rollback()
+        except Rollback:
+            pass
+        self.assertEqual(first, exp[:2])
+        self.assertEqual(second, exp[2:])
+        # rolling back gives the barcodes back
+        self.assertEqual(db.get_unassigned_barcodes(4), exp)
+
+    def test_insert_handout_kits(self):
+        class Rollback(Exception):
+            pass
+
+        seed(3)
+        taken = make_kit_ids(1, tag='tst')[0]
+        sql = "INSERT INTO ag.ag_handout_kits (kit_id) VALUES (%s)"
+        db._con.execute(sql, [taken])
+        try:
+            # the first candidate drawn is taken, so another one is used
+            seed(3)
+            try:
+                with db._con.transaction() as cur:
+                    kit_ids = db._insert_handout_kits(
+                        cur, [['pass', '12345', 3]], 'tst')
+                    cur.execute("""SELECT swabs_per_kit
+                                   FROM ag.ag_handout_kits
+                                   WHERE kit_id = %s""", kit_ids)
+                    self.assertEqual(cur.fetchone()[0], 3)
+                    raise Rollback()
+            except Rollback:
+                pass
+            self.assertEqual(len(kit_ids), 1)
+            self.assertNotEqual(kit_ids[0], taken)
+            self.assertTrue(kit_ids[0].startswith('tst_'))
+
+            seed(3)
+            with self.assertRaises(ValueError):
+                with db._con.transaction() as cur:
+                    db._insert_handout_kits(cur, [['pass', '12345', 3]],
+                                            'tst', max_tries=1)
+        finally:
+            db._con.execute("DELETE FROM ag.ag_handout_kits WHERE kit_id = %s",
+                            [taken])
+
+    def test_assign_barcodes_not_enough(self):
+        remaining = db.count_unassigned_barcodes()
+        with self.assertRaises(ValueError):
+            db.assign_barcodes(remaining + 1, ['American Gut Project'])
+        self.assertEqual(db.count_unassigned_barcodes(), remaining)
+        with self.assertRaises(ValueError):
+            db.assign_barcodes(1, ['not a project'])
+
     def test_get_users(self):
         obs = db.get_users()
         exp = 'test'
@@ -1,5 +1,6 @@
 import unittest
-from knimin.lib.mem_zip import InMemoryZip, extract_zip, sneak_files
+from knimin.lib.mem_zip import (InMemoryZip, StreamingZip, extract_zip,
+                                sneak_files)
 import zipfile
 import os
 import io
@@ -79,5 +80,42 @@ class TestInMemoryZip(unittest.TestCase):
         self.assertEqual(exp, obs)
 
 
+class TestStreamingZip(unittest.TestCase):
+    def test_append(self):
+        chunks = []
+        mem = StreamingZip(chunks.append)
+        mem2 = mem.append('test.txt', iter(['argh', ' ', 'blargh'] * 500))
+        self.assertIs(mem2, mem)
+        mem.append('empty.txt', []).close()
+        self.assertTrue(len(chunks) > 1)
+
+        zhandle = zipfile.ZipFile(io.BytesIO(''.join(chunks)))
+        self.assertIsNone(zhandle.testzip())
+        self.assertEqual(zhandle.namelist(), ['test.txt', 'empty.txt'])
+        self.assertEqual(zhandle.read('test.txt'), 'argh blargh' * 500)
+        self.assertEqual(zhandle.read('empty.txt'), '')
+
+    def test_write_file(self):
+        chunks = []
+        mem = StreamingZip(chunks.append)
+        read = []
+
+        def contents():
+            for chunk in ['argh', ' ', 'blargh']:
+                read.append(chunk)
+                yield chunk
+
+        steps = mem.write_file('test.txt', contents())
+        # nothing is read until the generator is iterated
+        self.assertEqual(read, [])
+        for i, _ in enumerate(steps):
+            self.assertEqual(len(read), i + 1)
+        self.assertEqual(i, 2)
+        mem.close()
+
+        zhandle = zipfile.ZipFile(io.BytesIO(''.join(chunks)))
+        self.assertEqual(zhandle.read('test.txt'), 'argh blargh')
+
+
 if __name__ == '__main__':
     unittest.main()
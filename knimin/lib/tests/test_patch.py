@@ -0,0 +1,62 @@
+from unittest import TestCase, main
+from os.path import join, basename
+from shutil import rmtree
+from tempfile import mkdtemp
+from glob import glob
+
+from knimin import db
+from knimin.lib.patch import (patch_db, get_pending_patches,
+                              get_applied_patches, PATCHES_DIR)
+
+
+class TestPatch(TestCase):
+    def setUp(self):
+        self.patches_dir = mkdtemp()
+        self.names = ['9001_test.sql', '9002_test.sql']
+        with open(join(self.patches_dir, self.names[0]), 'w') as f:
+            f.write("CREATE TABLE ag.labadmin_patch_test (val varchar);\n"
+                    "INSERT INTO ag.labadmin_patch_test VALUES ('100%');\n")
+        with open(join(self.patches_dir, self.names[1]), 'w') as f:
+            f.write("INSERT INTO ag.labadmin_patch_test VALUES ('second');")
+
+    def tearDown(self):
+        rmtree(self.patches_dir)
+        db._con.execute("DROP TABLE IF EXISTS ag.labadmin_patch_test")
+        db._con.execute("DELETE FROM ag.labadmin_patches WHERE patch IN %s",
+                        [tuple(self.names)])
+
+    def test_patch_db(self):
+        obs = get_pending_patches(db._con, self.patches_dir)
+        self.assertEqual(obs, [join(self.patches_dir, n) for n in self.names])
+
+        self.assertEqual(patch_db(db._con, self.patches_dir), self.names)
+        obs = db._con.execute_fetchall(
+            "SELECT val FROM ag.labadmin_patch_test ORDER BY val")
+        self.assertEqual([x[0] for x in obs], ['100%', 'second'])
+        self.assertTrue(set(self.names).issubset(get_applied_patches(db._con)))
+
+        # already applied patches are not run again
+        self.assertEqual(get_pending_patches(db._con, self.patches_dir), [])
+        self.assertEqual(patch_db(db._con, self.patches_dir), [])
+
+    def test_patch_db_failure(self):
+        with open(join(self.patches_dir, self.names[1]), 'w') as f:
+            f.write("INSERT INTO ag.labadmin_patch_test VALUES ('second');\n"
+                    "SELECT * FROM ag.table_does_not_exist;")
+        with self.assertRaises(ValueError):
+            patch_db(db._con, self.patches_dir)
+        # the failed patch is rolled back and still pending
+        self.assertEqual(get_pending_patches(db._con, self.patches_dir),
+                         [join(self.patches_dir, self.names[1])])
+        obs = db._con.execute_fetchall(
+            "SELECT val FROM ag.labadmin_patch_test")
+        self.assertEqual([x[0] for x in obs], ['100%'])
+
+    def test_shipped_patches_applied(self):
+        patch_db(db._con)
+        shipped = {basename(fp) for fp in glob(join(PATCHES_DIR, '*.sql'))}
+        self.assertTrue(shipped.issubset(get_applied_patches(db._con)))
+
+
+if __name__ == '__main__':
+    main()
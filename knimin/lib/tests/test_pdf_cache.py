@@ -0,0 +1,83 @@
+from unittest import TestCase, main
+from os import listdir, remove, stat, utime
+from os.path import join, exists
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from knimin.lib.pdf_cache import PDFCache
+
+
+class TestPDFCache(TestCase):
+    def setUp(self):
+        self.tmp_dir = mkdtemp()
+        self.cache_dir = join(self.tmp_dir, 'pdfs')
+        self.cache = PDFCache(self.cache_dir, 10)
+
+    def tearDown(self):
+        rmtree(self.tmp_dir)
+
+    def test_get_missing(self):
+        self.assertIsNone(self.cache.get('abc'))
+
+    def test_writer(self):
+        with self.cache.writer('abc') as f:
+            f.write('%PDF')
+        path = self.cache.get('abc')
+        self.assertEqual(path, join(self.cache_dir, 'abc.pdf'))
+        with open(path) as f:
+            self.assertEqual(f.read(), '%PDF')
+        self.assertEqual(listdir(self.cache_dir), ['abc.pdf'])
+
+    def test_open(self):
+        self.assertIsNone(self.cache.open('abc'))
+        with self.cache.writer('abc') as f:
+            f.write('%PDF')
+        utime(join(self.cache_dir, 'abc.pdf'), (100, 100))
+        with self.cache.open('abc') as f:
+            # evicted while it is being sent
+            remove(join(self.cache_dir, 'abc.pdf'))
+            self.assertEqual(f.read(), '%PDF')
+        self.assertIsNone(self.cache.open('abc'))
+
+    def test_open_marks_used(self):
+        with self.cache.writer('abc') as f:
+            f.write('%PDF')
+        path = join(self.cache_dir, 'abc.pdf')
+        utime(path, (100, 100))
+        self.cache.open('abc').close()
+        self.assertGreater(stat(path).st_mtime, 100)
+
+    def test_writer_error(self):
+        with self.assertRaises(ValueError):
+            with self.cache.writer('abc') as f:
+                f.write('%PDF')
+                raise ValueError('render failed')
+        self.assertIsNone(self.cache.get('abc'))
+        self.assertEqual(listdir(self.cache_dir), [])
+
+    def test_evict(self):
+        # two 4 byte PDFs fit in the 10 bytes
+        for key, when in (('a', 200), ('b', 100)):
+            with self.cache.writer(key) as f:
+                f.write('1234')
+            utime(join(self.cache_dir, '%s.pdf' % key), (when, when))
+        with self.cache.writer('c') as f:
+            f.write('1234')
+        self.assertFalse(exists(join(self.cache_dir, 'b.pdf')))
+        self.assertIsNotNone(self.cache.get('a'))
+        self.assertIsNotNone(self.cache.get('c'))
+
+    def test_get_marks_used(self):
+        for key in ('a', 'b'):
+            with self.cache.writer(key) as f:
+                f.write('1234')
+            utime(join(self.cache_dir, '%s.pdf' % key), (100, 100))
+        self.cache.get('a')
+        with self.cache.writer('c') as f:
+            f.write('1234')
+        self.assertIsNotNone(self.cache.get('a'))
+        self.assertIsNone(self.cache.get('b'))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,50 +1,17 @@
 from unittest import TestCase, main
-from os.path import join, dirname, realpath
-from os import mkdir, path
-import random
+from multiprocessing import Pool
+from zlib import compress, decompress
 
-from knimin.lib.code128 import code128_image
+from knimin.lib.code128 import code128_widths
 import knimin.lib.squash_barcodes as m
 
 
 class SquashBarcodesTests(TestCase):
     def test_build_barcodes_pdf(self):
-        self.assertIn('%PDF-1.', m.build_barcodes_pdf(['000000011']))
-
-        old_get_image = m.get_image
-
-        # replace get_image method to change behaviour.
-        def mock_get_image1(barcodes):
-            font = join(dirname(realpath(__file__)), '../', 'FreeSans.ttf')
-            for b in barcodes:
-                yield code128_image(b, height=150, width=300, font=font,
-                                    thickness=2, show_text=True,
-                                    quiet_zone=False)
-        m.get_image = mock_get_image1
-        self.assertIn('%PDF-1.', m.build_barcodes_pdf(['000000011']))
-
-        # replace get_image method to change behaviour
-        def mock_get_image2(barcodes):
-            font = join(dirname(realpath(__file__)), '../', 'FreeSans.ttf')
-            for b in barcodes:
-                yield code128_image(b, height=150, width=303, font=font,
-                                    thickness=2, show_text=True,
-                                    quiet_zone=False)
-        m.get_image = mock_get_image2
-        self.assertRaisesRegexp(AttributeError,
-                                "shape",
-                                m.build_barcodes_pdf,
-                                ['000000011'])
-        # reset function
-        m.get_image = old_get_image
-
-    def test_tmpdir(self):
-        # test that a temporary directory cannot collide with an existing one
-        random.seed(7)
-        fake_tmp_dir = 'tmp_IDQBN'
-        if not path.exists(fake_tmp_dir):
-            mkdir(fake_tmp_dir)
-        self.assertTrue(m.build_barcodes_pdf(['000000011']))
+        pdf = m.build_barcodes_pdf(['000000011'])
+        self.assertTrue(pdf.startswith('%PDF-1.'))
+        self.assertTrue(pdf.endswith('%%EOF\n'))
+        self.assertIn('/Count 1/MediaBox[0 0 612 792]', pdf)
 
     def test_get_image(self):
         barcodes = ['008675309', '314159265']
@@ -56,49 +23,87 @@ class SquashBarcodesTests(TestCase):
 
         self.assertEqual(counts, 2)
 
+    def test_draw_label(self):
+        obs = m.draw_label('000000011', 67, 84)
+        widths = code128_widths('000000011', 2)
+        # one rectangle per bar, then the fill and the text
+        self.assertEqual(len(obs), (len(widths) + 1) // 2 + 2)
+        self.assertEqual(obs[0], '67 84 4 76 re')
+        self.assertEqual(obs[-2], 'f')
+        self.assertEqual(obs[-1], 'BT /F1 20 Tf 1 0 0 -1 118.0 177 Tm '
+                                  '(000000011) Tj ET')
+
+        self.assertRaisesRegexp(ValueError, "Calculated width",
+                                m.draw_label, '0' * 40, 0, 0)
+
     def test_build_barcodes_pdf_one_page(self):
         pdf = m.build_barcodes_pdf(['000000011'] * 36)
 
-        self.assertTrue(ONE_PAGE_HEADER in pdf)
+        self.assertIn('/Count 1/', pdf)
 
     def test_build_barcodes_pdf_two_pages(self):
-        pdf = m.build_barcodes_pdf(['000000011'] * 72)
-
-        self.assertTrue(TWO_PAGES_HEADER in pdf)
-
-
-ONE_PAGE_HEADER = """<</Type/Page/MediaBox [0 0 1275 1650]
-/Parent 3 0 R
-/Resources<</ProcSet[/PDF /ImageC]
-/ExtGState 9 0 R
-/XObject 10 0 R
->>
-/Contents 5 0 R
->>
-endobj
-3 0 obj
-"""
-
-TWO_PAGES_HEADER = """<</Type/Page/MediaBox [0 0 1275 1650]
-/Parent 3 0 R
-/Resources<</ProcSet[/PDF /ImageC]
-/ExtGState 9 0 R
-/XObject 10 0 R
->>
-/Contents 5 0 R
->>
-endobj
-11 0 obj
-<</Type/Page/MediaBox [0 0 1275 1650]
-/Parent 3 0 R
-/Resources<</ProcSet[/PDF /ImageC]
-/ExtGState 14 0 R
-/XObject 15 0 R
->>
-/Contents 12 0 R
->>
-endobj
-3 0 obj"""
+        pdf = m.build_barcodes_pdf(['000000011'] * 37)
+
+        self.assertIn('/Count 2/', pdf)
+        self.assertEqual(pdf.count('/Type/Page/'), 2)
+
+    def test_build_barcodes_pdf_processes(self):
+        barcodes = ['%09d' % i for i in range(200)]
+        serial = m.build_barcodes_pdf(barcodes, processes=1)
+        self.assertIn('/Count 6/', serial)
+        self.assertEqual(m.build_barcodes_pdf(barcodes, processes=3), serial)
+
+    def test_write_barcodes_pdf(self):
+        barcodes = ['%09d' % i for i in range(200)]
+        exp = m.build_barcodes_pdf(barcodes, processes=1)
+        for processes in (1, 2):
+            # one piece per object at least, handed over in order
+            out = []
+            m.write_barcodes_pdf(barcodes, out.append, processes, chunksize=1)
+            self.assertTrue(len(out) > 12)
+            self.assertEqual(''.join(out), exp)
+
+    def test_write_barcodes_pdf_pool(self):
+        barcodes = ['%09d' % i for i in range(200)]
+        exp = m.build_barcodes_pdf(barcodes, processes=1)
+        pool = Pool(2)
+        try:
+            out = []
+            m.write_barcodes_pdf(barcodes, out.append, 2, chunksize=1,
+                                 pool=pool)
+            self.assertEqual(''.join(out), exp)
+            # the pool is left running for the next PDF
+            self.assertEqual(pool.apply(len, ['abc']), 3)
+        finally:
+            pool.close()
+            pool.join()
+
+    def test_barcodes_pdf_key(self):
+        key = m.barcodes_pdf_key(['000000011', '000000012'])
+        self.assertEqual(len(key), 64)
+        self.assertEqual(m.barcodes_pdf_key(['000000011', '000000012']), key)
+        self.assertNotEqual(m.barcodes_pdf_key(['000000012', '000000011']),
+                            key)
+        self.assertNotEqual(m.barcodes_pdf_key(['00000001', '1000000012']),
+                            key)
+
+    def test_render_page(self):
+        self.assertEqual(decompress(m.render_page(['000000011'])),
+                         m.build_page(['000000011']))
+
+    def test_write_pdf(self):
+        out = []
+        m.write_pdf([compress('0 0 1 1 re f'), compress('2 2 1 1 re f')],
+                    612, 792, out.append)
+        pdf = ''.join(out)
+        # the cross reference table points at each object
+        xref = pdf[int(pdf.split('startxref\n')[1].split()[0]):]
+        entries = xref.split('\n')[3:9]
+        for num, entry in enumerate(entries, 1):
+            offset = int(entry.split()[0])
+            self.assertTrue(pdf[offset:].startswith('%d 0 obj' % num))
+        self.assertIn('trailer\n<</Size 8/Root 1 0 R>>', pdf)
+        self.assertIn(compress('2 2 1 1 re f'), pdf)
 
 
 if __name__ == '__main__':
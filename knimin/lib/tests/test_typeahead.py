@@ -0,0 +1,113 @@
+from unittest import TestCase, main
+
+from tornado import gen
+from tornado.testing import AsyncTestCase, gen_test
+
+from knimin import db
+from knimin.lib.configuration import config
+from knimin.lib.data_access import KniminAccess
+from knimin.lib.typeahead import PrefixIndex, TypeaheadIndex
+
+
+class TestPrefixIndex(TestCase):
+    def test_search(self):
+        index = PrefixIndex(['abc', 'ABD', 'abe', 'b', '', None])
+        self.assertEqual(len(index), 4)
+        self.assertEqual(index.search('ab'), ['abc', 'ABD', 'abe'])
+        self.assertEqual(index.search('aB', limit=2), ['abc', 'ABD'])
+        self.assertEqual(index.search('abc'), ['abc'])
+        self.assertEqual(index.search('c'), [])
+        self.assertEqual(index.search('abcd'), [])
+
+    def test_update(self):
+        index = PrefixIndex(['a1', 'a3'])
+        index.update(['a2', 'a1'])
+        self.assertEqual(index.search('a'), ['a1', 'a2', 'a3'])
+
+        # large batches are merged in rather than inserted one by one
+        index.update(['a%03d' % i for i in range(100)])
+        self.assertEqual(len(index), 103)
+        obs = index.search('a0')
+        self.assertEqual(obs, ['a%03d' % i for i in range(100)])
+
+    def test_discard(self):
+        index = PrefixIndex(['a1', 'A2', 'a3'])
+        index.discard(['A2', 'a4', None])
+        self.assertEqual(index.search('a'), ['a1', 'a3'])
+        self.assertEqual(len(index), 2)
+
+
+class TestTypeaheadIndex(TestCase):
+    def setUp(self):
+        self.index = TypeaheadIndex(lambda: db)
+
+    def test_search(self):
+        # nothing is found before the indexes are loaded
+        self.assertEqual(self.index.search(''), [])
+        self.index.refresh()
+
+        barcode = db.get_typeahead_values('barcode')[0]
+        self.assertEqual(self.index.search(barcode, ['barcode']), [barcode])
+
+        email = db.get_typeahead_values('email')[0]
+        self.assertIn(email, self.index.search(email[:3].upper(), ['email']))
+
+        obs = self.index.search('', limit=5)
+        self.assertEqual(len(obs), 5)
+
+    def test_search_unknown_kind(self):
+        with self.assertRaises(ValueError):
+            self.index.search('a', ['barcode', 'foo'])
+
+    def test_add(self):
+        self.index.refresh()
+        self.assertEqual(self.index.search('zz_not'), [])
+        self.index.add('handout_kit_id', ['zz_not_a_kit'])
+        self.assertEqual(self.index.search('zz_not'), ['zz_not_a_kit'])
+        # forcing a full reload drops values that are not in the database
+        self.index.refresh(force=True)
+        self.assertEqual(self.index.search('zz_not'), [])
+
+    def test_replace(self):
+        self.index.refresh()
+        email = db.get_typeahead_values('email')[0]
+        self.index.replace('email', [email], ['zz_new@example.com'])
+        self.assertNotIn(email, self.index.search(email, ['email']))
+        self.assertEqual(self.index.search('zz_new', ['email']),
+                         ['zz_new@example.com'])
+
+    def test_refresh_changes(self):
+        self.index.refresh()
+        barcodes = db.create_barcodes(3)
+        try:
+            self.assertEqual(self.index.search(barcodes[0], ['barcode']), [])
+            self.index.refresh()
+            for barcode in barcodes:
+                self.assertEqual(self.index.search(barcode, ['barcode']),
+                                 [barcode])
+        finally:
+            db._con.execute("DELETE FROM barcodes.barcode "
+                            "WHERE barcode IN %s", [tuple(barcodes)])
+        # removed values are dropped too
+        self.index.refresh()
+        self.assertEqual(self.index.search(barcodes[0], ['barcode']), [])
+
+
+class TestTypeaheadIndexStart(AsyncTestCase):
+    @gen_test
+    def test_start(self):
+        index = TypeaheadIndex(lambda: KniminAccess(config),
+                               refresh_interval=0.01)
+        index.start()
+        try:
+            barcode = db.get_typeahead_values('barcode')[0]
+            while not index.search(barcode, ['barcode']):
+                yield gen.sleep(0.01)
+            # the thread keeps its own connection
+            self.assertIsNot(index._db, db)
+        finally:
+            index.stop()
+
+
+if __name__ == '__main__':
+    main()
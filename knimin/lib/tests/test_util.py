@@ -2,13 +2,16 @@
 
 from unittest import TestCase, main
 from StringIO import StringIO
+from multiprocessing import Pool
 from random import seed
 from socket import gaierror
 
 from knimin.lib.util import (combine_barcodes, categorize_age, categorize_etoh,
                              categorize_bmi, correct_bmi, correct_age,
-                             make_valid_kit_ids, get_printout_data, fetch_url,
-                             xhtml_escape_recursive)
+                             make_valid_kit_ids, make_kit_ids,
+                             get_printout_data, fetch_url,
+                             xhtml_escape_recursive, hash_password,
+                             hash_passwords)
 
 
 __author__ = "Adam Robbins-Pianka"
@@ -166,6 +169,61 @@ class UtilTests(TestCase):
         self.assertEqual(result, ['knut_ryqk', 'knut_zbwg', 'knut_dchv'])
         self.assertNotIn(existing_id, result)
 
+    def test_make_kit_ids(self):
+        seed(7)
+        result = make_kit_ids(3, 5, 'knut')
+        self.assertEqual(result, ['knut_hdrb', 'knut_pjbn', 'knut_akbc'])
+
+        # excluded ids are redrawn
+        seed(7)
+        result = make_kit_ids(3, 5, 'knut', exclude={'knut_pjbn'})
+        self.assertEqual(len(set(result)), 3)
+        self.assertNotIn('knut_pjbn', result)
+
+        # the whole id space can be drawn
+        result = make_kit_ids(23, 1)
+        self.assertEqual(sorted(result), list('abcdefghjkmnpqrstuvwxyz'))
+
+        # excluded ids that could be drawn use up the id space
+        result = make_kit_ids(22, 1, exclude={'a', 'knut_a'})
+        self.assertEqual(sorted(result), list('bcdefghjkmnpqrstuvwxyz'))
+
+    def test_make_kit_ids_errors(self):
+        self.assertRaisesRegexp(ValueError,
+                                "More kits requested than possible kit ID com",
+                                make_kit_ids, 23**4 + 1, 5, 'knut')
+        self.assertRaisesRegexp(ValueError,
+                                "More kits requested than possible kit ID com",
+                                make_kit_ids, 23, 1, exclude={'a'})
+
+    def test_hash_password(self):
+        hashed = hash_password('96812490')
+        self.assertTrue(hashed.startswith('$2'))
+        self.assertEqual(hash_password('96812490', hashed), hashed)
+        self.assertNotEqual(hash_password('33422033', hashed), hashed)
+
+    def test_hash_passwords(self):
+        passwords = ['96812490', '33422033', '12345678', '87654321', '1']
+        for processes in (1, 2, None):
+            obs = hash_passwords(passwords, processes)
+            self.assertEqual(len(obs), len(passwords))
+            # order is kept and every password gets its own salt
+            for password, hashed in zip(passwords, obs):
+                self.assertEqual(hash_password(password, hashed), hashed)
+            self.assertEqual(len(set(obs)), len(passwords))
+        self.assertEqual(hash_passwords([]), [])
+
+    def test_hash_passwords_pool(self):
+        passwords = ['96812490', '33422033', '12345678']
+        pool = Pool(2)
+        try:
+            obs = hash_passwords(passwords, pool=pool)
+        finally:
+            pool.close()
+            pool.join()
+        for password, hashed in zip(passwords, obs):
+            self.assertEqual(hash_password(password, hashed), hashed)
+
     def test_get_printout_data(self):
         kitinfo = [["xxx_pggwy", "96812490", "23577",
                     ["000033914", "000033915"]],
@@ -1,7 +1,16 @@
 from unittest import TestCase, main, skipIf
+from copy import copy
+from threading import Event, Lock, Thread
+from time import sleep, time
 import json
 
-from knimin.lib.vioscreen import VioscreenHandler
+from mock import patch
+import requests
+
+from knimin.lib.vioscreen import (VioscreenHandler, VioscreenClient,
+                                  VioscreenError, HostLimiter, _copy_value)
+from knimin.tests.vioscreen_api import (VioscreenStandIn, session_id,
+                                        ENDPOINTS)
 from knimin import config
 
 
@@ -62,7 +71,8 @@ class TestVioscreenHandler(TestCase):
         survey_id = '853df6a15d131b2c'
 
         self.vio.update_status(survey_id, 'Started')
-        sql = '''SELECT * FROM ag.vioscreen_surveys WHERE survey_id = %s'''
+        sql = '''SELECT status, survey_id, pulldown_date
+                 FROM ag.vioscreen_surveys WHERE survey_id = %s'''
 
         res = list(self.vio.sql_handler.execute_fetchone(sql, [survey_id]))
         self.assertEqual(['Started', survey_id, None], res)
@@ -74,6 +84,20 @@ class TestVioscreenHandler(TestCase):
         self.assertEqual(survey_id, res['survey_id'])
         self.assertIsNotNone(res['pulldown_date'])
 
+    @skipIf(skip, "No credentials")
+    def test_update_status_pulled_at(self):
+        survey_id = '853df6a15d131b2c'
+        sql = '''SELECT pulled_at FROM ag.vioscreen_surveys
+                 WHERE survey_id = %s'''
+
+        self.vio.update_status(survey_id, 'Started')
+        started = self.vio.sql_handler.execute_fetchone(sql, [survey_id])[0]
+        self.assertIsNotNone(started)
+
+        self.vio.update_status(survey_id, 'Finished')
+        res = self.vio.sql_handler.execute_fetchone(sql, [survey_id])[0]
+        self.assertGreater(res, started)
+
     @skipIf(skip, "No credentials")
     def test_insert_survey(self):
         survey_id = u'4fa6fd0e4f93adea'
@@ -330,6 +354,477 @@ class TestVioscreenHandler(TestCase):
             for key in data[row].keys():
                 self.assertEqual(res[row][key.lower()], data[row][key])
 
+    @skipIf(skip, "No credentials")
+    def test_store_users(self):
+        survey_ids = {}
+        data = {'foodcomponents': [{u'amount': 0.0,
+                                    u'code': u'acesupot',
+                                    u'description': u'Acesulfame\tK',
+                                    'survey_id': u'dd8445986318aed4',
+                                    u'units': u'mg',
+                                    u'valueType': u'Amount'}],
+                'percentenergy': [], 'mpeds': [], 'eatingpatterns': [],
+                'foodconsumption': [], 'dietaryscore': []}
+        self.vio.store_users([(u'dd8445986318aed4', 's1', 'Finished', data),
+                              (u'4fa6fd0e4f93adea', 's2', 'Started', None)],
+                             survey_ids)
+        self.assertEqual(survey_ids,
+                         {u'dd8445986318aed4': ('s1', 'Finished'),
+                          u'4fa6fd0e4f93adea': ('s2', 'Started')})
+
+        sql = '''SELECT * FROM ag.vioscreen_foodcomponents
+                 WHERE survey_id = %s'''
+        res = self.vio.sql_handler.execute_fetchall(sql,
+                                                    ['dd8445986318aed4'])
+        self.assertEqual(len(res), 1)
+        self.assertEqual(res[0]['description'], 'Acesulfame\tK')
+        res = self.vio.get_sync_state()
+        self.assertEqual(res['4fa6fd0e4f93adea'], ('s2', 'Started'))
+
+        # a new session updates the stored one
+        self.vio.store_users([(u'4fa6fd0e4f93adea', 's3', 'Started', None)],
+                             survey_ids)
+        res = self.vio.get_sync_state()
+        self.assertEqual(res['4fa6fd0e4f93adea'], ('s3', 'Started'))
+
+    @skipIf(skip, "No credentials")
+    def test_store_users_rollback(self):
+        survey_ids = {}
+        data = {'foodcomponents': [], 'percentenergy': [], 'mpeds': [],
+                'eatingpatterns': [], 'foodconsumption': [],
+                'dietaryscore': [{u'lowerLimit': u'not a number',
+                                  u'name': u'Total Vegetables',
+                                  u'score': 5.0,
+                                  'survey_id': u'dd8445986318aed4',
+                                  u'type': u'TotalVegetables',
+                                  u'upperLimit': 5.0}]}
+        with self.assertRaises(ValueError):
+            self.vio.store_users(
+                [(u'dd8445986318aed4', 's1', 'Finished', data)], survey_ids)
+        self.assertEqual(survey_ids, {})
+        self.assertNotIn('dd8445986318aed4', self.vio.get_init_surveys())
+
+    @skipIf(skip, "No credentials")
+    def test_sync_users(self):
+        def fetch_user(username, known):
+            if username == 'error':
+                raise ValueError('Unable to make this query work')
+            if known == ('s1', 'Started'):
+                return None
+            return username, 's1', 'Started', None
+
+        self.vio.fetch_user = fetch_user
+        state = {}
+        obs = self.vio._sync_users(['a', 'error', 'b', 'c'], state, 2)
+        self.assertEqual(obs, ['error'])
+        exp = {'a': ('s1', 'Started'), 'b': ('s1', 'Started'),
+               'c': ('s1', 'Started')}
+        self.assertEqual(state, exp)
+        res = self.vio.get_sync_state()
+        for username in exp:
+            self.assertEqual(res[username], exp[username])
+
+        # unchanged sessions are not stored again
+        self.vio.store_users = None
+        self.assertEqual(self.vio._sync_users(['a', 'b'], state, 2), [])
+
+    @skipIf(skip, "No credentials")
+    def test_sync_users_interrupted(self):
+        def fetch_user(username, known):
+            if username == 'stop':
+                raise KeyboardInterrupt()
+            return username, 's1', 'Started', None
+
+        self.vio.fetch_user = fetch_user
+        self.vio.concurrency = 1
+        state = {}
+        with self.assertRaises(KeyboardInterrupt):
+            self.vio._sync_users(['a', 'stop', 'b'], state, 10)
+        self.assertEqual(state, {'a': ('s1', 'Started')})
+        self.assertEqual(self.vio.get_sync_state()['a'], ('s1', 'Started'))
+
+
+class TestSyncVioscreen(TestCase):
+    tables = ['surveys', 'foodcomponents', 'percentenergy', 'mpeds',
+              'eatingpatterns', 'foodconsumption', 'dietaryscore']
+
+    def setUp(self):
+        VioscreenClient._tokens.clear()
+        self.api = VioscreenStandIn({'u1': 'Finished', 'u2': 'Started',
+                                     'u3': 'Finished'}, seed=1)
+        self.config = copy(config)
+        self.config.vioscreen_url = self.api.start()
+        self.config.vioscreen_rate_limit = 0
+
+    def tearDown(self):
+        self.api.error_rate = 0
+        self.api.token_lifetime = None
+        VioscreenHandler(self.config).flush_vioscreen_db()
+        self.api.stop()
+        VioscreenClient._tokens.clear()
+
+    def _handler(self, concurrency):
+        self.config.vioscreen_concurrency = concurrency
+        vio = VioscreenHandler(self.config)
+        vio._client.backoff = 0.001
+        return vio
+
+    def _dump(self, vio):
+        dump = {}
+        for table in self.tables:
+            sql = 'SELECT * FROM ag.vioscreen_%s' % table
+            rows = vio.sql_handler.execute_fetchall(sql)
+            dump[table] = sorted(
+                [dict(r, pulldown_date=None, pulled_at=None)
+                 if table == 'surveys'
+                 else dict(r) for r in rows])
+        return dump
+
+    def test_sync_vioscreen(self):
+        vio = self._handler(1)
+        self.assertEqual(vio.sync_vioscreen(), [])
+        self.assertEqual(vio.get_sync_state(),
+                         {'u1': (session_id('u1'), 'Finished'),
+                          'u2': (session_id('u2'), 'Started'),
+                          'u3': (session_id('u3'), 'Finished')})
+        dump = self._dump(vio)
+        self.assertEqual(len(dump['foodcomponents']), 6)
+        self.assertEqual(len(dump['dietaryscore']), 4)
+        obs = dump['foodconsumption'][0]['data']
+        exp = self.api.fixture['foodconsumption']['foodConsumption'][0]
+        self.assertEqual(obs, exp['data'])
+
+    def test_sync_vioscreen_concurrent(self):
+        vio = self._handler(1)
+        vio.sync_vioscreen()
+        exp = self._dump(vio)
+        vio.flush_vioscreen_db()
+
+        vio = self._handler(4)
+        self.assertEqual(vio.sync_vioscreen(), [])
+        self.assertEqual(self._dump(vio), exp)
+
+    def test_sync_vioscreen_unreliable(self):
+        vio = self._handler(1)
+        vio.sync_vioscreen()
+        exp = self._dump(vio)
+        vio.flush_vioscreen_db()
+
+        self.api.error_rate = 0.2
+        self.api.token_lifetime = 0.05
+        vio = self._handler(2)
+        self.assertEqual(vio.sync_vioscreen(), [])
+        self.assertEqual(self._dump(vio), exp)
+        stats = vio._client.stats()
+        self.assertGreater(stats['retries'], 0)
+        self.assertGreater(stats['token_refreshes'], 1)
+
+    def test_sync_vioscreen_resume(self):
+        vio = self._handler(1)
+        vio.sync_vioscreen()
+
+        # no session has changed, so only the session lists are pulled
+        requests = self.api.requests
+        self.assertEqual(vio.sync_vioscreen(), [])
+        self.assertEqual(self.api.requests - requests, 3)
+
+        self.api.users['u2'] = 'Finished'
+        requests = self.api.requests
+        vio.sync_vioscreen()
+        self.assertEqual(self.api.requests - requests, 10)
+        self.assertEqual(vio.get_sync_state()['u2'],
+                         (session_id('u2'), 'Finished'))
+
+    def test_sync_vioscreen_new_session(self):
+        vio = self._handler(1)
+        vio.sync_vioscreen()
+        exp = self._dump(vio)
+
+        # finished users can start over. A finished session replaces
+        # their data, and they keep it until then
+        u1 = self.api.new_session('u1', 'Finished')
+        u3 = self.api.new_session('u3', 'Started')
+        self.assertEqual(vio.sync_vioscreen(), [])
+        self.assertEqual(vio.get_sync_state(),
+                         {'u1': (u1, 'Finished'),
+                          'u2': (session_id('u2'), 'Started'),
+                          'u3': (u3, 'Started')})
+        dump = self._dump(vio)
+        for table in self.tables[1:]:
+            self.assertEqual(dump[table], exp[table])
+
+    def test_sync_vioscreen_failed_pull(self):
+        vio = self._handler(1)
+        self.api.users['u2'] = 'Finished'
+        original = vio.get_session_data
+
+        def get_session_data(sessionid, endpoint, raw=False):
+            if sessionid == session_id('u2'):
+                raise ValueError('Unable to make this query work')
+            return original(sessionid, endpoint, raw)
+
+        vio.get_session_data = get_session_data
+        # u2 is not stored as finished without data, so it is retried
+        self.assertEqual(vio.sync_vioscreen(), ['u2'])
+        self.assertNotIn('u2', vio.get_sync_state())
+
+        vio.get_session_data = original
+        self.assertEqual(vio.sync_vioscreen(), [])
+        self.assertEqual(vio.get_sync_state()['u2'],
+                         (session_id('u2'), 'Finished'))
+        rows = self._dump(vio)['foodcomponents']
+        self.assertEqual(len([r for r in rows if r['survey_id'] == 'u2']), 3)
+
+    def test_sync_vioscreen_no_data(self):
+        vio = self._handler(1)
+        original = vio.get_session_data
+
+        def get_session_data(sessionid, endpoint, raw=False):
+            if sessionid == session_id('u1'):
+                raise VioscreenError('Unable to make this query work')
+            return original(sessionid, endpoint, raw)
+
+        vio.get_session_data = get_session_data
+        # an error answer means the session has no data
+        self.assertEqual(vio.sync_vioscreen(), [])
+        self.assertEqual(vio.get_sync_state()['u1'],
+                         (session_id('u1'), 'Finished'))
+        rows = self._dump(vio)['foodcomponents']
+        self.assertEqual([r for r in rows if r['survey_id'] == 'u1'], [])
+
+    def test_sync_vioscreen_raw_payloads(self):
+        vio = self._handler(2)
+        vio.raw_payloads = False
+        vio.sync_vioscreen()
+        exp = self._dump(vio)
+        vio.flush_vioscreen_db()
+
+        vio = self._handler(2)
+        self.assertTrue(vio.raw_payloads)
+        self.assertEqual(vio.sync_vioscreen(), [])
+        self.assertEqual(self._dump(vio), exp)
+
+    def test_store_users_raw_payloads(self):
+        vio = self._handler(1)
+        row = {'amount': 0.1, 'code': 'x', 'description': 'a\tb\\ "c"\n',
+               'units': None, 'valueType': 'Amount'}
+        data = {endpoint: json.dumps({}) for endpoint in ENDPOINTS}
+        data['foodcomponents'] = json.dumps({'data': [row]}, indent=1)
+        data['mpeds'] = json.dumps({'data': {'not': 'rows'}})
+        state = {}
+        vio.store_users([('u1', 's1', 'Finished', data)], state)
+        # the staging table is dropped with the transaction
+        vio.store_users([('u2', 's2', 'Finished', data)], state)
+
+        dump = self._dump(vio)
+        exp = [{'survey_id': u, 'code': 'x', 'description': row['description'],
+                'valuetype': 'Amount', 'amount': 0.1, 'units': None}
+               for u in ('u1', 'u2')]
+        self.assertEqual(dump['foodcomponents'], exp)
+        for table in ENDPOINTS:
+            if table != 'foodcomponents':
+                self.assertEqual(dump[table], [])
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, data):
+        self.status_code = status_code
+        self._data = data
+
+    def json(self):
+        if isinstance(self._data, str):
+            raise ValueError('No JSON object could be decoded')
+        return self._data
+
+    @property
+    def text(self):
+        return self._data
+
+    @property
+    def content(self):
+        if isinstance(self._data, str):
+            return self._data
+        return json.dumps(self._data)
+
+
+class TestVioscreenClient(TestCase):
+    def setUp(self):
+        VioscreenClient._tokens.clear()
+        self.client = VioscreenClient('reg', 'user', 'pw', backoff=0.001)
+        self.sent = []
+        self.responses = []
+        self.tokens = iter(['token1', 'token2', 'token3'])
+
+        def request(method, url, **kwargs):
+            self.sent.append((method, url, kwargs))
+            if url.endswith('/auth/login'):
+                return FakeResponse(200, {'token': next(self.tokens)})
+            response = self.responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            return response
+
+        self.client._session.request = request
+
+    def tearDown(self):
+        VioscreenClient._tokens.clear()
+
+    def test_get(self):
+        self.responses = [FakeResponse(200, {'users': []})]
+        obs = self.client.get('https://api.viocare.com/reg/users')
+        self.assertEqual(obs, {'users': []})
+        self.assertEqual([s[1] for s in self.sent],
+                         ['https://api.viocare.com/reg/auth/login',
+                          'https://api.viocare.com/reg/users'])
+        headers = self.sent[1][2]['headers']
+        self.assertEqual(headers['Authorization'], 'Bearer token1')
+        self.assertEqual(headers['Accept'], 'application/json')
+        self.assertNotIn('Authorization', self.sent[0][2]['headers'])
+
+    def test_get_raw(self):
+        self.responses = [FakeResponse(200, {'users': []})]
+        obs = self.client.get('https://api.viocare.com/reg/users', raw=True)
+        self.assertEqual(obs, '{"users": []}')
+
+    def test_token_expired(self):
+        self.responses = [FakeResponse(400, {'Code': 1016}),
+                          FakeResponse(200, {'users': []})]
+        obs = self.client.get('https://api.viocare.com/reg/users')
+        self.assertEqual(obs, {'users': []})
+        self.assertEqual(self.sent[-1][2]['headers']['Authorization'],
+                         'Bearer token2')
+        stats = self.client.stats()
+        self.assertEqual(stats['requests'], 4)
+        self.assertEqual(stats['retries'], 1)
+        self.assertEqual(stats['token_refreshes'], 2)
+
+    def test_token_shared(self):
+        other = VioscreenClient('reg', 'user', 'pw')
+        VioscreenClient._tokens[('reg', 'user')] = ('token0', time())
+        self.assertEqual(other.token(), 'token0')
+        self.assertEqual(self.client.token(), 'token0')
+        # a token another client already replaced is not replaced again
+        self.assertEqual(self.client.token(stale='old'), 'token0')
+        self.assertEqual(self.sent, [])
+
+    def test_token_lock_per_account(self):
+        other = VioscreenClient('reg2', 'user', 'pw')
+        logging_in = Event()
+        release = Event()
+
+        def request(method, url, **kwargs):
+            logging_in.set()
+            release.wait(5)
+            return FakeResponse(200, {'token': 'other'})
+
+        other._session.request = request
+        thread = Thread(target=other.token)
+        thread.start()
+        try:
+            self.assertTrue(logging_in.wait(5))
+            # a slow login to one account does not hold up another
+            self.assertEqual(self.client.token(), 'token1')
+            self.assertTrue(thread.is_alive())
+        finally:
+            release.set()
+            thread.join()
+        self.assertEqual(VioscreenClient._tokens[('reg2', 'user')][0],
+                         'other')
+
+    def test_token_max_age(self):
+        VioscreenClient._tokens[('reg', 'user')] = ('token0', time() - 1801)
+        self.assertEqual(self.client.token(), 'token1')
+
+    def test_backoff(self):
+        self.responses = [FakeResponse(503, 'Service Unavailable'),
+                          requests.ConnectionError('reset'),
+                          FakeResponse(200, {'users': []})]
+        with patch('knimin.lib.vioscreen.sleep') as sleep_mock:
+            obs = self.client.get('https://api.viocare.com/reg/users')
+        self.assertEqual(obs, {'users': []})
+        self.assertEqual(sleep_mock.call_count, 2)
+        first, second = [c[0][0] for c in sleep_mock.call_args_list]
+        self.assertTrue(0 <= first <= 0.001)
+        self.assertTrue(0 <= second <= 0.002)
+        self.assertEqual(self.client.stats()['retries'], 2)
+
+    def test_retries_exhausted(self):
+        self.client.retries = 2
+        self.responses = [FakeResponse(500, {'Message': 'error'})] * 2
+        with self.assertRaises(ValueError) as e:
+            self.client.get('https://api.viocare.com/reg/users')
+        self.assertNotIsInstance(e.exception, VioscreenError)
+        self.assertEqual(len(self.sent), 3)
+
+    def test_connection_error(self):
+        self.client.retries = 2
+        self.responses = [requests.ConnectionError('reset')] * 2
+        with self.assertRaisesRegexp(ValueError, 'reset') as e:
+            self.client.get('https://api.viocare.com/reg/users')
+        self.assertNotIsInstance(e.exception, VioscreenError)
+
+    def test_error(self):
+        self.responses = [FakeResponse(404, {'Message': 'Not found'})]
+        with self.assertRaises(VioscreenError):
+            self.client.get('https://api.viocare.com/reg/users/x/sessions')
+        self.assertEqual(self.client.stats()['retries'], 0)
+
+
+class TestCopyValue(TestCase):
+    def test_copy_value(self):
+        self.assertEqual(_copy_value(None), '\\N')
+        self.assertEqual(_copy_value(29.5868480021635), '29.5868480021635')
+        self.assertEqual(_copy_value(52), '52')
+        self.assertEqual(_copy_value(u'a\tb\nc\\d'), 'a\\tb\\nc\\\\d')
+        self.assertEqual(_copy_value(u'A\xf1adido'), 'A\xc3\xb1adido')
+        self.assertEqual(_copy_value([{'units': 'mg'}]), '[{"units": "mg"}]')
+
+
+class TestHostLimiter(TestCase):
+    def _run(self, limiter, urls):
+        lock = Lock()
+        state = {'running': {}, 'most': {}, 'starts': []}
+
+        def request(url):
+            with limiter(url):
+                with lock:
+                    running = state['running'].get(url, 0) + 1
+                    state['running'][url] = running
+                    state['most'][url] = max(state['most'].get(url, 0),
+                                             running)
+                    state['starts'].append(time())
+                sleep(0.02)
+                with lock:
+                    state['running'][url] -= 1
+
+        threads = [Thread(target=request, args=(url,)) for url in urls]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return state
+
+    def test_concurrency(self):
+        limiter = HostLimiter(2, 0)
+        urls = ['https://a.example.com/x'] * 6 + ['https://b.example.com/y']
+        state = self._run(limiter, urls)
+        self.assertEqual(state['most'], {'https://a.example.com/x': 2,
+                                         'https://b.example.com/y': 1})
+
+    def test_rate(self):
+        limiter = HostLimiter(5, 50)
+        state = self._run(limiter, ['https://a.example.com/x'] * 5)
+        starts = sorted(state['starts'])
+        # five requests at 50 a second take at least 4 intervals to start
+        self.assertGreaterEqual(starts[-1] - starts[0], 0.075)
+
+    def test_rate_per_host(self):
+        limiter = HostLimiter(5, 1)
+        start = time()
+        self._run(limiter, ['https://a.example.com/x',
+                            'https://b.example.com/x'])
+        self.assertLess(time() - start, 0.5)
+
 
 if __name__ == "__main__":
     main()
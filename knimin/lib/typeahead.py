@@ -0,0 +1,249 @@
+"""In-memory prefix indexes for typeahead lookups
+
+Operators mostly type partial barcodes, kit IDs and emails. Rather than
+running a query per keystroke, the identifiers are held in sorted lists in
+memory and prefix lookups are answered with a binary search.
+"""
+from bisect import bisect_left, insort
+from heapq import merge
+from threading import Lock
+from time import time
+
+from concurrent.futures import ThreadPoolExecutor
+from tornado.ioloop import PeriodicCallback
+
+
+class PrefixIndex(object):
+    """Sorted set of strings answering case insensitive prefix lookups
+
+    Parameters
+    ----------
+    values : iterable of str, optional
+        Initial contents of the index
+    """
+    def __init__(self, values=()):
+        self._entries = []
+        self._members = set()
+        self.update(values)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def update(self, values):
+        """Adds values to the index, ignoring empty and known ones
+
+        Parameters
+        ----------
+        values : iterable of str
+            Values to add
+        """
+        new = sorted({(v.lower(), v) for v in values if v} - self._members)
+        if not new:
+            return
+        if len(new) < 64:
+            for entry in new:
+                insort(self._entries, entry)
+        else:
+            self._entries = list(merge(self._entries, new))
+        self._members.update(new)
+
+    def discard(self, values):
+        """Removes values from the index, ignoring unknown ones
+
+        Parameters
+        ----------
+        values : iterable of str
+            Values to remove
+        """
+        for entry in {(v.lower(), v) for v in values if v} & self._members:
+            del self._entries[bisect_left(self._entries, entry)]
+            self._members.remove(entry)
+
+    def search(self, prefix, limit=None):
+        """Returns the values starting with prefix, ignoring case
+
+        Parameters
+        ----------
+        prefix : str
+            Start of the values to find
+        limit : int, optional
+            Maximum number of values to return. Default None (all)
+
+        Returns
+        -------
+        list of str
+            Matching values, sorted case insensitively
+        """
+        prefix = prefix.lower()
+        entries = self._entries
+        found = []
+        i = bisect_left(entries, (prefix,))
+        while i < len(entries) and entries[i][0].startswith(prefix):
+            if limit is not None and len(found) >= limit:
+                break
+            found.append(entries[i][1])
+            i += 1
+        return found
+
+
+class TypeaheadIndex(object):
+    """Prefix indexes over barcodes, kit IDs, handout kit IDs and emails
+
+    Parameters
+    ----------
+    connect : callable
+        Returns the KniminAccess the indexes are loaded with. It is called
+        by the thread refreshing the indexes, so it gets its own connection
+    refresh_interval : int, optional
+        Seconds between checks for changed identifiers. Default 30
+    reload_interval : int, optional
+        Seconds between full reloads of every index. Default 3600
+
+    Notes
+    -----
+    Once `start` is called the indexes are loaded and kept up to date on a
+    background thread, so lookups never wait on the database. Each refresh
+    applies the changes logged since the previous one, whether they were
+    made by labadmin or american-gut-web. Changes made through labadmin
+    can also be pushed with `add` and `replace` so they show up right away.
+    An email shared by several logins is dropped from the index when one
+    of them changes it, until the next full reload.
+    """
+    kinds = ('barcode', 'kit_id', 'handout_kit_id', 'email')
+
+    def __init__(self, connect, refresh_interval=30, reload_interval=3600):
+        self._connect = connect
+        self._db = None
+        self.refresh_interval = refresh_interval
+        self.reload_interval = reload_interval
+        self._indexes = {kind: PrefixIndex() for kind in self.kinds}
+        self._lock = Lock()
+        self._snapshot = None
+        self._reloaded = None
+        self._executor = None
+        self._callback = None
+        self._refreshing = None
+
+    def _reload(self):
+        snapshot = self._db.get_typeahead_changes()[0]
+        self._db.prune_typeahead_changes()
+        indexes = {kind: PrefixIndex(self._db.get_typeahead_values(kind))
+                   for kind in self.kinds}
+        with self._lock:
+            self._indexes = indexes
+            self._snapshot = snapshot
+
+    def _apply_changes(self):
+        snapshot, changes = self._db.get_typeahead_changes(self._snapshot)
+        with self._lock:
+            for kind, old_values, new_values in changes:
+                self._indexes[kind].discard(old_values)
+                self._indexes[kind].update(new_values)
+            self._snapshot = snapshot
+
+    def refresh(self, force=False):
+        """Brings the indexes up to date, waiting on the database
+
+        Parameters
+        ----------
+        force : bool, optional
+            Fully reload every index now. Default False
+        """
+        now = time()
+        if self._db is None:
+            self._db = self._connect()
+        try:
+            if force or self._snapshot is None or \
+                    now - self._reloaded >= self.reload_interval:
+                self._reload()
+                self._reloaded = now
+            else:
+                self._apply_changes()
+        except Exception:
+            # reconnect next time in case the connection was lost
+            self._db = None
+            raise
+
+    def _schedule(self):
+        if self._refreshing is None or self._refreshing.done():
+            self._refreshing = self._executor.submit(self.refresh)
+
+    def start(self):
+        """Loads the indexes and refreshes them every refresh interval
+
+        The indexes are loaded on a background thread, and lookups find
+        nothing until the first load finishes. Must be called on the thread
+        of the IOLoop running the server.
+        """
+        self._executor = ThreadPoolExecutor(1)
+        self._schedule()
+        self._callback = PeriodicCallback(self._schedule,
+                                          self.refresh_interval * 1000)
+        self._callback.start()
+
+    def stop(self):
+        """Stops refreshing the indexes"""
+        self._callback.stop()
+        self._executor.shutdown()
+
+    def add(self, kind, values):
+        """Adds values created through labadmin to an index
+
+        Parameters
+        ----------
+        kind : {'barcode', 'kit_id', 'handout_kit_id', 'email'}
+            The index to add to
+        values : iterable of str
+            The new values
+        """
+        with self._lock:
+            self._indexes[kind].update(values)
+
+    def replace(self, kind, old_values, new_values):
+        """Replaces values changed through labadmin in an index
+
+        Parameters
+        ----------
+        kind : {'barcode', 'kit_id', 'handout_kit_id', 'email'}
+            The index to change
+        old_values : iterable of str
+            The values to remove
+        new_values : iterable of str
+            The values to add in their place
+        """
+        with self._lock:
+            self._indexes[kind].discard(old_values)
+            self._indexes[kind].update(new_values)
+
+    def search(self, prefix, kinds=None, limit=20):
+        """Returns the values of the given kinds starting with prefix
+
+        Parameters
+        ----------
+        prefix : str
+            Start of the values to find, case insensitive
+        kinds : list of str, optional
+            Indexes to search. Default all of them
+        limit : int, optional
+            Maximum number of values to return. Default 20
+
+        Returns
+        -------
+        list of str
+            Matching values, sorted case insensitively
+
+        Raises
+        ------
+        ValueError
+            Unknown kind passed
+        """
+        if kinds is None:
+            kinds = self.kinds
+        unknown = set(kinds) - set(self.kinds)
+        if unknown:
+            raise ValueError('Unknown typeahead kinds: %s' %
+                             ', '.join(sorted(unknown)))
+        found = set()
+        for kind in kinds:
+            found.update(self._indexes[kind].search(prefix, limit))
+        return sorted(found, key=lambda v: (v.lower(), v))[:limit]
@@ -1,7 +1,9 @@
 from random import choice
 from StringIO import StringIO
+from multiprocessing import Pool, cpu_count
 import time
 
+from bcrypt import hashpw, gensalt
 from tornado.httpclient import HTTPClient, HTTPError
 from tornado.escape import xhtml_escape
 
@@ -84,6 +86,22 @@ def combine_barcodes(cli_barcodes=None, input_file=None):
 def get_printout_data(kitinfo):
     """Produce the text for paper slips with kit credentials & mapping table
     """
+    return ''.join(iter_printout_data(kitinfo))
+
+
+def iter_printout_data(kitinfo):
+    """Produce the paper slip text one kit at a time
+
+    Parameters
+    ----------
+    kitinfo : iterable of tuple
+        The kits, in the form (kit_id, password, verification_code, barcodes)
+
+    Returns
+    -------
+    generator of str
+        The text of each kit's slip. Joined, they give get_printout_data
+    """
     BASE_PRINTOUT_TEXT = """Thank you for participating in the American Gut \
 Project! Below you will find your sample barcodes (the numbers that \
 anonymously link your samples to you) and your login credentials. It is very \
@@ -98,8 +116,9 @@ The American Gut Project
     password = 1
     bcs = 3
 
-    text = []
-    for kit in kitinfo:
+    for n, kit in enumerate(kitinfo):
+        # slips are separated by a newline
+        text = [''] if n else []
         text.append(BASE_PRINTOUT_TEXT)
         barcodes = kit[bcs]
 
@@ -120,22 +139,22 @@ The American Gut Project
         for i in range(padding_lines):
             text.append('')
 
-    return '\n'.join(text)
+        yield '\n'.join(text)
 
 
-def make_valid_kit_ids(num_ids, obs_kit_ids, kit_id_length=5, tag=None):
-    """Generates new unique kit IDs
+def make_kit_ids(num_ids, kit_id_length=5, tag=None, exclude=()):
+    """Generates distinct random kit IDs
 
     Parameters
     ----------
     num_ids : int
         Number of kit IDs to create
-    obs_kit_ids : set
-        Already used kit IDs in the database
     kit_id_length : int, optional
         number of characters in base kit_id created, default 5. Must be <= 9
     tag : str, optional
         tag to prepend to kit_id, defaut none. Maximum 4 characters
+    exclude : set, optional
+        Kit IDs that must not be returned. Default none
 
     Returns
     -------
@@ -146,15 +165,14 @@ def make_valid_kit_ids(num_ids, obs_kit_ids, kit_id_length=5, tag=None):
     ------
     ValueError
         Tag is more than 4 characters long
-        More kits requested than possible kit ID combinations
+        More kits requested than possible kit ID combinations, less the
+        excluded ones
 
     Notes
     -----
-    If id length is > 9, it will be set to 9. This length includes the
-    passed kit_id_length + tag length + 1 for an underscore seperator.
-    Because of this, kit_id_length should be kept short.
+    The database is not checked, so the IDs may already be in use. See
+    `make_valid_kit_ids` for the length limits.
     """
-
     if tag is not None:
         if len(tag) > 4:
             raise ValueError("Tag must be 4 or less characters")
@@ -165,7 +183,11 @@ def make_valid_kit_ids(num_ids, obs_kit_ids, kit_id_length=5, tag=None):
     else:
         tag = ''
 
-    if num_ids > len(KIT_ALPHA)**kit_id_length:
+    # only excluded IDs that could be drawn use up combinations
+    id_length = len(tag) + kit_id_length
+    excluded = sum(1 for kit_id in exclude
+                   if len(kit_id) == id_length and kit_id.startswith(tag))
+    if num_ids + excluded > len(KIT_ALPHA)**kit_id_length:
         raise ValueError("More kits requested than possible kit ID combos!")
 
     def make_kit_id(kit_id_length, tag):
@@ -175,13 +197,50 @@ def make_valid_kit_ids(num_ids, obs_kit_ids, kit_id_length=5, tag=None):
 
     # Create the new kit IDs
     new_ids = []
+    seen = set()
     for i in range(num_ids):
         kit_id = make_kit_id(kit_id_length, tag)
-        while kit_id in obs_kit_ids:
+        while kit_id in seen or kit_id in exclude:
             kit_id = make_kit_id(kit_id_length, tag)
         new_ids.append(kit_id)
-        obs_kit_ids.add(kit_id)
+        seen.add(kit_id)
+
+    return new_ids
+
+
+def make_valid_kit_ids(num_ids, obs_kit_ids, kit_id_length=5, tag=None):
+    """Generates new unique kit IDs
+
+    Parameters
+    ----------
+    num_ids : int
+        Number of kit IDs to create
+    obs_kit_ids : set
+        Already used kit IDs in the database
+    kit_id_length : int, optional
+        number of characters in base kit_id created, default 5. Must be <= 9
+    tag : str, optional
+        tag to prepend to kit_id, defaut none. Maximum 4 characters
+
+    Returns
+    -------
+    list
+        New kit IDs created
+
+    Raises
+    ------
+    ValueError
+        Tag is more than 4 characters long
+        More kits requested than possible kit ID combinations
 
+    Notes
+    -----
+    If id length is > 9, it will be set to 9. This length includes the
+    passed kit_id_length + tag length + 1 for an underscore seperator.
+    Because of this, kit_id_length should be kept short.
+    """
+    new_ids = make_kit_ids(num_ids, kit_id_length, tag, exclude=obs_kit_ids)
+    obs_kit_ids.update(new_ids)
     return new_ids
 
 
@@ -199,6 +258,74 @@ def make_verification_code(vercode_length=5):
     return choice(KIT_VERCODE_NOZEROS) + x
 
 
+def hash_password(password, hashedpw=None):
+    """Hashes a password with bcrypt
+
+    Parameters
+    ----------
+    password: str
+        Plaintext password
+    hashedpw: str, optional
+        Previously hashed password for bcrypt to pull salt from. If not
+        given, salt generated before hash
+
+    Returns
+    -------
+    str
+        Hashed password
+    """
+    # all the encode/decode as a python 3 workaround for bcrypt
+    if hashedpw is None:
+        hashedpw = gensalt()
+    else:
+        hashedpw = hashedpw.encode('utf-8')
+    password = password.encode('utf-8')
+    output = hashpw(password, hashedpw)
+    if isinstance(output, bytes):
+        output = output.decode("utf-8")
+    return output
+
+
+def hash_passwords(passwords, processes=None, pool=None):
+    """Hashes many passwords, each with a fresh salt, in parallel
+
+    Parameters
+    ----------
+    passwords : iterable of str
+        Plaintext passwords
+    processes : int, optional
+        Number of worker processes. Default one per CPU
+    pool : multiprocessing.Pool, optional
+        Worker processes to hash on, instead of starting processes for this
+        call. processes is then ignored
+
+    Returns
+    -------
+    list of str
+        Hashed passwords, in the same order as passwords
+
+    Notes
+    -----
+    bcrypt is deliberately CPU bound, so hashing thousands of kit passwords
+    one after the other is limited by a single core.
+    """
+    passwords = list(passwords)
+    if pool is not None:
+        return pool.map(hash_password, passwords)
+    if processes is None:
+        processes = cpu_count()
+    processes = min(processes, len(passwords))
+    if processes <= 1:
+        return [hash_password(p) for p in passwords]
+
+    pool = Pool(processes)
+    try:
+        return pool.map(hash_password, passwords)
+    finally:
+        pool.close()
+        pool.join()
+
+
 def categorize_age(x):  # noqa
     if x == 'Unspecified':
         return 'Unspecified'
@@ -1,30 +1,407 @@
 import requests
-import os
 import json
+import re
 
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
-from functools import partial
+from itertools import izip
+from random import uniform
+from cStringIO import StringIO
+from threading import BoundedSemaphore, Lock
+from time import sleep, time
+from urlparse import urlparse
+
+from requests.adapters import HTTPAdapter
 from knimin import config
 from knimin.lib.data_access import SQLHandler
 
+# data pulled for each finished session, and the key holding its rows
+SESSION_ENDPOINTS = (('foodcomponents', ('data',)),
+                     ('percentenergy', ('calculations',)),
+                     ('mpeds', ('data',)),
+                     ('eatingpatterns', ('data',)),
+                     ('foodconsumption', ('foodConsumption',)),
+                     ('dietaryscore', ('dietaryScore', 'scores')))
+
+# columns of each ag.vioscreen_* table, named as in the API's rows
+VIOSCREEN_COLUMNS = {
+    'foodcomponents': ('amount', 'code', 'description', 'survey_id',
+                       'units', 'valueType'),
+    'percentenergy': ('amount', 'code', 'description', 'foodComponentType',
+                      'foodDataDefinition', 'precision', 'shortDescription',
+                      'survey_id', 'units'),
+    'mpeds': ('amount', 'code', 'description', 'survey_id', 'units',
+              'valueType'),
+    'eatingpatterns': ('amount', 'code', 'description', 'survey_id',
+                       'units', 'valueType'),
+    'foodconsumption': ('amount', 'consumptionAdjustment', 'created', 'data',
+                        'description', 'foodCode', 'foodGroup', 'frequency',
+                        'servingFrequencyText', 'servingSizeText',
+                        'survey_id'),
+    'dietaryscore': ('lowerLimit', 'name', 'score', 'survey_id', 'type',
+                     'upperLimit')}
+
+# type of the API's fields stored as something other than varchar
+_FIELD_TYPES = {'amount': 'double precision',
+                'consumptionAdjustment': 'double precision',
+                'data': 'jsonb', 'foodComponentType': 'integer',
+                'frequency': 'integer', 'lowerLimit': 'double precision',
+                'precision': 'integer', 'score': 'double precision',
+                'upperLimit': 'double precision'}
+
+
+def _derive_sql(table):
+    """SQL inserting the rows of the staged payloads of an endpoint"""
+    fields = [c for c in VIOSCREEN_COLUMNS[table] if c != 'survey_id']
+    return """INSERT INTO ag.vioscreen_{0} (survey_id, {1})
+              SELECT p.survey_id, {2}
+              FROM vioscreen_payloads p, jsonb_to_recordset(
+                  CASE jsonb_typeof(p.payload #> %(path)s)
+                  WHEN 'array' THEN p.payload #> %(path)s END) AS r({3})
+              WHERE p.endpoint = %(endpoint)s""".format(
+        table, ', '.join(fields), ', '.join('r."%s"' % f for f in fields),
+        ', '.join('"%s" %s' % (f, _FIELD_TYPES.get(f, 'varchar'))
+                  for f in fields))
+
+
+_DERIVE_SQL = {table: _derive_sql(table) for table in VIOSCREEN_COLUMNS}
+
+_COPY_SPECIAL = re.compile(r'[\\\t\n\r]')
+
+
+def _copy_value(value):
+    """Formats a value for COPY's text format"""
+    if value is None:
+        return '\\N'
+    if isinstance(value, float):
+        # repr keeps every digit, str rounds to 12
+        return repr(value)
+    if isinstance(value, (int, long)):
+        return str(value)
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    elif isinstance(value, (dict, list)):
+        value = json.dumps(value)
+    else:
+        value = str(value)
+    if _COPY_SPECIAL.search(value) is None:
+        return value
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace(
+        '\n', '\\n').replace('\r', '\\r')
+
+
+class HostLimiter(object):
+    """Limits how many requests are made to each host, and how often
+
+    Parameters
+    ----------
+    concurrency : int
+        Most requests to a host at once
+    rate : float
+        Most requests to a host a second. 0 for no limit
+
+    Notes
+    -----
+    Use as ``with limiter(url):`` around each request. It is shared by all
+    the threads making requests.
+    """
+    def __init__(self, concurrency, rate):
+        self.concurrency = concurrency
+        self.interval = 1.0 / rate if rate > 0 else 0
+        self._lock = Lock()
+        self._slots = defaultdict(lambda: BoundedSemaphore(concurrency))
+        self._next = defaultdict(float)
+
+    def _wait(self, host):
+        """Seconds to wait before the next request to host may start"""
+        with self._lock:
+            now = time()
+            start = max(now, self._next[host])
+            self._next[host] = start + self.interval
+        return start - now
+
+    @contextmanager
+    def __call__(self, url):
+        host = urlparse(url).netloc
+        with self._lock:
+            slots = self._slots[host]
+        with slots:
+            if self.interval:
+                sleep(self._wait(host))
+            yield
+
+
+def _error_body(response):
+    """The JSON body of an error response, or its text if it is not JSON"""
+    try:
+        return response.json()
+    except ValueError:
+        return response.text
+
+
+class VioscreenError(ValueError):
+    """The vioscreen API answered a request with an error"""
+    pass
+
+
+class VioscreenClient(object):
+    """HTTP client for the vioscreen API
+
+    Parameters
+    ----------
+    regcode : str
+        Registration code of the account
+    user, password : str
+        Credentials of the account
+    url : str, optional
+        Address of the API. Default https://api.viocare.com
+    concurrency : int, optional
+        Most requests to the API at once. Default 4
+    rate : float, optional
+        Most requests to the API a second. Default 0, no limit
+    retries : int, optional
+        Tries a request gets before giving up. Default 5
+    backoff : float, optional
+        Seconds the first retry waits at most, doubling for each retry after
+        it. Default 0.5
+    max_backoff : float, optional
+        Most seconds a retry waits. Default 30
+    token_max_age : float, optional
+        Seconds a token is used before a new one is requested. Default 1800
+    timeout : float, optional
+        Seconds to wait for the API to answer. Default 60
+
+    Notes
+    -----
+    Tokens are shared by every client of the same account, including those
+    on other threads. They are renewed once they reach token_max_age, or
+    when the API rejects one as expired (code 1016). Connections are kept
+    alive and reused, a connection per concurrent request. Failed requests
+    are retried after a random wait that grows exponentially when the API
+    is down or busy (connection errors, 429 and 5xx responses).
+    """
+    # {(regcode, user): (token, time it was issued)}
+    _tokens = {}
+    # {(regcode, user): Lock held while logging in to the account}
+    _token_locks = {}
+    _tokens_lock = Lock()
+
+    def __init__(self, regcode, user, password,
+                 url='https://api.viocare.com', concurrency=4, rate=0,
+                 retries=5, backoff=0.5, max_backoff=30, token_max_age=1800,
+                 timeout=60):
+        self.regcode = regcode
+        self.user = user
+        self.password = password
+        self.url = url.rstrip('/')
+        self.concurrency = max(concurrency, 1)
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.token_max_age = token_max_age
+        self.timeout = timeout
+
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=self.concurrency)
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
+        self._limiter = HostLimiter(self.concurrency, rate)
+        self._stats_lock = Lock()
+        self._stats = {'requests': 0, 'retries': 0, 'token_refreshes': 0,
+                       'seconds': 0.0, 'max_seconds': 0.0}
+
+    def _count(self, name, value=1):
+        with self._stats_lock:
+            self._stats[name] += value
+
+    def stats(self):
+        """Returns the counters of the requests made so far
+
+        Returns
+        -------
+        dict
+            Number of requests, retries and token refreshes, and the total,
+            mean and longest seconds the requests took
+        """
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['mean_seconds'] = (stats['seconds'] / stats['requests']
+                                 if stats['requests'] else 0.0)
+        return stats
+
+    def token(self, stale=None):
+        """Returns a token for the API
+
+        Parameters
+        ----------
+        stale : str, optional
+            Token the API rejected. A new token is requested unless another
+            thread already replaced it
+
+        Returns
+        -------
+        str
+            The API token
+
+        Raises
+        ------
+        ValueError
+            If the token request was not successful
+        """
+        key = (self.regcode, self.user)
+        with self._tokens_lock:
+            lock = self._token_locks.setdefault(key, Lock())
+        # held while logging in, so threads needing a token of the account
+        # wait for a single login without blocking other accounts
+        with lock:
+            cached = self._tokens.get(key)
+            if cached is not None and cached[0] != stale and \
+                    time() - cached[1] < self.token_max_age:
+                return cached[0]
+            url = '%s/%s/auth/login' % (self.url, self.regcode)
+            response = self.request('post', url, authenticate=False,
+                                    data={"username": self.user,
+                                          "password": self.password})
+            if 'token' not in response:
+                raise ValueError('Token request not successful')
+            self._count('token_refreshes')
+            self._tokens[key] = (response['token'], time())
+            return response['token']
+
+    def _send(self, method, url, **kwargs):
+        with self._limiter(url):
+            start = time()
+            try:
+                return self._session.request(method, url, **kwargs)
+            finally:
+                seconds = time() - start
+                with self._stats_lock:
+                    self._stats['requests'] += 1
+                    self._stats['seconds'] += seconds
+                    self._stats['max_seconds'] = max(
+                        self._stats['max_seconds'], seconds)
+
+    def _wait(self, attempt):
+        """Sleeps before retrying, unless it was the last attempt"""
+        if attempt + 1 < self.retries:
+            sleep(uniform(0, min(self.max_backoff,
+                                 self.backoff * 2 ** attempt)))
+
+    def _attempt(self, method, url, attempt, authenticate, headers, kwargs):
+        """Makes a request once
+
+        Returns
+        -------
+        tuple of (bool, object)
+            Whether the request succeeded, and the response or the reason
+            it should be retried
+        """
+        token = None
+        if authenticate:
+            token = self.token()
+            headers['Authorization'] = 'Bearer %s' % token
+        try:
+            response = self._send(method, url, headers=headers, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt + 1 == self.retries:
+                raise ValueError("Unable to make this query work: %s"
+                                 % str(e))
+            self._wait(attempt)
+            return False, e
+        if response.status_code == 200:
+            return True, response
+
+        data = _error_body(response)
+        if authenticate and isinstance(data, dict) and \
+                data.get('Code') == 1016:
+            # the token expired, retry straight away with a new one
+            self.token(stale=token)
+        elif response.status_code == 429 or response.status_code >= 500:
+            self._wait(attempt)
+        else:
+            raise VioscreenError("Unable to make this query work: %s"
+                                 % str(data))
+        return False, data
+
+    def request(self, method, url, authenticate=True, raw=False, **kwargs):
+        """Makes a request to the API, retrying it if it fails
+
+        Parameters
+        ----------
+        method: str
+            HTTP method, either 'get' or 'post'
+        url: str
+            The url from which data is requested
+        authenticate: bool, optional
+            Whether to send the API token. Default True
+        raw: bool, optional
+            Return the body of the response as is instead of decoding its
+            JSON. Default False
+        **kwargs
+            Optional arguments that requests takes
+
+        Return
+        ------
+        dict or str
+            Data returned from HTTP request
+
+        Raises
+        ------
+        VioscreenError
+            If the API answered with an error
+        ValueError
+            If the request still failed after all the retries
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        headers = {'Accept': 'application/json'}
+        headers.update(kwargs.pop('headers', None) or {})
+        for attempt in range(self.retries):
+            if attempt:
+                self._count('retries')
+            done, data = self._attempt(method, url, attempt, authenticate,
+                                       headers, kwargs)
+            if done:
+                return data.content if raw else data.json()
+        raise ValueError("Unable to make this query work: %s" % str(data))
+
+    def get(self, url, **kwargs):
+        """GET request to the API, see request"""
+        return self.request('get', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        """POST request to the API, see request"""
+        return self.request('post', url, **kwargs)
+
 
 class VioscreenHandler(object):
     """VioScreen handler object.
 
     Used to pull data from VioScreen RESTful API and store data in AG database.
+
+    Parameters
+    ----------
+    config: KniminConfig, optional
+        Settings of the API and the AG database. Default the labadmin
+        configuration
     """
-    def __init__(self):
+    def __init__(self, config=config):
         self._key = config.vioscreen_regcode
         self._user = config.vioscreen_user
         self._pw = config.vioscreen_password
 
-        self._session = requests.Session()
-        # define partial functions for get and post
-        self.get = partial(self.request, self._session.get)
-        self.post = partial(self.request, self._session.post)
-        # setup our HTTP header data
-        self._headers = {'Accept': 'application/json',
-                         'Authorization': 'Bearer %s' % self.get_token()}
+        self._client = VioscreenClient(
+            self._key, self._user, self._pw, url=config.vioscreen_url,
+            concurrency=config.vioscreen_concurrency,
+            rate=config.vioscreen_rate_limit)
+        self.concurrency = self._client.concurrency
+        self.raw_payloads = config.vioscreen_raw_payloads
+        self._base = '%s/%s' % (self._client.url, self._key)
+        self.get = self._client.get
+        self.post = self._client.post
+        # setup our HTTP header data, the client adds the token
+        self._headers = {'Accept': 'application/json'}
         self._users = self.get_users()
         self.sql_handler = SQLHandler(config)
 
@@ -41,13 +418,7 @@ class VioscreenHandler(object):
         ValueError
             If the post returned None
         """
-        url = 'https://api.viocare.com/%s/auth/login' % self._key
-        response = self.post(url,
-                             data={"username": self._user,
-                                   "password": self._pw})
-        if 'token' not in response:
-            raise ValueError('Token request not successful')
-        return response['token']
+        return self._client.token()
 
     def get_users(self):
         """Gets list of users that vioscreen has data for
@@ -57,47 +428,7 @@ class VioscreenHandler(object):
         list of dict
             List of users that have vioscreen data
         """
-        return self.get('https://api.viocare.com/%s/users' % self._key,
-                        headers=self._headers)
-
-    def request(self, func, url, retries=5, **kwargs):
-        """Extension of get  and post methods from requests.
-        Will make a request for data and return it, or return an
-        error message if data was unable to be retrieved
-
-        Parameters
-        ----------
-        func: function
-            requests function being called, either GET or POST
-        url: str
-            The url from which data is requested
-        retries: int
-            Number of tries the function takes if we refresh the token
-            each time a retrieval fails
-        **kwargs
-            Optional arguments that requests takes
-
-        Return
-        ------
-        dict
-            Data returned from HTTP request
-        """
-        for i in range(retries):
-            req = func(url, **kwargs)
-            if req.status_code != 200:  # HTTP status code, 200 is all good
-                data = req.json()
-
-                # if we did not get a HTTP status code 200, than guess that the
-                # API token is no longer valid so get a new one and retry
-                if 'Code' in data and data['Code'] == 1016:
-                    self._headers['token'] = self.get_token()
-                else:
-                    raise ValueError("Unable to make this query work: %s\n%s"
-                                     % (str(data),
-                                        str(sorted(os.environ.keys()))))
-            else:
-                return req.json()
-        raise ValueError("Unable to make this query work")
+        return self.get('%s/users' % self._base, headers=self._headers)
 
     def tidyfy(self, username, payload):
         """Restructures data so that 'survey_id' is associated with each row
@@ -120,7 +451,7 @@ class VioscreenHandler(object):
             dat.append(entry)
         return dat
 
-    def get_session_data(self, session_id, endpoint):
+    def get_session_data(self, session_id, endpoint, raw=False):
         """Pulls data from the vioscreen API based on
         a specific session ID and session type(ex. 'foodcomponents')
 
@@ -130,18 +461,123 @@ class VioscreenHandler(object):
             Session ID that data is being requested for
         endpoint: str
             Name of the session type that data is being requested for
+        raw: bool, optional
+            Return the JSON as received instead of decoding it.
+            Default False
 
         Return
         ------
-        dict:
+        dict or str:
             Food frequency questionnaire data
         """
-        url = 'https://api.viocare.com/%s/sessions/%s/%s' % (self._key,
-                                                             session_id,
-                                                             endpoint)
-        return self.get(url, headers=self._headers)
+        url = '%s/sessions/%s/%s' % (self._base, session_id, endpoint)
+        return self.get(url, headers=self._headers, raw=raw)
+
+    def fetch_user(self, username, known=None):
+        """Pulls a user's latest session from the vioscreen API
+
+        Parameters
+        ----------
+        username: str
+            User (survey ID) to pull
+        known: tuple of (str, str), optional
+            Session ID and status stored for the user by the last sync
+
+        Return
+        ------
+        tuple of (str, str, str, dict or None) or None
+            The username, the session ID, the session status and the
+            session data by endpoint, ready to insert. With raw_payloads
+            the data of each endpoint is the JSON received, undecoded. The
+            data is None unless the session is finished and has data. None
+            if the session list shows the known session with the known
+            status
+        """
+        url = '%s/users/%s/sessions' % (self._base, username)
+        session_data = self.get(url, headers=self._headers)
+        session_detail = session_data['sessions'][0]
+        sessionid = session_detail['sessionId']
+        if known is not None and \
+                known == (sessionid, session_detail.get('status')):
+            return None
+
+        url = '%s/sessions/%s/detail' % (self._base, sessionid)
+        detail = self.get(url, headers=self._headers)
+        status = detail['status']
+
+        # only finished surveys will have their data pulled
+        if status != 'Finished':
+            return username, sessionid, status, None
+
+        data = {}
+        try:
+            for endpoint, keys in SESSION_ENDPOINTS:
+                if self.raw_payloads:
+                    data[endpoint] = self.get_session_data(
+                        sessionid, endpoint, raw=True)
+                    continue
+                rows = self.get_session_data(sessionid, endpoint)
+                for key in keys:
+                    rows = rows[key]
+                data[endpoint] = self.tidyfy(username, rows)
+        except VioscreenError:
+            # sometimes there is a status Finished w/o data... Requests
+            # that failed are raised, so the user is pulled again next time
+            return username, sessionid, status, None
+        return username, sessionid, status, data
+
+    def _fetch(self, username, known):
+        """fetch_user, returning the error instead of raising it"""
+        try:
+            return self.fetch_user(username, known)
+        except (ValueError, KeyError, IndexError,
+                requests.RequestException) as e:
+            return e
+
+    def _fetch_users(self, usernames, state):
+        """Yields fetch_user for each user, in order
+
+        Users are fetched concurrently, at most self.concurrency at a time
+        and a few ahead of the ones yielded, so results come in the same
+        order as fetching them one after another. A user that could not be
+        fetched gives the error instead.
+        """
+        if self.concurrency == 1:
+            for username in usernames:
+                yield self._fetch(username, state.get(username))
+            return
+
+        pending = deque()
+        with ThreadPoolExecutor(self.concurrency) as executor:
+            for username in usernames:
+                pending.append(executor.submit(self._fetch, username,
+                                               state.get(username)))
+                if len(pending) > self.concurrency * 2:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def _sync_users(self, usernames, state, batch_size):
+        """Fetches and stores users, returning the ones that failed"""
+        failures = []
+        batch = []
+        try:
+            for username, user in izip(usernames,
+                                       self._fetch_users(usernames, state)):
+                if isinstance(user, Exception):
+                    failures.append(username)
+                elif user is not None:
+                    batch.append(user)
+                if len(batch) == batch_size:
+                    users, batch = batch, []
+                    self.store_users(users, state)
+        finally:
+            # keep what was fetched if the sync is interrupted
+            if batch:
+                self.store_users(batch, state)
+        return failures
 
-    def sync_vioscreen(self, user_ids=None):
+    def sync_vioscreen(self, user_ids=None, batch_size=50):
         """Pulls data from the vioscreen API and stores
         the data into the AG database
 
@@ -150,6 +586,24 @@ class VioscreenHandler(object):
         user_ids: set of str
             Set of user_ids (identical to survey_ids) that
             are needed to have their data pulled. Default None (syncs all)
+        batch_size: int, optional
+            Number of users stored in each transaction. Default 50
+
+        Return
+        ------
+        list of str
+            The user_ids without vioscreen data, and the users that could
+            not be pulled this time
+
+        Notes
+        -----
+        Each user's session ID and status are stored with their data, so an
+        interrupted sync resumes where it stopped, and users whose session
+        has not changed since the last sync are not pulled again. Only the
+        session list of those users is requested. When a user's new session
+        has data, it replaces the data of the old session. Users whose data
+        could not be pulled are not stored, so they are pulled again by the
+        next sync.
         """
         all_vio_user_ids = {x['username'] for x in self._users['users']}
         failures = []
@@ -160,75 +614,13 @@ class VioscreenHandler(object):
         else:
             user_ids = all_vio_user_ids
 
-        # takes all survey IDs from vio_screen survey info and filters
-        # only ones that do not have their data in the ag database
-        ids_to_sync = self.get_vio_survey_ids_not_in_ag(user_ids)
-
-        # gets list of surveys in AG database along with their statuses
-        survey_ids = self.get_init_surveys()
-
-        for username in ids_to_sync:
-            url = 'https://api.viocare.com/%s/users/%s/sessions' % (self._key,
-                                                                    username)
-            session_data = self.get(url, headers=self._headers)
-            session_detail = session_data['sessions'][0]
-            sessionid = session_detail['sessionId']
-
-            url = 'https://api.viocare.com/%s/sessions/%s/detail' % (self._key,
-                                                                     sessionid)
-            detail = self.get(url, headers=self._headers)
-
-            # Adds new survey information to database
-            if username not in survey_ids:
-                survey_ids[username] = detail['status']
-                self.insert_survey(username, detail['status'])
-            # Updates status of vioscreen survey if it has changed
-            elif survey_ids[username] != detail['status']:
-                survey_ids[username] = detail['status']
-                self.update_status(username, detail['status'])
-
-            # only finished surveys will have their data pulled
-            if detail['status'] != 'Finished':
-                continue
-
-            try:
-                foodcomponents = self.get_session_data(sessionid,
-                                                       'foodcomponents')
-                percentenergy = self.get_session_data(sessionid,
-                                                      'percentenergy')
-                mpeds = self.get_session_data(sessionid,
-                                              'mpeds')
-                eatingpatterns = self.get_session_data(sessionid,
-                                                       'eatingpatterns')
-                foodconsumption = self.get_session_data(sessionid,
-                                                        'foodconsumption')
-                dietaryscore = self.get_session_data(sessionid,
-                                                     'dietaryscore')
-            except ValueError:
-                # sometimes there is a status Finished w/o data...
-                continue
-
-            dietaryscore = dietaryscore['dietaryScore']['scores']
-            foodconsumption = foodconsumption['foodConsumption']
-            mpeds = mpeds['data']
-            eatingpatterns = eatingpatterns['data']
-            percentenergy = percentenergy['calculations']
-            foodcomponents = foodcomponents['data']
-
-            foodcomponents = self.tidyfy(username, foodcomponents)
-            percentenergy = self.tidyfy(username, percentenergy)
-            mpeds = self.tidyfy(username, mpeds)
-            eatingpatterns = self.tidyfy(username, eatingpatterns)
-            foodconsumption = self.tidyfy(username, foodconsumption)
-            dietaryscore = self.tidyfy(username, dietaryscore)
-
-            self.insert_foodcomponents(foodcomponents)
-            self.insert_percentenergy(percentenergy)
-            self.insert_mpeds(mpeds)
-            self.insert_eatingpatterns(eatingpatterns)
-            self.insert_foodconsumption(foodconsumption)
-            self.insert_dietaryscore(dietaryscore)
+        # gets the session and status of the surveys in the AG database.
+        # Finished surveys are checked too, as a user can start a new
+        # session after finishing one
+        state = self.get_sync_state()
 
+        failures.extend(self._sync_users(sorted(user_ids), state,
+                                         batch_size))
         return failures
 
     # DB access functions
@@ -247,7 +639,33 @@ class VioscreenHandler(object):
             survey_ids[row[0]] = row[1]
         return survey_ids
 
-    def update_status(self, survey_id, status):
+    def get_sync_state(self):
+        """Retrieve the session and status of each vioscreen survey
+
+        Returns
+        -------
+        dict of tuple of (str, str)
+           Survey IDs and the session ID and status stored by the last sync
+        """
+        sql = """SELECT survey_id, session_id, status
+                 FROM ag.vioscreen_surveys"""
+        return {row[0]: (row[1], row[2])
+                for row in self.sql_handler.execute_fetchall(sql)}
+
+    def _update_status(self, cur, survey_id, status, session_id=None):
+        pulled_at = datetime.now()
+        if status == 'Finished':
+            pulldown_date = pulled_at
+        else:
+            pulldown_date = None
+        sql = """UPDATE ag.vioscreen_surveys SET status=%s,
+                 pulldown_date=%s, pulled_at=%s,
+                 session_id=COALESCE(%s, session_id)
+                 WHERE survey_id=%s"""
+        cur.execute(sql, [status, pulldown_date, pulled_at, session_id,
+                          survey_id])
+
+    def update_status(self, survey_id, status, session_id=None):
         """Updates vioscreen status of AG database to correspond to status
            pulled from vioscreen
 
@@ -257,16 +675,26 @@ class VioscreenHandler(object):
             Survey ID being updated in database
         status: str
             Status that the survey ID status is being updated to
+        session_id: str, optional
+            Session the status was read from. Default keep the stored one
+
+        Notes
+        -----
+        pulldown_date is only set for finished surveys, pulled_at records
+        the time of every update
         """
-        if status == 'Finished':
-            pulldown_date = datetime.now()
-        else:
-            pulldown_date = None
-        sql = """UPDATE ag.vioscreen_surveys SET status=%s,
-                 pulldown_date=%s WHERE survey_id=%s"""
-        self.sql_handler.execute(sql, [status, pulldown_date, survey_id])
+        with self.sql_handler.transaction() as cur:
+            self._update_status(cur, survey_id, status, session_id)
 
-    def insert_survey(self, survey_id, status):
+    def _insert_survey(self, cur, survey_id, status, session_id=None):
+        pulldown_date = datetime.now()
+        sql = """INSERT INTO ag.vioscreen_surveys (status, survey_id,
+                 pulldown_date, pulled_at, session_id)
+                 VALUES (%s, %s, %s, %s, %s)"""
+        cur.execute(sql, [status, survey_id, pulldown_date, pulldown_date,
+                          session_id])
+
+    def insert_survey(self, survey_id, status, session_id=None):
         """Inserts a survey id that has a vioscreen session along with its
            status ('Started', 'Finished', etc.) and pulldown date into the
            ag.vioscreen_surveys table
@@ -277,11 +705,11 @@ class VioscreenHandler(object):
             Survey ID being inserted into vioscreen survey database
         status: str
             Status that the survey ID is being inserted with
+        session_id: str, optional
+            Session the status was read from
         """
-        pulldown_date = datetime.now()
-        sql = """INSERT INTO ag.vioscreen_surveys (status, survey_id,
-                 pulldown_date) VALUES (%s, %s, %s)"""
-        self.sql_handler.execute(sql, [status, survey_id, pulldown_date])
+        with self.sql_handler.transaction() as cur:
+            self._insert_survey(cur, survey_id, status, session_id)
 
     def get_vio_survey_ids_not_in_ag(self, vio_ids):
         """Retrieve survey ids that have vioscreen data but
@@ -304,15 +732,16 @@ class VioscreenHandler(object):
         ag_survey_ids = {i[0] for i in ag_survey_ids}
         return vio_ids - set(ag_survey_ids)
 
-    def _call_sql_handler(self, sql, session_data):
-        """Formats session_data to insert into a particular table
+    def _copy_rows(self, cur, table, rows):
+        """Bulk loads session data into a table with COPY
 
         Parameters
         ----------
-        sql: str
-            SQL query specific to particular session insertion
-            session_data : Data pulled from Vioscreen
-        session_data: list of dict
+        cur: psycopg2.cursor
+            Cursor of the transaction to load the rows in
+        table: str
+            Table to load, without the ag.vioscreen_ prefix
+        rows: list of dict
             The data that is being stored into the AG database
 
         Return
@@ -320,17 +749,99 @@ class VioscreenHandler(object):
         int
             The number of rows added to the database
         """
-        # inserts represents the data of a session to be stored
-        inserts = []
-        keys = sorted(session_data[0].keys())
-        for row in session_data:
-            # row_insert represents the data of a single row
-            row_insert = []
-            for key in keys:
-                row_insert.append(row[key])
-            inserts.append(row_insert)
-        self.sql_handler.executemany(sql, inserts)
-        return len(inserts)
+        columns = VIOSCREEN_COLUMNS[table]
+        data = StringIO(''.join(
+            ['\t'.join([_copy_value(row[c]) for c in columns]) + '\n'
+             for row in rows]))
+        cur.copy_expert('COPY ag.vioscreen_%s (%s) FROM STDIN'
+                        % (table, ', '.join(columns)), data)
+        return len(rows)
+
+    def _derive_rows(self, cur, payloads):
+        """Inserts the rows of session data received as JSON
+
+        Parameters
+        ----------
+        cur: psycopg2.cursor
+            Cursor of the transaction to insert the rows in
+        payloads: list of tuple of (str, str, str)
+            The survey ID, the endpoint and the JSON received from it
+
+        Notes
+        -----
+        The JSON is loaded into a staging table with COPY and split into
+        the rows of each table by postgres, so it is never decoded in
+        python. The staging table is dropped when the transaction ends.
+        """
+        cur.execute("""CREATE TEMP TABLE vioscreen_payloads (
+                           survey_id varchar, endpoint varchar,
+                           payload jsonb) ON COMMIT DROP""")
+        data = StringIO(''.join(
+            ['\t'.join([_copy_value(v) for v in payload]) + '\n'
+             for payload in payloads]))
+        cur.copy_expert('COPY vioscreen_payloads FROM STDIN', data)
+        for endpoint, keys in SESSION_ENDPOINTS:
+            cur.execute(_DERIVE_SQL[endpoint],
+                        {'path': list(keys), 'endpoint': endpoint})
+
+    def _delete_rows(self, cur, survey_ids):
+        """Removes the session data of surveys from every table"""
+        if not survey_ids:
+            return
+        for endpoint, _ in SESSION_ENDPOINTS:
+            cur.execute("""DELETE FROM ag.vioscreen_{0}
+                           WHERE survey_id = ANY(%s)""".format(endpoint),
+                        [survey_ids])
+
+    def _insert_rows(self, table, rows):
+        with self.sql_handler.transaction() as cur:
+            return self._copy_rows(cur, table, rows)
+
+    def store_users(self, users, state):
+        """Stores the statuses and session data of several users at once
+
+        Parameters
+        ----------
+        users: list of tuple
+            The users, as returned by fetch_user
+        state: dict
+            Survey IDs in the AG database and their session and status, as
+            returned by get_sync_state. Updated with the users' sessions
+            once they are stored
+
+        Notes
+        -----
+        Everything is written in a single transaction, one COPY per table,
+        so either all of the users are stored or none of them are. Data
+        received as JSON is split into rows by _derive_rows. Users already
+        in the AG database whose new session has data have the rows of
+        their previous session removed first, other users keep them.
+        """
+        with self.sql_handler.transaction() as cur:
+            self._delete_rows(cur, [user[0] for user in users
+                                    if user[0] in state and user[3]])
+            for username, session_id, status, _ in users:
+                # Adds new survey information to database
+                if username not in state:
+                    self._insert_survey(cur, username, status, session_id)
+                # Updates status of vioscreen survey if it has changed
+                elif state[username] != (session_id, status):
+                    self._update_status(cur, username, status, session_id)
+            payloads = []
+            for endpoint, _ in SESSION_ENDPOINTS:
+                rows = []
+                for username, _, _, data in users:
+                    if not data:
+                        continue
+                    if isinstance(data[endpoint], str):
+                        payloads.append((username, endpoint, data[endpoint]))
+                    else:
+                        rows.extend(data[endpoint])
+                self._copy_rows(cur, endpoint, rows)
+            if payloads:
+                self._derive_rows(cur, payloads)
+        for username, session_id, status, _ in users:
+            state[username] = (session_id, status)
 
     def insert_foodcomponents(self, foodcomponents):
         """Inserts foodcomponents data into AG database
@@ -345,10 +856,7 @@ class VioscreenHandler(object):
         int
             The number of rows added to the database
         """
-        sql = """INSERT INTO ag.vioscreen_foodcomponents (amount, code,
-                 description, survey_id, units, valueType) VALUES (%s,
-                 %s, %s, %s, %s, %s)"""
-        return self._call_sql_handler(sql, foodcomponents)
+        return self._insert_rows('foodcomponents', foodcomponents)
 
     def insert_percentenergy(self, percentenergy):
         """Inserts percentenergy data into AG database
@@ -363,12 +871,7 @@ class VioscreenHandler(object):
         int
             The number of rows added to the database
         """
-        sql = """INSERT INTO ag.vioscreen_percentenergy
-                    (amount, code, description, foodComponentType,
-                     foodDataDefinition, precision, shortDescription,
-                     survey_id, units)
-                 VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)"""
-        return self._call_sql_handler(sql, percentenergy)
+        return self._insert_rows('percentenergy', percentenergy)
 
     def insert_mpeds(self, mpeds):
         """Inserts mpeds data into AG database
@@ -383,11 +886,7 @@ class VioscreenHandler(object):
         int
             The number of rows added to the database
         """
-        sql = """INSERT INTO ag.vioscreen_mpeds
-                    (amount, code, description, survey_id,
-                     units, valueType)
-                 VALUES (%s, %s, %s, %s, %s, %s)"""
-        return self._call_sql_handler(sql, mpeds)
+        return self._insert_rows('mpeds', mpeds)
 
     def insert_eatingpatterns(self, eatingpatterns):
         """Inserts eatingpatterns data into AG database
@@ -402,11 +901,7 @@ class VioscreenHandler(object):
         int
             The number of rows added to the database
         """
-        sql = """INSERT INTO ag.vioscreen_eatingpatterns
-                    (amount, code, description,
-                     survey_id, units, valueType)
-                 VALUES (%s, %s, %s, %s, %s, %s)"""
-        return self._call_sql_handler(sql, eatingpatterns)
+        return self._insert_rows('eatingpatterns', eatingpatterns)
 
     def insert_foodconsumption(self, foodconsumption):
         """Inserts foodconsumption data into AG database
@@ -421,15 +916,10 @@ class VioscreenHandler(object):
         int
             The number of rows added to the database
         """
-        sql = """INSERT INTO ag.vioscreen_foodconsumption
-                    (amount, consumptionAdjustment, created, data, description,
-                     foodCode, foodGroup, frequency, servingFrequencyText,
-                     servingSizeText, survey_id)
-                 VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"""
         # convert large data dict to json for data storage
         for row in foodconsumption:
             row['data'] = json.dumps(row['data'])
-        return self._call_sql_handler(sql, foodconsumption)
+        return self._insert_rows('foodconsumption', foodconsumption)
 
     def insert_dietaryscore(self, dietaryscore):
         """Inserts dietaryscore data into AG database
@@ -444,11 +934,7 @@ class VioscreenHandler(object):
         int
             The number of rows added to the database
         """
-        sql = """INSERT INTO ag.vioscreen_dietaryscore
-                    (lowerLimit, name, score, survey_id,
-                     type, upperLimit)
-                 VALUES (%s, %s, %s, %s, %s, %s)"""
-        return self._call_sql_handler(sql, dietaryscore)
+        return self._insert_rows('dietaryscore', dietaryscore)
 
     # Testing function
     def flush_vioscreen_db(self):
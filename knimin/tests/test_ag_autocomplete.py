@@ -0,0 +1,68 @@
+from unittest import main
+from json import loads
+
+from knimin.tests.tornado_test_base import TestHandlerBase
+from knimin import db, typeahead
+
+
+class TestAGAutocompleteHandler(TestHandlerBase):
+    def setUp(self):
+        super(TestAGAutocompleteHandler, self).setUp()
+        typeahead.refresh()
+
+    def test_get_not_authed(self):
+        response = self.get('/ag_autocomplete/?term=a')
+        self.assertEqual(response.code, 200)
+        self.assertTrue(response.effective_url.endswith(
+            '?next=%2Fag_autocomplete%2F%3Fterm%3Da'))
+
+    def test_get(self):
+        self.mock_login_admin()
+        kit_id = db.ut_get_supplied_kit_id(
+            'd8592c74-7cf9-2135-e040-8a80115d6401')
+        response = self.get('/ag_autocomplete/?kind=kit_id&term=%s' %
+                            kit_id[:-1])
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.headers['Content-Type'],
+                         'application/json')
+        self.assertIn(kit_id, loads(response.body))
+
+        response = self.get('/ag_autocomplete/?term=0&limit=3')
+        self.assertEqual(response.code, 200)
+        self.assertEqual(len(loads(response.body)), 3)
+
+    def test_get_kits_access(self):
+        db.alter_access_levels('test', [2])
+        self.mock_login()
+        response = self.get('/ag_autocomplete/?kind=kit_id&term=a')
+        self.assertEqual(response.code, 200)
+        response = self.get('/ag_autocomplete/?kind=kit_id'
+                            '&kind=handout_kit_id&term=a')
+        self.assertEqual(response.code, 200)
+        # emails and barcodes need the Search access level
+        for query in ('kind=email&', 'kind=barcode&',
+                      'kind=kit_id&kind=email&', ''):
+            response = self.get('/ag_autocomplete/?%sterm=a' % query)
+            self.assertEqual(response.code, 403)
+
+        db.alter_access_levels('test', [6])
+        response = self.get('/ag_autocomplete/?kind=email&term=a')
+        self.assertEqual(response.code, 200)
+
+    def test_get_bad_limit(self):
+        self.mock_login_admin()
+        for limit in ('abc', '0', '-1'):
+            response = self.get('/ag_autocomplete/?term=0&limit=%s' % limit)
+            self.assertEqual(response.code, 400)
+        response = self.get('/ag_autocomplete/?term=0&limit=100000')
+        self.assertEqual(response.code, 200)
+        self.assertLessEqual(len(loads(response.body)), 100)
+
+    def test_get_unknown_kind(self):
+        self.mock_login_admin()
+        response = self.get('/ag_autocomplete/?kind=foo&term=a')
+        self.assertEqual(response.code, 400)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,32 @@
 from unittest import main
 import os
+from multiprocessing import Pool
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+from threading import current_thread
+
+from mock import patch
 
 from tornado.escape import url_escape, xhtml_escape
 from tornado.httpclient import HTTPError
 
 from knimin.tests.tornado_test_base import TestHandlerBase
+from knimin.lib.pdf_cache import PDFCache
+from knimin.lib.squash_barcodes import barcodes_pdf_key
 from knimin import db
 
 
 class TestAGBarcodePrintoutHandler(TestHandlerBase):
+    def setUp(self):
+        super(TestAGBarcodePrintoutHandler, self).setUp()
+        self.cache_dir = mkdtemp()
+        self.app.barcode_pdfs = PDFCache(self.cache_dir, 1024 * 1024)
+
+    def tearDown(self):
+        rmtree(self.cache_dir)
+        super(TestAGBarcodePrintoutHandler, self).tearDown()
+
     def test_get_not_authed(self):
         response = self.get('/ag_new_barcode/download/')
         self.assertEqual(response.code, 405)  # Method Not Allowed
@@ -23,7 +41,78 @@ class TestAGBarcodePrintoutHandler(TestHandlerBase):
         # check that the files is a PDF ...
         self.assertIn('%PDF-1.', response.body)
         # ... and it is not empty
-        self.assertEqual(len(response.body) > 1000, True)
+        self.assertIn('/Count 1/', response.body)
+        self.assertTrue(response.body.endswith('%%EOF\n'))
+
+    def test_post_reprint(self):
+        self.mock_login_admin()
+        response = self.post('/ag_new_barcode/download/',
+                             {'barcodes': "1111,222,33,4"})
+        self.assertEqual(response.code, 200)
+        path = join(self.cache_dir,
+                    '%s.pdf' % barcodes_pdf_key(['1111', '222', '33', '4']))
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), response.body)
+
+        # the reprint is the cached PDF
+        with open(path, 'wb') as f:
+            f.write('%PDF-1.4 cached')
+        response = self.post('/ag_new_barcode/download/',
+                             {'barcodes': "1111,222,33,4"})
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.body, '%PDF-1.4 cached')
+
+    def test_post_process_pool(self):
+        self.mock_login_admin()
+        exp = self.post('/ag_new_barcode/download/',
+                        {'barcodes': "1111,222,33,4"})
+        rmtree(self.cache_dir)
+
+        self.app.process_pool = Pool(2)
+        try:
+            response = self.post('/ag_new_barcode/download/',
+                                 {'barcodes': "1111,222,33,4"})
+        finally:
+            self.app.process_pool.close()
+            self.app.process_pool.join()
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.body, exp.body)
+
+    def test_post_evicted(self):
+        self.mock_login_admin()
+        self.post('/ag_new_barcode/download/', {'barcodes': "1111"})
+        path = join(self.cache_dir, '%s.pdf' % barcodes_pdf_key(['1111']))
+        get = self.app.barcode_pdfs.get
+
+        def evicted(key):
+            # evicted between finding the PDF and opening it
+            os.remove(path)
+            return get(key)
+
+        with patch.object(self.app.barcode_pdfs, 'get', evicted):
+            response = self.post('/ag_new_barcode/download/',
+                                 {'barcodes': "1111"})
+        self.assertEqual(response.code, 200)
+        self.assertIn('/Count 1/', response.body)
+
+    def test_post_off_ioloop(self):
+        threads = []
+
+        def render(barcodes, write, processes, pool):
+            threads.append(current_thread())
+            # no pool to render on, so this thread does not fork
+            self.assertEqual((processes, pool), (1, None))
+            write('%PDF-1.4 rendered')
+
+        self.mock_login_admin()
+        with patch('knimin.handlers.ag_new_barcode.write_barcodes_pdf',
+                   render):
+            response = self.post('/ag_new_barcode/download/',
+                                 {'barcodes': "1111"})
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.body, '%PDF-1.4 rendered')
+        self.assertEqual(len(threads), 1)
+        self.assertNotEqual(threads[0], current_thread())
 
 
 class TestAGBarcodeAssignedHandler(TestHandlerBase):
@@ -115,7 +204,7 @@ class TestAGNewBarcodeHandler(TestHandlerBase):
             (num_barcodes, ", ".join(projects)))
         self.assertIn(exp, response.body)
 
-        # check if SQL error is thrown if number of barcodes is 0.
+        # check if an error is shown if number of barcodes is 0.
         # See issue: #107
         response = self.post('/ag_new_barcode/',
                              {'action': 'assign',
@@ -123,7 +212,7 @@ class TestAGNewBarcodeHandler(TestHandlerBase):
                               'projects': projects,
                               'newproject': ""})
         self.assertEqual(response.code, 200)
-        self.assertIn("Error running SQL query: UPDATE barcodes.barcode",
+        self.assertIn("ERROR! Number of barcodes must be positive, got 0",
                       response.body)
 
         # check recognition of existing projects
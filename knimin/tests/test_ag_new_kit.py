@@ -1,11 +1,23 @@
-from unittest import main
+from unittest import main, TestCase
+from collections import namedtuple
+from hashlib import md5
+from io import BytesIO
+from threading import current_thread
+from zipfile import ZipFile
+
+from mock import patch
 
 from tornado.escape import url_escape, xhtml_escape
-from json import loads, dumps
+from json import loads
 
 from knimin.tests.tornado_test_base import TestHandlerBase
+from knimin.handlers.ag_new_kit import KitBatchStore, AGNewKitDLHandler
+from knimin.lib.util import get_printout_data, hash_passwords
 from knimin import db
 
+KitTuple = namedtuple('AGKit', ['kit_id', 'password', 'verification_code',
+                                'barcodes'])
+
 
 class TestAGNewKitDLHandler(TestHandlerBase):
     def test_get_not_authed(self):
@@ -15,19 +27,69 @@ class TestAGNewKitDLHandler(TestHandlerBase):
     def test_post(self):
         self.mock_login_admin()
 
-        # fake kitinfo data structure
-        kitinfo = [["xxx_pggwy", "96812490", "23577",
-                    ["000033914", "000033915"]],
-                   ["xxx_drcrv", "33422033", "56486",
-                    ["000033916", "000033917"]]]
-        response = self.post('/ag_new_kit/download/',
-                             {'kitinfo': dumps(kitinfo),
-                              'fields': ('kit_id,password,verification_code,'
-                                         'barcodes')})
+        kits = [KitTuple('xxx_pggwy', '96812490', '23577',
+                         ('000033914', '000033915')),
+                KitTuple('xxx_drcrv', '33422033', '56486',
+                         ('000033916', '000033917'))]
+        batch = self.app.kit_batches.add('test', kits)
+        response = self.post('/ag_new_kit/download/', {'batch': batch})
         self.assertEqual(response.code, 200)
-        # is it necessary to unpack the zipfile and check its content?
         self.assertEqual(response.headers['Content-Disposition'],
                          'attachment; filename=kitinfo.zip')
+        kit_zip = ZipFile(BytesIO(response.body))
+        self.assertEqual(kit_zip.read('kit_printouts.txt'),
+                         get_printout_data(kits))
+        self.assertEqual(kit_zip.read('kit_table.txt'),
+                         "kit_id\tpassword\tverification_code\tbarcodes\n"
+                         "xxx_pggwy\t96812490\t23577\t"
+                         "('000033914', '000033915')\n"
+                         "xxx_drcrv\t33422033\t56486\t"
+                         "('000033916', '000033917')")
+
+        # batches are only given to the user who created them
+        other = self.app.kit_batches.add('other', kits)
+        response = self.post('/ag_new_kit/download/', {'batch': other})
+        self.assertEqual(response.code, 404)
+
+        response = self.post('/ag_new_kit/download/', {'batch': 'nope'})
+        self.assertEqual(response.code, 404)
+
+    def test_post_flushes(self):
+        self.mock_login_admin()
+        kits = [KitTuple('xxx_%05d' % i, md5(str(i)).hexdigest(), '23577',
+                         ('%09d' % (2 * i), '%09d' % (2 * i + 1)))
+                for i in range(2000)]
+        batch = self.app.kit_batches.add('test', kits)
+        exp = self.post('/ag_new_kit/download/', {'batch': batch}).body
+
+        flush = AGNewKitDLHandler.flush
+        flushes = []
+
+        def waited_flush(handler, *args, **kwargs):
+            # more is only written once the last flush went out
+            self.assertTrue(all(f.done() for f in flushes))
+            flushes.append(flush(handler, *args, **kwargs))
+            return flushes[-1]
+
+        with patch.object(AGNewKitDLHandler, 'flush_size', 1024), \
+                patch.object(AGNewKitDLHandler, 'flush', waited_flush):
+            response = self.post('/ag_new_kit/download/', {'batch': batch})
+        self.assertEqual(response.body, exp)
+        self.assertGreater(len(flushes), 2)
+
+
+class TestKitBatchStore(TestCase):
+    def test_add_get(self):
+        store = KitBatchStore()
+        batch = store.add('test', ['kit'])
+        self.assertEqual(store.get('test', batch), ['kit'])
+        self.assertIsNone(store.get('other', batch))
+        self.assertIsNone(store.get('test', 'nope'))
+
+    def test_expire(self):
+        store = KitBatchStore(max_age=-1)
+        batch = store.add('test', ['kit'])
+        self.assertIsNone(store.get('test', batch))
 
 
 class TestAGNewKitHandler(TestHandlerBase):
@@ -66,14 +128,34 @@ class TestAGNewKitHandler(TestHandlerBase):
                               'swabs': swabs,
                               'kits': kits,
                               })
-        kitinfo = loads(response.body)
-        self.assertEqual(len(kitinfo['kitinfo']), sum(kits))
-        for k in kitinfo['kitinfo']:
-            self.assertIn(tag, k[0])
-        self.assertEqual(len(kitinfo['kitinfo'][0][-1]), swabs[0])
-        self.assertEqual(len(kitinfo['kitinfo'][1][-1]), swabs[1])
-        self.assertEqual(kitinfo['fields'],
-                         "kit_id,password,verification_code,barcodes")
+        obs = loads(response.body)
+        self.assertEqual(obs['kits'], sum(kits))
+        self.assertEqual(obs['barcodes'], 6)
+        kitinfo = self.app.kit_batches.get('test', obs['batch'])
+        self.assertEqual(len(kitinfo), sum(kits))
+        for k in kitinfo:
+            self.assertIn(tag, k.kit_id)
+        self.assertEqual(len(kitinfo[0].barcodes), swabs[0])
+        self.assertEqual(len(kitinfo[1].barcodes), swabs[1])
+
+        # the passwords are hashed off the IOLoop
+        threads = []
+
+        def hash_off_ioloop(passwords, processes, pool):
+            threads.append(current_thread())
+            # no pool to hash on, so this thread does not fork
+            self.assertEqual((processes, pool), (1, None))
+            return hash_passwords(passwords, processes, pool)
+
+        with patch('knimin.handlers.ag_new_kit.hash_passwords',
+                   hash_off_ioloop):
+            response = self.post('/ag_new_kit/',
+                                 {'tag': tag, 'projects': [project1],
+                                  'swabs': [1], 'kits': [2]})
+        self.assertEqual(response.code, 200)
+        self.assertEqual(loads(response.body)['kits'], 2)
+        self.assertEqual(len(threads), 1)
+        self.assertNotEqual(threads[0], current_thread())
 
         # missing argument
         response = self.post('/ag_new_kit/',
@@ -114,7 +196,7 @@ class TestAGNewKitHandler(TestHandlerBase):
                               'kits': kits,
                               })
         self.assertEqual(response.code, 500)
-        self.assertIn("SET assigned_on = NOW() WHERE barcode IN ()",
+        self.assertIn("Number of barcodes must be positive, got 0",
                       response.body)
 
         # no kits given
@@ -125,7 +207,7 @@ class TestAGNewKitHandler(TestHandlerBase):
                               'kits': [],
                               })
         self.assertEqual(response.code, 500)
-        self.assertIn("SET assigned_on = NOW() WHERE barcode IN ()",
+        self.assertIn("Number of barcodes must be positive, got 0",
                       response.body)
 
         # what if tag is None
@@ -136,8 +218,9 @@ class TestAGNewKitHandler(TestHandlerBase):
                               'kits': kits,
                               })
         self.assertEqual(response.code, 200)
-        kitinfo = loads(response.body)
-        self.assertNotIn('_', kitinfo['kitinfo'][0][0])
+        batch = loads(response.body)['batch']
+        kitinfo = self.app.kit_batches.get('test', batch)
+        self.assertNotIn('_', kitinfo[0].kit_id)
 
 
 if __name__ == "__main__":
@@ -1,5 +1,7 @@
 from unittest import main
 
+from mock import patch
+
 from tornado.escape import url_escape
 
 from knimin.tests.tornado_test_base import TestHandlerBase
@@ -69,6 +71,37 @@ class testAGSearchHandler(TestHandlerBase):
                             self.assertIn(str(exp),
                                           response.body)
 
+    def test_post_next_page(self):
+        self.mock_login_admin()
+        search_term = 'a'
+        logins = set(db.search_participant_info(search_term))
+        logins.update(db.search_kits(search_term))
+        logins.update(db.search_barcodes(search_term))
+        logins = sorted(logins)
+
+        with patch('knimin.handlers.ag_search.config') as config:
+            config.search_page_size = 1
+            response = self.post('/ag_search/', {'search_term': search_term})
+            self.assertEqual(response.code, 200)
+            self.assertIn('Next page', response.body)
+            self.assertIn('name="after" value="%s"' % logins[0],
+                          response.body)
+
+            # last page of logins
+            response = self.post('/ag_search/',
+                                 {'search_term': search_term,
+                                  'after': logins[-2],
+                                  'handout_after': 'end'})
+            self.assertEqual(response.code, 200)
+            self.assertNotIn('Next page', response.body)
+
+    def test_post_bad_handout_cursor(self):
+        self.mock_login_admin()
+        response = self.post('/ag_search/', {'search_term': 'a',
+                                             'after': 'end',
+                                             'handout_after': 'nocolon'})
+        self.assertEqual(response.code, 400)
+
     def test_search_barcodes(self):
         # Elaine Wolfe found the following bug, May 13th 2017:
         # Barcodes in a kit do not show up unless they are logged when
@@ -23,9 +23,28 @@ class TestProjectsSummaryHandler(TestHandlerBase):
         # check that correct information is printed on HTML page.
         for project_name in db.getProjectNames():
             num_barcodes = len(db.get_barcodes_for_projects([project_name]))
-            self.assertIn('<tr><td>%s</td>' % xhtml_escape(project_name),
-                          obs)
-            self.assertIn('<td>%s</td></tr>' % num_barcodes, obs)
+            self.assertIn('<tr><td>%s</td><td>%s</td>' %
+                          (xhtml_escape(project_name), num_barcodes), obs)
+
+    def test_get_cached(self):
+        self.mock_login()
+        cache = self.app.projects_summary
+        self.get('/projects/summary/')
+        summary = cache.summary
+        updated = cache.updated
+
+        # a fresh summary is served as is
+        self.get('/projects/summary/')
+        self.assertIs(cache.summary, summary)
+        self.assertEqual(cache.updated, updated)
+
+        # a stale one is served, then recounted in the background
+        cache.max_age = 0
+        response = self.get('/projects/summary/')
+        self.assertEqual(response.code, 200)
+        self.io_loop.run_sync(cache.refresh)
+        self.assertIsNot(cache.summary, summary)
+        self.assertEqual(cache.summary, summary)
 
 
 if __name__ == '__main__':
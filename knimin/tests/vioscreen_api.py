@@ -0,0 +1,223 @@
+"""Local stand-in for the vioscreen API
+
+Serves the auth, users, sessions, detail and session data endpoints used by
+knimin.lib.vioscreen from the recorded session in data/vioscreen, so syncs
+can be tested and benchmarked without the real API::
+
+    api = VioscreenStandIn({'853df6a15d131b2c': 'Finished'}, latency=0.05)
+    url = api.start()
+    ...
+    api.stop()
+
+Every user gets a copy of the recorded session. Requests can be delayed,
+fail at random with 503 and have their tokens expire, to see how a sync
+copes with a slow or unreliable API.
+"""
+import json
+from hashlib import md5
+from os.path import dirname, join
+from random import Random
+from threading import Event, Thread
+from time import time
+from uuid import uuid4
+
+from tornado import gen
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+from tornado.testing import bind_unused_port
+from tornado.web import Application, RequestHandler
+
+SESSION_FP = join(dirname(__file__), 'data', 'vioscreen', 'session.json')
+ENDPOINTS = ('foodcomponents', 'percentenergy', 'mpeds', 'eatingpatterns',
+             'foodconsumption', 'dietaryscore')
+
+
+def session_id(username):
+    """The session ID the stand-in gives a user"""
+    return md5(username).hexdigest()
+
+
+class StandInHandler(RequestHandler):
+    def initialize(self, api):
+        self.api = api
+
+    @gen.coroutine
+    def prepare(self):
+        self.api.requests += 1
+        if self.api.latency:
+            yield gen.sleep(self.api.latency)
+        if self.api.random.random() < self.api.error_rate:
+            self.api.errors += 1
+            self.set_status(503)
+            self.finish('Service Unavailable')
+        elif not isinstance(self, LoginHandler) and not self._check_token():
+            self.api.errors += 1
+            self.set_status(401)
+            self.finish({'Code': 1016, 'Message': 'Token has expired'})
+
+    def _check_token(self):
+        auth = self.request.headers.get('Authorization', '')
+        issued = self.api.tokens.get(auth[len('Bearer '):])
+        if issued is None:
+            return False
+        lifetime = self.api.token_lifetime
+        return lifetime is None or time() - issued < lifetime
+
+    def not_found(self, message):
+        self.set_status(404)
+        self.finish({'Code': 1001, 'Message': message})
+
+    def session(self, sessionid):
+        username = self.api.sessions.get(sessionid)
+        if username is None:
+            self.not_found('Session not found')
+        return username
+
+
+class LoginHandler(StandInHandler):
+    def post(self, regcode):
+        token = uuid4().hex
+        self.api.tokens[token] = time()
+        self.finish({'token': token})
+
+
+class UsersHandler(StandInHandler):
+    def get(self, regcode):
+        self.finish({'users': [{'username': u, 'subjectId': u}
+                               for u in sorted(self.api.users)]})
+
+
+class SessionsHandler(StandInHandler):
+    def get(self, regcode, username):
+        if username not in self.api.users:
+            return self.not_found('User not found')
+        self.finish({'sessions': [{'sessionId': self.api.session_ids[username],
+                                   'username': username,
+                                   'status': self.api.users[username]}]})
+
+
+class DetailHandler(StandInHandler):
+    def get(self, regcode, sessionid):
+        username = self.session(sessionid)
+        if username is not None:
+            detail = dict(self.api.fixture['detail'], sessionId=sessionid,
+                          username=username,
+                          status=self.api.users[username])
+            self.finish(detail)
+
+
+class SessionDataHandler(StandInHandler):
+    def get(self, regcode, sessionid, endpoint):
+        username = self.session(sessionid)
+        if username is not None:
+            self.set_header('Content-Type', 'application/json')
+            self.finish(self.api.payloads[endpoint].replace(
+                self.api.fixture['detail']['sessionId'], sessionid))
+
+
+class VioscreenStandIn(object):
+    """Local vioscreen API serving a recorded session for every user
+
+    Parameters
+    ----------
+    users : dict of {str: str}
+        Usernames and the status of their session
+    latency : float, optional
+        Seconds each request takes. Default 0
+    error_rate : float, optional
+        Fraction of requests answered with 503. Default 0
+    token_lifetime : float, optional
+        Seconds a token is accepted for. Default forever
+    scale : int, optional
+        Times the recorded rows are repeated in each session's data, to
+        stand in for larger sessions. Default 1
+    seed : int, optional
+        Seed for the injected errors
+    """
+    def __init__(self, users, latency=0, error_rate=0, token_lifetime=None,
+                 scale=1, seed=None):
+        self.users = dict(users)
+        self.session_ids = {u: session_id(u) for u in self.users}
+        self.sessions = {s: u for u, s in self.session_ids.items()}
+        self.latency = latency
+        self.error_rate = error_rate
+        self.token_lifetime = token_lifetime
+        self.random = Random(seed)
+        self.tokens = {}
+        self.requests = 0
+        self.errors = 0
+        self.url = None
+
+        with open(SESSION_FP) as f:
+            self.fixture = json.load(f)
+        self.payloads = {}
+        for endpoint in ENDPOINTS:
+            payload = self.fixture[endpoint]
+            for rows in payload.values():
+                if isinstance(rows, dict):
+                    rows = rows.get('scores')
+                if isinstance(rows, list):
+                    rows[:] = rows * scale
+            self.payloads[endpoint] = json.dumps(payload)
+
+    def new_session(self, username, status):
+        """Replaces a user's session, as when they take the FFQ again
+
+        Returns
+        -------
+        str
+            The ID of the new session
+        """
+        sessionid = uuid4().hex[:16]
+        self.session_ids[username] = sessionid
+        self.sessions[sessionid] = username
+        self.users[username] = status
+        return sessionid
+
+    def make_app(self):
+        """Returns the tornado application serving the API"""
+        args = {'api': self}
+        return Application([
+            (r'/(\w+)/auth/login', LoginHandler, args),
+            (r'/(\w+)/users', UsersHandler, args),
+            (r'/(\w+)/users/(\w+)/sessions', SessionsHandler, args),
+            (r'/(\w+)/sessions/(\w+)/detail', DetailHandler, args),
+            (r'/(\w+)/sessions/(\w+)/(%s)' % '|'.join(ENDPOINTS),
+             SessionDataHandler, args)])
+
+    def _serve(self, started):
+        self.io_loop = IOLoop()
+        self.io_loop.make_current()
+        sock, port = bind_unused_port()
+        self._server = HTTPServer(self.make_app())
+        self._server.add_sockets([sock])
+        self.url = 'http://127.0.0.1:%d' % port
+        started.set()
+        self.io_loop.start()
+        self.io_loop.close(all_fds=True)
+
+    @gen.coroutine
+    def _shutdown(self):
+        self._server.stop()
+        yield self._server.close_all_connections()
+        self.io_loop.stop()
+
+    def start(self):
+        """Serves the API on a free local port, on a background thread
+
+        Returns
+        -------
+        str
+            Address of the API
+        """
+        started = Event()
+        self._thread = Thread(target=self._serve, args=(started,))
+        self._thread.daemon = True
+        self._thread.start()
+        started.wait()
+        return self.url
+
+    def stop(self):
+        """Stops serving the API"""
+        self.io_loop.add_callback(self._shutdown)
+        self._thread.join()
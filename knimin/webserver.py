@@ -1,5 +1,6 @@
 from os.path import dirname, join
 from base64 import b64encode
+from multiprocessing import Pool
 from uuid import uuid4
 
 from tornado.httpserver import HTTPServer
@@ -7,15 +8,19 @@ from tornado.ioloop import IOLoop
 from tornado.web import Application, StaticFileHandler
 from tornado.options import define, options, parse_command_line
 
+from knimin import typeahead
 from knimin.lib.configuration import config
+from knimin.lib.pdf_cache import PDFCache
 from knimin.handlers.base import MainHandler, NoPageHandler
 from knimin.handlers.auth_handlers import AuthLoginHandler, AuthLogoutHandler
 from knimin.handlers.ag_search import AGSearchHandler
+from knimin.handlers.ag_autocomplete import AGAutocompleteHandler
 from knimin.handlers.logged_in_index import LoggedInIndexHandler
 from knimin.handlers.barcode_util import BarcodeUtilHandler, PushQiitaHandler
 from knimin.handlers.ag_stats import AGStatsHandler
 from knimin.handlers.ag_edit_participant import AGEditParticipantHandler
-from knimin.handlers.ag_new_kit import AGNewKitHandler, AGNewKitDLHandler
+from knimin.handlers.ag_new_kit import (AGNewKitHandler, AGNewKitDLHandler,
+                                        KitBatchStore)
 from knimin.handlers.ag_new_barcode import (AGNewBarcodeHandler,
                                             AGBarcodePrintoutHandler,
                                             AGBarcodeAssignedHandler)
@@ -29,7 +34,8 @@ from knimin.handlers.ag_get_participant_names import (AGNamesHandler,
 from knimin.handlers.ag_third_party import (AGThirdPartyHandler,
                                             AGNewThirdPartyHandler)
 from knimin.handlers.ag_consent_check import AGConsentCheckHandler
-from knimin.handlers.projects_summary import ProjectsSummaryHandler
+from knimin.handlers.projects_summary import (ProjectsSummaryHandler,
+                                              ProjectSummaryCache)
 from knimin.handlers.access_control import AGEditAccessHandler
 from knimin.handlers.ag_results_ready import AGResultsReadyHandler
 
@@ -42,7 +48,17 @@ COOKIE_SECRET = b64encode(uuid4().bytes + uuid4().bytes)
 
 
 class WebApplication(Application):
-    def __init__(self):
+    """The labadmin web application
+
+    Parameters
+    ----------
+    process_pool : multiprocessing.Pool, optional
+        Worker processes for CPU bound work such as rendering barcode
+        sheets. It must be started before any threads, as forking a
+        threaded process can deadlock. Default None, the work is done on
+        the handlers' threads instead
+    """
+    def __init__(self, process_pool=None):
         handlers = [
             (r"/results/(.*)", StaticFileHandler,
                 {"path": '/tmp/'}),
@@ -52,6 +68,7 @@ class WebApplication(Application):
             (r"/auth/logout/", AuthLogoutHandler),
             (r"/logged_in_index/", LoggedInIndexHandler),
             (r"/ag_search/", AGSearchHandler),
+            (r"/ag_autocomplete/", AGAutocompleteHandler),
             (r"/barcode_util/", BarcodeUtilHandler),
             (r"/notify-qiita/", PushQiitaHandler),
             (r"/ag_add_barcode_kit/", AGAddBarcodeKitHandler),
@@ -84,6 +101,12 @@ class WebApplication(Application):
             "login_url": "/login/",
         }
         super(WebApplication, self).__init__(handlers, **settings)
+        self.process_pool = process_pool
+        self.projects_summary = ProjectSummaryCache()
+        self.kit_batches = KitBatchStore()
+        self.barcode_pdfs = PDFCache(
+            join(config.base_data_dir, 'barcode_pdfs'),
+            config.barcode_pdf_cache_mb * 1024 * 1024)
 
 
 def main():
@@ -91,8 +114,11 @@ def main():
     prefix = join(config.base_log_dir, "labadmin_%d.log" % options.port)
     options.log_file_prefix = prefix
     parse_command_line()
-    http_server = HTTPServer(WebApplication())
+    # started before the server and the handlers' threads
+    process_pool = Pool()
+    http_server = HTTPServer(WebApplication(process_pool))
     http_server.listen(options.port)
+    typeahead.start()
     print("Tornado started on port %d" % options.port)
     IOLoop.instance().start()
 